@@ -111,11 +111,16 @@ class PTBModel(object):
       #embedding = tf.get_variable("embedding", [vocab_size, size])
       #inputs = tf.nn.embedding_lookup(embedding, self._input_data)
 
-      bit_vector_embeddings=reader.get_bitvector_embeddings(lang,vocab_size,config.representation)
-      bv_embedding_size=int(bit_vector_embeddings.get_shape()[1])
-      embedding = tf.get_variable("embedding", [bv_embedding_size,size])
-      embedding_wrapper  = tf.matmul(bit_vector_embeddings , embedding)
-      inputs = tf.nn.embedding_lookup(embedding_wrapper, self._input_data)
+      if config.representation=='onehot':
+        ## the onehot bit-vector embeddings are an identity matrix, so the embedding is looked up directly
+        embedding = tf.get_variable("embedding", [vocab_size, size])
+        inputs = tf.nn.embedding_lookup(embedding, self._input_data)
+      else:
+        bit_vector_embeddings=reader.get_bitvector_embeddings(lang,vocab_size,config.representation)
+        bv_embedding_size=int(bit_vector_embeddings.get_shape()[1])
+        embedding = tf.get_variable("embedding", [bv_embedding_size,size])
+        embedding_wrapper  = tf.matmul(bit_vector_embeddings , embedding)
+        inputs = tf.nn.embedding_lookup(embedding_wrapper, self._input_data)
 
     if is_training and config.keep_prob < 1:
       inputs = tf.nn.dropout(inputs, config.keep_prob)
@@ -1,5 +1,6 @@
 import Mapping
 import encoders
+import utilities
 
 import tensorflow as tf
 from tensorflow.python.ops import rnn, rnn_cell
@@ -59,10 +60,14 @@ class AttentionModel():
         self.embed_b = dict()
 
         # Finds bit-vector representation for each character of each language
+        # The onehot representations are identity matrices, so they are not created: the embedding matrix is 
+        # used directly instead of multiplying it with the bit-vector embeddings. This also keeps the 
+        # gradients of the embeddings sparse. The variables are the same, so saved models are compatible
         self.bitvector_embeddings={}
         self.bitvector_embedding_size={}
         for lang in self.lang_list:
-            self.bitvector_embeddings[lang] = tf.constant(self.mapping[lang].get_bitvector_embeddings(lang,self.representation[lang]),dtype=tf.float32)
+            if self.representation[lang] not in ['onehot','onehot_shared']:
+                self.bitvector_embeddings[lang] = tf.constant(self.mapping[lang].get_bitvector_embeddings(lang,self.representation[lang]),dtype=tf.float32)
             self.bitvector_embedding_size[lang]=self.mapping[lang].get_bitvector_embedding_size(self.representation[lang])
 
         # Converting the character representation to embedding_size vector
@@ -76,12 +81,16 @@ class AttentionModel():
                     self.embed_W0 = tf.Variable(tf.random_uniform([self.bitvector_embedding_size[lang],self.embedding_size], -1*max_val, max_val), name = 'embed_W0')
                     self.embed_b0 = tf.Variable(tf.constant(0., shape=[self.embedding_size]), name = 'embed_b0')
 
-                self.embed_W[lang] = tf.matmul(self.bitvector_embeddings[lang], self.embed_W0, name='embed_W_{}'.format(lang))
+                if self.representation[lang] == 'onehot_shared':
+                    self.embed_W[lang] = self.embed_W0
+                else:
+                    self.embed_W[lang] = tf.matmul(self.bitvector_embeddings[lang], self.embed_W0, name='embed_W_{}'.format(lang))
                 self.embed_b[lang] = self.embed_b0
             elif self.representation[lang] ==  'onehot':
-                ### TODO: maybe multiplication by identity bitvector embedding is not required
+                ### multiplication by identity bitvector embedding is not required
                 x = tf.Variable(tf.random_uniform([self.bitvector_embedding_size[lang],self.embedding_size], -1*max_val, max_val))
-                self.embed_W[lang] = tf.matmul(self.bitvector_embeddings[lang], x, name='embed_W_{}'.format(lang))
+                #self.embed_W[lang] = tf.matmul(self.bitvector_embeddings[lang], x, name='embed_W_{}'.format(lang))
+                self.embed_W[lang] = x
                 self.embed_b[lang] = tf.Variable(tf.constant(0., shape=[self.embedding_size]), name = 'embed_b_{}'.format(lang))
 
         ####### Output embeddings 
@@ -99,10 +108,9 @@ class AttentionModel():
 
             out_representation='onehot_shared'  ### output side uses onehot_shared representation
 
-            self.out_bitvector_embeddings={}
+            ## the onehot_shared bit-vector embeddings are identity matrices, and are not needed (see the input embeddings)
             self.out_bitvector_embedding_size={}
             for lang in self.lang_list:
-                self.out_bitvector_embeddings[lang] = tf.constant(self.mapping[lang].get_bitvector_embeddings(lang,out_representation),dtype=tf.float32)
                 self.out_bitvector_embedding_size[lang]=self.mapping[lang].get_bitvector_embedding_size(out_representation)
 
             # Converting the character representation to embedding_size vector
@@ -115,7 +123,7 @@ class AttentionModel():
                     self.embed_outW0 = tf.Variable(tf.random_uniform([self.out_bitvector_embedding_size[lang],self.embedding_size], -1*max_val, max_val), name = 'embed_outW0')
                     self.embed_outb0 = tf.Variable(tf.constant(0., shape=[self.embedding_size]), name = 'embed_outb0')
 
-                self.embed_outW[lang] = tf.matmul(self.out_bitvector_embeddings[lang], self.embed_outW0, name='embed_outW_{}'.format(lang))
+                self.embed_outW[lang] = self.embed_outW0
                 self.embed_outb[lang] = self.embed_outb0
 
         ##### Create Encoder
@@ -218,7 +226,54 @@ class AttentionModel():
         states, enc_outputs = self.input_encoder.encode(sequence_embeddings,sequence_lengths,dropout_keep_prob)
         return states, enc_outputs
 
-    def compute_attention_context(self,prev_state,prev_out_embed,enc_outputs):
+    def precompute_attention_inputs(self,enc_outputs,sequence_lengths=None):
+        """
+            Compute the parts of the attention network input which depend only on the encoder outputs.
+            This is done once for a source sequence, and reused at every decoder step
+
+            Paramters: 
+
+            enc_outputs: list of Tensors with shape (batch_size x enc_output_size). 
+                Length of list=max_sequence_length. One element in the list for each timestamp. 
+                Or a Tensor of shape (batch_size x num_steps x enc_output_size) (the CNN encoders)
+            sequence_lengths: Tensor of shape (batch_size) containing length of each source sequence. If given, 
+                the encoder outputs are truncated to the longest sequence in the batch, and the positions after 
+                the end of each sequence (PAD) get zero attention weight. 
+
+            Returns: a tuple (ctx_vecs, enc_attn_term, attn_mask), to be passed to compute_attention_context
+              ctx_vecs: encoder outputs, shape: (batch_size x num_ctx_vec x enc_output_size)
+              enc_attn_term: contribution of the encoder outputs to the attention network output (before the 
+                             non-linearity), shape: (batch_size x num_ctx_vec)
+              attn_mask: added to the attention network output, 0 within the sequence and a large negative number 
+                         for PAD, shape: (batch_size x num_ctx_vec). None if sequence_lengths is not given
+        """
+
+        ## reshaping and transposing enc_outputs
+        if isinstance(enc_outputs,list):
+            a3=tf.pack(enc_outputs)
+            a4=tf.transpose(a3,[1,0,2])
+            num_ctx_vec=self.max_sequence_length
+        else:
+            a4=enc_outputs
+            num_ctx_vec=tf.shape(a4)[1]
+
+        attn_mask=None
+        if sequence_lengths is not None: 
+            a4, lengths = encoders.truncate_to_longest(a4, sequence_lengths)
+            num_ctx_vec=tf.shape(a4)[1]
+            attn_mask=(1.0-tf.cast(tf.sequence_mask(lengths,num_ctx_vec),tf.float32))*-1e9
+
+        a5=tf.reshape(a4,[-1,self.ctxvec_size],name='attn__a5__enc_outputs_shaped')
+
+        ## The attention network is linear in its input [prev_state, prev_out_embed, enc_output] before the non-linearity. 
+        ## So the rows of attn_W for the encoder outputs are applied here, and the rest in compute_attention_context
+        attn_W_enc=tf.slice(self.attn_W,[self.dec_state_size+self.embedding_size,0],[self.ctxvec_size,1])
+        a7_enc=tf.matmul(a5,attn_W_enc)+self.attn_b
+        a7_enc=tf.reshape(a7_enc,tf.pack([-1,num_ctx_vec]),name='attn__a7_enc__network_output_enc')
+
+        return a4, a7_enc, attn_mask
+
+    def compute_attention_context(self,prev_state,prev_out_embed,attn_inputs):
         """
             Compute the annotation/context vector using the attention mechanism,
             which can be used by the decoder for predicting the next symbol
@@ -227,105 +282,60 @@ class AttentionModel():
 
             prev_state: Previous decoder state. 
                         Shape: batch_size x decoder_state_size 
+                        For beam search: (batch_size*num_beams) x decoder_state_size, with the beams of each 
+                        input in consecutive rows
             prev_out_embed: Embedding for the previous decoder output. 
-                            Shape: batch_size x output_embedding_size
-            enc_outputs: list of Tensors with shape (batch_size x enc_output_size). 
-                Length of list=max_sequence_length. One element in the list for each timestamp
+                            Shape: same number of rows as prev_state x output_embedding_size
+            attn_inputs: output of precompute_attention_inputs for the encoder outputs, one for each input 
+                         in the batch. It is not replicated for the beams: row r of prev_state attends over 
+                         the encoder outputs of input r/num_beams
 
 
-            Returns: annotation/context vector of shape (batch_size x enc_output_size)
+            Returns: annotation/context vector of shape (number of rows of prev_state x enc_output_size)
         """
 
-        batch_size=tf.shape(prev_state)[0]
-
-        ## reshaping and transposing enc_outputs
-        a3=tf.pack(enc_outputs)
-        a4=tf.transpose(a3,[1,0,2])
-        a5=tf.reshape(a4,[-1,self.ctxvec_size],name='attn__a5__enc_outputs_shaped')
-
-        num_ctx_vec=self.max_sequence_length
-        #num_ctx_vec=tf.shape(a3)[0]
+        a4, a7_enc, attn_mask = attn_inputs
 
-        ## getting prev_state and prev_out_embed in the correct shape
-        ## and duplicate them for cacatenating with enc_outputs
+        ###### Only the decoder side of the attention network is computed at each step, once for each input in the batch. 
+        ## It is the same for all encoder vectors and is added to the precomputed encoder side
         att_ref=tf.concat(1,[prev_state,prev_out_embed])
-        a1=tf.tile(att_ref,[1,num_ctx_vec])
-        a2=tf.reshape(a1,[-1,self.dec_state_size+self.embedding_size],name='attn__a2__state__embed_shaped')
-
-        ## preparing the input to the attention network
-        a6=tf.concat(1,[a2,a5],name='attn__a6__network_input')
-
-        ###### Passing through attention network
-        ## The network takes input for one encoder input and the current decoder state and output embedding and gives a scalar output
-        ## for all encoder vectors, at current decoder position, for the entire batch)
-
-        a7=tf.matmul(a6,self.attn_W)+self.attn_b
-        a8=tf.nn.tanh(a7,name='attn__a7__network_output')
-        a9=tf.reshape(a8,[-1,num_ctx_vec],name='attn__a9')
+        attn_W_dec=tf.slice(self.attn_W,[0,0],[self.dec_state_size+self.embedding_size,1])
+        a7_dec=tf.matmul(att_ref,attn_W_dec,name='attn__a7_dec__network_output_dec')
+        ## the beams of an input share its encoder side: (batch_size x 1 x num_ctx_vec) + (batch_size x num_beams x 1)
+        batch_size=tf.shape(a7_enc)[0]
+        num_ctx_vec=tf.shape(a7_enc)[1]
+        a7=tf.expand_dims(a7_enc,1)+tf.reshape(a7_dec,tf.pack([batch_size,-1,1]))
+        a9=tf.nn.tanh(a7,name='attn__a9__network_output')
+        ## PAD positions get zero weight in the softmax
+        if attn_mask is not None: 
+            a9=a9+tf.expand_dims(attn_mask,1)
+        a9=tf.reshape(a9,tf.pack([-1,num_ctx_vec]))
 
         ## apply softmax to compute the weights for the encoder outputs
         a10=tf.nn.softmax(a9,name='attn__a10__softmax')
 
         # computing context vector
 
-        #### (a)
-        #a11=tf.unpack(a10,name='attn__a11__ctxweighting_input1')
-        #a12=tf.unpack(a4,num=batch_size,name='attn__a12__ctxweighting_input2')  ## organized as list, one for each input in batch (used later)
-        #a13=[]
-        #for i  in range(batch_size):
-        #    a13.append(tf.matmul(tf.expand_dims(a11[i],0),a12[i],name='attn__a13__{}__ctx_weighting'.format(i)))
-        #a14=tf.squeeze(tf.pack(a13),name='attn__a14__output')
-
-        ###### (b)
-        #a13=[]
-        #def loop_func(batch_no):
-        #    a11=tf.slice(a10,[batch_no,0],[1,self.max_sequence_length])
-        #    a12=tf.slice(a5,[batch_no*self.max_sequence_length,0],[self.max_sequence_length,self.ctxvec_size])
-        #    a13.append(tf.matmul(a11,a12,name='attn__a13__{}__ctx_weighting'.format(batch_no)))
-        #    return tf.add(batch_no,1)
-
-        #cond=lambda bno:tf.less(bno,batch_size)
-        #bno=tf.constant(0)
-
-        #tf.while_loop(cond,loop_func,[bno])
-        #a14=tf.squeeze(tf.pack(a13),[1],name='attn__a14__output')
-
-        ###### (c)
-        #def loop_func(batch_no,_):
-        #    a11=tf.slice(a10,[batch_no,0],[1,self.max_sequence_length])
-        #    a12=tf.slice(a5,[batch_no*self.max_sequence_length,0],[self.max_sequence_length,self.ctxvec_size])
-        #    c=tf.matmul(a11,a12,name='attn__a13__{}__ctx_weighting'.format(batch_no))
-        #    return (tf.add(batch_no,1),c)
-
-        #cond=lambda bno, _:tf.less(bno,batch_size) ## FIXME: hardcoding
-        #bno=tf.constant(0)
-        #ctxv=tf.random_uniform((1,self.ctxvec_size))
-
-        #results=tf.while_loop(cond,loop_func,[bno,ctxv])
-        #[ x[1] for x in results ]
-        #a13=[ x[1] for x in results ]
-        #print 'hello'
-        #print a13
-        #a14=tf.squeeze(tf.pack(a13),[1],name='attn__a14__output')
-
-        #### (e)  This method finally worked and it is so simple and elegant!
-        def loop_func(batch_no):
-            a11=tf.slice(a10,[batch_no,0],[1,num_ctx_vec])
-            a12=tf.slice(a5,[batch_no*num_ctx_vec,0],[num_ctx_vec,self.ctxvec_size])
-            return tf.matmul(a11,a12)
-
-        a13=tf.map_fn(loop_func,tf.range(0,batch_size),dtype=tf.float32,parallel_iterations=100)
-        a14=tf.squeeze(a13,[1])
+        ## one batched matmul for the entire batch
+        ## (batch_size x num_beams x num_ctx_vec) x (batch_size x num_ctx_vec x ctxvec_size)
+        a13=tf.batch_matmul(tf.reshape(a10,tf.pack([batch_size,-1,num_ctx_vec])),a4,name='attn__a13__ctx_weighting')
+        a14=tf.reshape(a13,[-1,self.ctxvec_size],name='attn__a14__output')
 
         return a14
 
     # Find cross entropy loss in predicting target_sequences from computed hidden representation (intial state)
-    def seq_loss(self, target_sequence, target_masks, lang, initial_state, enc_output,dropout_keep_prob):
+    # sequence_lengths: lengths of the source sequences, for masking the attention (see precompute_attention_inputs)
+    def seq_loss(self, target_sequence, target_masks, lang, initial_state, enc_output,dropout_keep_prob,sequence_lengths=None):
 
         batch_size = tf.shape(target_sequence)[0]
 
         state = tf.matmul(initial_state,self.state_adapt_W) + self.state_adapt_b 
 
+        ## encoder side of the attention network, computed once for all decoder steps
+        attn_inputs=None
+        if self.enc_type!='simple_lstm_noattn':
+            attn_inputs=self.precompute_attention_inputs(enc_output,sequence_lengths)
+
         loss = 0.0
         cell = rnn_cell.DropoutWrapper(self.decoder_cell[lang],output_keep_prob=dropout_keep_prob)
 
@@ -349,7 +359,7 @@ class AttentionModel():
                 current_input=current_emb
             else: 
                 ## using the attention mechanism
-                context=self.compute_attention_context(state,current_emb,enc_output)
+                context=self.compute_attention_context(state,current_emb,attn_inputs)
                 current_input=tf.concat(1,[current_emb,context])
 
             # Run one step of the decoder cell. Updates 'state' and store output in 'output'
@@ -391,7 +401,8 @@ class AttentionModel():
                     lang2,target_sequences,target_sequence_masks,target_sequence_lengths,
                     dropout_keep_prob):
         hidden_representation, enc_output = self.compute_hidden_representation(sequences,sequence_lengths,lang1,dropout_keep_prob)
-        loss = self.seq_loss(target_sequences,target_sequence_masks,lang2,hidden_representation,enc_output,dropout_keep_prob)
+        loss = self.seq_loss(target_sequences,target_sequence_masks,lang2,hidden_representation,enc_output,dropout_keep_prob,
+                                sequence_lengths)
         return loss
 
     # Get a monolingual optimizer for 'lang' language
@@ -402,8 +413,9 @@ class AttentionModel():
                     lang2,target_sequences,target_sequence_masks,target_sequence_lengths,
                     dropout_keep_prob):
         hidden_representation, enc_output = self.compute_hidden_representation(sequences,sequence_lengths,lang1,dropout_keep_prob)
-        loss = self.seq_loss(target_sequences,target_sequence_masks,lang2,hidden_representation,enc_output,dropout_keep_prob)
-        optimizer = tf.train.AdamOptimizer(learning_rate).minimize(loss)
+        loss = self.seq_loss(target_sequences,target_sequence_masks,lang2,hidden_representation,enc_output,dropout_keep_prob,
+                                sequence_lengths)
+        optimizer = utilities.minimize(tf.train.AdamOptimizer(learning_rate),loss)
         return [ optimizer, loss ]
 
     def transliterate_beam(self, source_lang, sequences, sequence_lengths, target_lang, beam_size, topn):
@@ -435,6 +447,11 @@ class AttentionModel():
         initial_state, enc_output = self.compute_hidden_representation(sequences,sequence_lengths, source_lang,tf.constant(1.0))
         initial_state = tf.matmul(initial_state,self.state_adapt_W) + self.state_adapt_b 
 
+        ## encoder side of the attention network, computed once for all decoder steps
+        attn_inputs=None
+        if self.enc_type!='simple_lstm_noattn':
+            attn_inputs=self.precompute_attention_inputs(enc_output,sequence_lengths)
+
         ### start decoding 
 
         batch_size = tf.shape(sequences)[0]
@@ -469,7 +486,7 @@ class AttentionModel():
                 current_input=current_emb
             else: 
                 ## using the attention mechanism
-                context=self.compute_attention_context(prev_states,current_emb,enc_output)
+                context=self.compute_attention_context(prev_states,current_emb,attn_inputs)
                 current_input=tf.concat(1,[current_emb,context])
 
             # Run one step of the decoder cell. Updates 'state' and store output in 'output'
@@ -510,11 +527,6 @@ class AttentionModel():
             ##### update beam size after first iteration 
             if i==0:
                 cur_beam_size=beam_size
-                enc_output=tf.unpack(
-                        tf.reshape(   tf.tile(tf.pack(  enc_output   ),[1,1,beam_size]),
-                                    [self.max_sequence_length,-1,self.input_encoder.get_output_size()]
-                                  )
-                        )
 
             #### get top-n outputs for the last iteration                 
             if i==self.max_sequence_length-1: 
@@ -1,18 +1,53 @@
 import os 
+import json
+import numpy as np
 
 import Mapping
 import encoders
+import utilities
 
 import tensorflow as tf
 
+def load_attention_config(model_fname, attention, attention_window): 
+    """
+    The attention mechanism saved with the model 'model_fname' (see AttentionModel.save_attention_config). 
+    'attention' and 'attention_window' are returned for models saved without it
+
+    Returns a tuple (attention, attention_window)
+    """
+    config_fname = model_fname+'.attention.json'
+    if not os.path.exists(config_fname): 
+        return attention, attention_window
+    with open(config_fname,'r') as config_file: 
+        config = json.load(config_file)
+    return str(config['attention']), config['attention_window']
+
 class AttentionModel():
 
     def __init__(self,mapping,representation,max_sequence_length,
                     embedding_size,enc_rnn_size,dec_rnn_size,
-                    enc_type='cnn',separate_output_embedding=False):
+                    enc_type='cnn',separate_output_embedding=False,inference_mode=False,
+                    attention='global',attention_window=3,source_prefix_length=0):
+        """
+        attention: 'global' attends over all the positions of the source sequence at every decoder step. 
+            'local' attends only over the positions within 'attention_window' of a center which advances 
+            with the decoder step (see select_attention_window)
+        source_prefix_length: number of tokens prefixed to the source sequences (the language tokens of 
+            --prefix_tgtlang and --prefix_srclang, see Mapping.prefix_sequence_with_token). The center of the 
+            local attention window is shifted by it
+        inference_mode: build the graph for decoding only. The embedding matrices which are projections 
+            of the bit-vector embeddings are stored in tables that are not trained or saved, instead of being 
+            computed again on every run. Call fold_embeddings() after the parameters are restored to fill them
+        """
 
         self.max_sequence_length = max_sequence_length
         self.enc_type = enc_type 
+        ## the decoder uses the attention mechanism, except with the simple RNN encoders
+        self.use_attention = self.enc_type not in ['simple_lstm_noattn','simple_lstm_noattn_dynamic']
+        assert attention in ['global','local'], 'attention has to be global or local'
+        self.attention = attention
+        self.attention_window = attention_window
+        self.source_prefix_length = source_prefix_length
 
         self.embedding_size = embedding_size
         self.enc_rnn_size = enc_rnn_size
@@ -48,6 +83,9 @@ class AttentionModel():
         for lang in self.lang_list: 
             self.vocab_size[lang] = self.mapping[lang].get_vocab_size()
 
+        self.inference_mode=inference_mode
+        self.fold_ops=[]
+
         max_val = 0.1
 
         ####### Input embeddings 
@@ -55,10 +93,14 @@ class AttentionModel():
         self.embed_b = dict()
 
         # Finds bit-vector representation for each character of each language
+        # The onehot representations are identity matrices, so they are not created: the embedding matrix is 
+        # used directly instead of multiplying it with the bit-vector embeddings. This also keeps the 
+        # gradients of the embeddings sparse. The variables are the same, so saved models are compatible
         self.bitvector_embeddings={}
         self.bitvector_embedding_size={}
         for lang in self.lang_list:
-            self.bitvector_embeddings[lang] = tf.constant(self.mapping[lang].get_bitvector_embeddings(lang,self.representation[lang]),dtype=tf.float32)
+            if self.representation[lang] not in ['onehot','onehot_shared']:
+                self.bitvector_embeddings[lang] = tf.constant(self.mapping[lang].get_bitvector_embeddings(lang,self.representation[lang]),dtype=tf.float32)
             self.bitvector_embedding_size[lang]=self.mapping[lang].get_bitvector_embedding_size(self.representation[lang])
 
         # Converting the character representation to embedding_size vector
@@ -72,12 +114,16 @@ class AttentionModel():
                     self.embed_W0 = tf.Variable(tf.random_uniform([self.bitvector_embedding_size[lang],self.embedding_size], -1*max_val, max_val), name = 'embed_W0')
                     self.embed_b0 = tf.Variable(tf.constant(0., shape=[self.embedding_size]), name = 'embed_b0')
 
-                self.embed_W[lang] = tf.matmul(self.bitvector_embeddings[lang], self.embed_W0, name='embed_W_{}'.format(lang))
+                if self.representation[lang] == 'onehot_shared':
+                    self.embed_W[lang] = self.embed_W0
+                else:
+                    self.embed_W[lang] = self.project_embeddings(self.bitvector_embeddings[lang], self.embed_W0, 'embed_W_{}'.format(lang))
                 self.embed_b[lang] = self.embed_b0
             elif self.representation[lang] ==  'onehot':
-                ### TODO: maybe multiplication by identity bitvector embedding is not required
+                ### multiplication by identity bitvector embedding is not required
                 x = tf.Variable(tf.random_uniform([self.bitvector_embedding_size[lang],self.embedding_size], -1*max_val, max_val))
-                self.embed_W[lang] = tf.matmul(self.bitvector_embeddings[lang], x, name='embed_W_{}'.format(lang))
+                #self.embed_W[lang] = tf.matmul(self.bitvector_embeddings[lang], x, name='embed_W_{}'.format(lang))
+                self.embed_W[lang] = x
                 self.embed_b[lang] = tf.Variable(tf.constant(0., shape=[self.embedding_size]), name = 'embed_b_{}'.format(lang))
 
         ####### Output embeddings 
@@ -95,10 +141,9 @@ class AttentionModel():
 
             out_representation='onehot_shared'  ### output side uses onehot_shared representation
 
-            self.out_bitvector_embeddings={}
+            ## the onehot_shared bit-vector embeddings are identity matrices, and are not needed (see the input embeddings)
             self.out_bitvector_embedding_size={}
             for lang in self.lang_list:
-                self.out_bitvector_embeddings[lang] = tf.constant(self.mapping[lang].get_bitvector_embeddings(lang,out_representation),dtype=tf.float32)
                 self.out_bitvector_embedding_size[lang]=self.mapping[lang].get_bitvector_embedding_size(out_representation)
 
             # Converting the character representation to embedding_size vector
@@ -111,7 +156,7 @@ class AttentionModel():
                     self.embed_outW0 = tf.Variable(tf.random_uniform([self.out_bitvector_embedding_size[lang],self.embedding_size], -1*max_val, max_val), name = 'embed_outW0')
                     self.embed_outb0 = tf.Variable(tf.constant(0., shape=[self.embedding_size]), name = 'embed_outb0')
 
-                self.embed_outW[lang] = tf.matmul(self.out_bitvector_embeddings[lang], self.embed_outW0, name='embed_outW_{}'.format(lang))
+                self.embed_outW[lang] = self.embed_outW0
                 self.embed_outb[lang] = self.embed_outb0
 
         ##### Create Encoder
@@ -123,10 +168,21 @@ class AttentionModel():
         elif self.enc_type == 'bilstm':
             ### Bidirectional RNN encoder 
             self.input_encoder=encoders.BidirectionalRnnEncoder(embedding_size,max_sequence_length,enc_rnn_size)
+        elif self.enc_type == 'simple_lstm_noattn_dynamic':
+            ## Simple RNN Encoder, run in a loop up to the longest sequence in the batch
+            self.input_encoder=encoders.DynamicRnnEncoder(embedding_size,max_sequence_length,enc_rnn_size)
+        elif self.enc_type == 'bilstm_dynamic':
+            ### Bidirectional RNN encoder, run in a loop up to the longest sequence in the batch
+            self.input_encoder=encoders.DynamicBidirectionalRnnEncoder(embedding_size,max_sequence_length,enc_rnn_size)
         elif self.enc_type == 'cnn':
             ## CNN Encoder
             filter_sizes=[1,2,3,4]
             self.input_encoder=encoders.CNNEncoder(embedding_size,max_sequence_length,filter_sizes,enc_rnn_size*2/len(filter_sizes))
+        elif self.enc_type == 'cnn_masked':
+            ## CNN Encoder, with the PAD positions masked out of the convolutions and the final state
+            filter_sizes=[1,2,3,4]
+            self.input_encoder=encoders.CNNEncoder(embedding_size,max_sequence_length,filter_sizes,enc_rnn_size*2/len(filter_sizes),
+                                                    mask_padding=True)
 
         ## FIXME: what is the best way to initialize the input - I suppose with embedding for GO symbol
         ## the variable need not even be saved
@@ -200,6 +256,36 @@ class AttentionModel():
             -1*max_val, max_val), name = 'attn_W')
         self.attn_b = tf.Variable(tf.constant(0., shape=[1]), name = 'attn_b')
 
+        ####### Per-language parameters stacked into tables indexed by the language id
+        ## The language of a graph can then be an input (a scalar int32 Tensor with the language id) instead
+        ## of being fixed when the graph is created, and one graph serves all the language pairs (see get_lang_param).
+        ## The tables are padded to the largest vocabulary. The output bias of the padding symbols is a large
+        ## negative number, so they get zero probability
+        self.lang_ids = dict([ (lang,i) for i,lang in enumerate(self.lang_list) ])
+        self.max_vocab_size = max(self.vocab_size.values()+[ self.out_W[lang].get_shape()[1].value for lang in self.lang_list ])
+
+        def pad_table(x,axis,pad_value=0.0):
+            num_pad = self.max_vocab_size-x.get_shape()[axis].value
+            if num_pad == 0:
+                return x
+            pad_shape = x.get_shape().as_list()
+            pad_shape[axis] = num_pad
+            return tf.concat(axis,[x,tf.constant(pad_value,shape=pad_shape)])
+
+        self.embed_W_table = tf.pack([ pad_table(self.embed_W[lang],0) for lang in self.lang_list ])
+        self.embed_b_table = tf.pack([ self.embed_b[lang] for lang in self.lang_list ])
+        self.embed_outW_table = tf.pack([ pad_table(self.embed_outW[lang],0) for lang in self.lang_list ])
+        self.embed_outb_table = tf.pack([ self.embed_outb[lang] for lang in self.lang_list ])
+        ## the padded output layers of each language, also used for batches with a different target language 
+        ## for each example (see compute_logits)
+        self.out_W_padded = [ pad_table(self.out_W[lang],1) for lang in self.lang_list ]
+        self.out_b_padded = [ pad_table(self.out_b[lang],0,-1e9) for lang in self.lang_list ]
+        self.out_W_table = tf.pack(self.out_W_padded)
+        self.out_b_table = tf.pack(self.out_b_padded)
+
+        ## optimizers of the per-language variables, for graphs with the language as an input (see get_lang_optimizers)
+        self.lang_optimizers = dict()
+
         ####### Parameters related to language model ### 
 
         self.lm_model = None 
@@ -210,6 +296,175 @@ class AttentionModel():
         self.lm_model = lm_model
         self.wlm = wlm
 
+    def project_embeddings(self,bitvector_embeddings,W,name): 
+        """
+        Embedding matrix for the bit-vector embeddings. In inference mode, this is a table filled 
+        by fold_embeddings() 
+        """
+        projection = tf.matmul(bitvector_embeddings, W, name=name)
+        if not self.inference_mode: 
+            return projection
+
+        ## not added to any collection, so that it is not initialized, trained or saved with the model parameters
+        table = tf.Variable(tf.zeros(projection.get_shape()), trainable=False, collections=[], name=name+'_folded')
+        self.fold_ops.append(tf.assign(table,projection))
+        return table
+
+    def fold_embeddings(self,sess): 
+        """
+        Computes the embedding tables of the inference mode. Call after the parameters are restored
+        """
+        if len(self.fold_ops)>0: 
+            sess.run(self.fold_ops)
+
+    def save_attention_config(self,model_fname):
+        """
+        Save the attention mechanism next to the saved model 'model_fname' (the path returned by 
+        tf.train.Saver.save), so that decoding builds the same graph (see load_attention_config)
+        """
+        with open(model_fname+'.attention.json','w') as config_file:
+            json.dump({'attention':self.attention,'attention_window':self.attention_window},config_file)
+
+    def export_weights(self,sess,fname):
+        """
+        Save the parameters used for decoding to a single NumPy file (.npz), which NumpyAttentionModel
+        decodes with, without TensorFlow. Call after the parameters are restored (and fold_embeddings()
+        in inference mode): the embedding matrices are saved after the projection of the bit-vector embeddings
+
+        The architecture and the indices of the special symbols are saved in a JSON header
+        """
+        header={}
+        header['enc_type']=self.enc_type
+        header['embedding_size']=self.embedding_size
+        header['enc_rnn_size']=self.enc_rnn_size
+        header['dec_rnn_size']=self.dec_rnn_size
+        header['max_sequence_length']=self.max_sequence_length
+        header['attention']=self.attention
+        header['attention_window']=self.attention_window
+        header['source_prefix_length']=self.source_prefix_length
+        header['langs']=self.lang_list
+        header['symbols']=dict([ (lang,dict([ (symbol,self.mapping[lang].get_index(symbol))
+                                for symbol in [Mapping.Mapping.GO,Mapping.Mapping.EOW,Mapping.Mapping.PAD] ]))
+                                    for lang in self.lang_list ])
+        if isinstance(self.input_encoder,encoders.CNNEncoder):
+            header['maxpool_width']=self.input_encoder.maxpool_width
+            header['mask_padding']=self.input_encoder.mask_padding
+
+        tensors={}
+        for lang in self.lang_list:
+            tensors['embed_W_{}'.format(lang)]=self.embed_W[lang]
+            tensors['embed_b_{}'.format(lang)]=self.embed_b[lang]
+            tensors['embed_outW_{}'.format(lang)]=self.embed_outW[lang]
+            tensors['embed_outb_{}'.format(lang)]=self.embed_outb[lang]
+            tensors['out_W_{}'.format(lang)]=self.out_W[lang]
+            tensors['out_b_{}'.format(lang)]=self.out_b[lang]
+        tensors['state_adapt_W']=self.state_adapt_W
+        tensors['state_adapt_b']=self.state_adapt_b
+        tensors['attn_W']=self.attn_W
+        tensors['attn_b']=self.attn_b
+        tensors['decoder_W'], tensors['decoder_b'] = encoders.get_lstm_variables('decoder')
+        for name, tensor in self.input_encoder.get_weights().iteritems():
+            tensors['encoder_{}'.format(name)]=tensor
+
+        names=tensors.keys()
+        arrays=dict(zip(names,sess.run([ tensors[name] for name in names ])))
+        np.savez(fname,header=np.array(json.dumps(header)),**arrays)
+
+    def get_lang_param(self, params, table, lang, example_table=None):
+        """
+        Get a per-language parameter. 
+
+        params: dictionary of the parameter for each language e.g. self.out_W
+        table: the corresponding table indexed by the language id e.g. self.out_W_table
+        lang: a language code, or a scalar int32 Tensor containing the language id (see self.lang_ids), 
+              or an int32 Tensor of shape (batch_size) containing the language id of each example 
+        example_table: table returned for the language id of each example (default: 'table')
+
+        Returns params[lang] for a language code, the row of 'table' for a language id, and the entire 
+        table for the language id of each example. The parameter of each example is then selected by 
+        lookup_embeddings and compute_logits
+        """
+        if self.is_lang_per_example(lang): 
+            return table if example_table is None else example_table
+        elif isinstance(lang,tf.Tensor): 
+            return tf.gather(table,lang)
+        else: 
+            return params[lang]
+
+    def is_lang_per_example(self, lang):
+        """
+        Is 'lang' a Tensor with the language id of each example (see get_lang_param)
+        """
+        return isinstance(lang,tf.Tensor) and lang.get_shape().ndims == 1
+
+    def lookup_embeddings(self, embed_W, embed_b, lang, ids):
+        """
+        Embeddings of the symbol ids 'ids' (shape: batch_size, or batch_size x sequence length) of 
+        language 'lang'. embed_W and embed_b are the embedding parameters for 'lang' from get_lang_param 
+        """
+        if self.is_lang_per_example(lang): 
+            ## the symbol ids are offset to the rows of the language of each example in the flattened table 
+            offsets = lang*self.max_vocab_size
+            biases = tf.gather(embed_b,lang)
+            if ids.get_shape().ndims == 2: 
+                offsets = tf.expand_dims(offsets,1)
+                biases = tf.expand_dims(biases,1)
+            return tf.nn.embedding_lookup(tf.reshape(embed_W,[-1,self.embedding_size]),ids+offsets)+biases
+        else: 
+            return tf.nn.embedding_lookup(embed_W,ids)+embed_b
+
+    def compute_logits(self, output, out_W, out_b, lang): 
+        """
+        Output layer, for the decoder output 'output' (shape: batch_size x dec_rnn_size). 
+        out_W and out_b are the output layer parameters for 'lang' from get_lang_param (for the language 
+        id of each example, the lists self.out_W_padded and self.out_b_padded) 
+        """
+        if self.is_lang_per_example(lang): 
+            ## the rows are grouped by their target language, with one matmul for each language, and put back 
+            ## in their order
+            num_langs = len(self.lang_list)
+            row_groups = tf.dynamic_partition(output,lang,num_langs)
+            index_groups = tf.dynamic_partition(tf.range(0,tf.shape(output)[0]),lang,num_langs)
+            logits = [ tf.matmul(rows,out_W[k])+out_b[k] for k, rows in enumerate(row_groups) ]
+            return tf.dynamic_stitch(index_groups,logits)
+        else: 
+            return tf.matmul(output,out_W)+out_b
+
+    def get_vocab_size(self, lang):
+        """
+        Size of the output vocabulary for 'lang' (a language code or language id Tensor, see get_lang_param). 
+        It is the size of the padded vocabulary for a language id Tensor 
+        """
+        if isinstance(lang,tf.Tensor): 
+            return self.max_vocab_size
+        else: 
+            return self.vocab_size[lang]
+
+    def get_symbol_index(self, lang, symbol):
+        """
+        Index of a special symbol (GO, EOW, PAD) for 'lang' (a language code or language id Tensor, see get_lang_param). 
+        With a language id Tensor, the symbol must have the same index in all languages
+        """
+        if isinstance(lang,tf.Tensor): 
+            indices = set([ self.mapping[l].get_index(symbol) for l in self.lang_list ])
+            if len(indices) != 1: 
+                raise ValueError('Symbol {} does not have the same index in all languages'.format(symbol))
+            return indices.pop()
+        else: 
+            return self.mapping[lang].get_index(symbol)
+
+    def get_decoder_cell(self, lang):
+        """
+        Decoder cell for 'lang' (a language code or language id Tensor, see get_lang_param). 
+        A language id Tensor can only be used with a shared decoder
+        """
+        if isinstance(lang,tf.Tensor): 
+            if not self.is_shared_decoder: 
+                raise ValueError('A language id Tensor can only be used with a shared decoder')
+            return self.decoder_cell.values()[0]
+        else: 
+            return self.decoder_cell[lang]
+
     def compute_hidden_representation(self, sequences, sequence_lengths, lang, dropout_keep_prob):
         """
 
@@ -219,179 +474,242 @@ class AttentionModel():
 
         sequences: Tensor of integers of shape containing the input symbol ids (batch_size x max_sequence_length)
         sequence_lengths: Tensor of shape (batch_size) containing length of each  sequence input 
-        lang: language of the input
+        lang: language of the input (a language code, or a language id Tensor, see get_lang_param)
         dropout_keep_prob: dropout keep probability
 
         Return: 
          a tuple (states, enc_outputs)
           states: final state of the encoder, shape: (batch_size x encoder_state_size)
           enc_outputs: list of Tensors with shape (batch_size x enc_output_size). 
-            Length of list=max_sequence_length. One element in the list for each timestamp
+            Length of list=max_sequence_length. One element in the list for each timestamp. 
+            Or a Tensor of shape (batch_size x num_steps x enc_output_size) (the dynamic and CNN encoders)
 
         """
-        sequence_embeddings = tf.add(tf.nn.embedding_lookup(self.embed_W[lang],sequences),self.embed_b[lang])
+        sequence_embeddings = self.lookup_embeddings(self.get_lang_param(self.embed_W,self.embed_W_table,lang),
+                                    self.get_lang_param(self.embed_b,self.embed_b_table,lang),lang,sequences)
         states, enc_outputs = self.input_encoder.encode(sequence_embeddings,sequence_lengths,dropout_keep_prob)
         return states, enc_outputs
 
-    def compute_attention_context(self,prev_state,prev_out_embed,enc_outputs):
+    def precompute_attention_inputs(self,enc_outputs,sequence_lengths=None):
         """
-            Compute the annotation/context vector using the attention mechanism,
-            which can be used by the decoder for predicting the next symbol
+            Compute the parts of the attention network input which depend only on the encoder outputs.
+            This is done once for a source sequence, and reused at every decoder step
 
             Paramters: 
 
-            prev_state: Previous decoder state. 
-                        Shape: batch_size x decoder_state_size 
-            prev_out_embed: Embedding for the previous decoder output. 
-                            Shape: batch_size x output_embedding_size
             enc_outputs: list of Tensors with shape (batch_size x enc_output_size). 
-                Length of list=max_sequence_length. One element in the list for each timestamp
+                Length of list=max_sequence_length. One element in the list for each timestamp. 
+                Or a Tensor of shape (batch_size x num_steps x enc_output_size), where num_steps need 
+                not be known when the graph is created (dynamic encoders)
+            sequence_lengths: Tensor of shape (batch_size) containing length of each source sequence. If given, 
+                the encoder outputs are truncated to the longest sequence in the batch, and the positions after 
+                the end of each sequence (PAD) get zero attention weight. 
+
+            Returns: a tuple (ctx_vecs, enc_attn_term, attn_mask, ctx_lengths), to be passed to compute_attention_context
+              ctx_vecs: encoder outputs, shape: (batch_size x num_ctx_vec x enc_output_size)
+              enc_attn_term: contribution of the encoder outputs to the attention network output (before the 
+                             non-linearity), shape: (batch_size x num_ctx_vec)
+              attn_mask: added to the attention network output, 0 within the sequence and a large negative number 
+                         for PAD, shape: (batch_size x num_ctx_vec). None if sequence_lengths is not given
+              ctx_lengths: number of encoder outputs of each sequence (int32), shape: (batch_size)
+        """
 
+        ## reshaping and transposing enc_outputs
+        if isinstance(enc_outputs,list):
+            a3=tf.pack(enc_outputs)
+            a4=tf.transpose(a3,[1,0,2])
+            num_ctx_vec=len(enc_outputs)
+        else:
+            a4=enc_outputs
+            num_ctx_vec=tf.shape(a4)[1]
+
+        attn_mask=None
+        if sequence_lengths is not None: 
+            a4, lengths = encoders.truncate_to_longest(a4, sequence_lengths)
+            num_ctx_vec=tf.shape(a4)[1]
+            attn_mask=(1.0-tf.cast(tf.sequence_mask(lengths,num_ctx_vec),tf.float32))*-1e9
+        else: 
+            lengths=tf.fill(tf.pack([tf.shape(a4)[0]]),num_ctx_vec)
+
+        a5=tf.reshape(a4,[-1,self.ctxvec_size],name='attn__a5__enc_outputs_shaped')
+
+        ## The attention network is linear in its input [prev_state, prev_out_embed, enc_output] before the non-linearity. 
+        ## So the rows of attn_W for the encoder outputs are applied here, and the rest in compute_attention_context
+        attn_W_enc=tf.slice(self.attn_W,[self.dec_state_size+self.embedding_size,0],[self.ctxvec_size,1])
+        a7_enc=tf.matmul(a5,attn_W_enc)+self.attn_b
+        a7_enc=tf.reshape(a7_enc,tf.pack([-1,num_ctx_vec]),name='attn__a7_enc__network_output_enc')
 
-            Returns: annotation/context vector of shape (batch_size x enc_output_size)
+        return a4, a7_enc, attn_mask, lengths
+
+    def select_attention_window(self,attn_inputs,step):
         """
+            Local attention: select the encoder positions within attention_window of the center for decoder 
+            step 'step'. Transliteration alignments are nearly monotonic, and the source and target sequences 
+            both start with GO, so the center is the position 'step' of the source sequence after the prefixed 
+            tokens (source_prefix_length), or its last position after its end. 
 
-        batch_size=tf.shape(prev_state)[0]
+            Returns a tuple (ctx_vecs, enc_attn_term, attn_mask) like precompute_attention_inputs, with 
+            num_ctx_vec=2*attention_window+1. The window positions outside the sequence are masked
+        """
+        ctx_vecs, enc_attn_term, _, ctx_lengths = attn_inputs
+        batch_size=tf.shape(enc_attn_term)[0]
+        num_ctx_vec=tf.shape(enc_attn_term)[1]
 
-        ## reshaping and transposing enc_outputs
-        a3=tf.pack(enc_outputs)
-        a4=tf.transpose(a3,[1,0,2])
-        a5=tf.reshape(a4,[-1,self.ctxvec_size],name='attn__a5__enc_outputs_shaped')
+        centers=tf.maximum(tf.minimum(step+self.source_prefix_length,ctx_lengths-1),0)
+        positions=tf.expand_dims(centers,1)+tf.range(-self.attention_window,self.attention_window+1)
+        in_sequence=tf.logical_and(tf.greater_equal(positions,0),tf.less(positions,tf.expand_dims(ctx_lengths,1)))
+        attn_mask=(1.0-tf.cast(in_sequence,tf.float32))*-1e9
 
-        num_ctx_vec=self.max_sequence_length
-        #num_ctx_vec=tf.shape(a3)[0]
+        ## index of each window position in the flattened batch 
+        positions=tf.minimum(tf.maximum(positions,0),num_ctx_vec-1)
+        flat_positions=positions+tf.expand_dims(tf.range(0,batch_size)*num_ctx_vec,1)
+        ctx_vecs=tf.gather(tf.reshape(ctx_vecs,[-1,self.ctxvec_size]),flat_positions)
+        enc_attn_term=tf.gather(tf.reshape(enc_attn_term,[-1]),flat_positions)
 
-        ## getting prev_state and prev_out_embed in the correct shape
-        ## and duplicate them for cacatenating with enc_outputs
-        att_ref=tf.concat(1,[prev_state,prev_out_embed])
-        a1=tf.tile(att_ref,[1,num_ctx_vec])
-        a2=tf.reshape(a1,[-1,self.dec_state_size+self.embedding_size],name='attn__a2__state__embed_shaped')
+        return ctx_vecs, enc_attn_term, attn_mask
 
-        ## preparing the input to the attention network
-        a6=tf.concat(1,[a2,a5],name='attn__a6__network_input')
+    def compute_attention_context(self,prev_state,prev_out_embed,attn_inputs,step):
+        """
+            Compute the annotation/context vector using the attention mechanism,
+            which can be used by the decoder for predicting the next symbol
 
-        ###### Passing through attention network
-        ## The network takes input for one encoder input and the current decoder state and output embedding and gives a scalar output
-        ## for all encoder vectors, at current decoder position, for the entire batch)
+            Paramters: 
+
+            prev_state: Previous decoder state. 
+                        Shape: batch_size x decoder_state_size 
+                        For beam search: (batch_size*num_beams) x decoder_state_size, with the beams of each 
+                        input in consecutive rows
+            prev_out_embed: Embedding for the previous decoder output. 
+                            Shape: same number of rows as prev_state x output_embedding_size
+            attn_inputs: output of precompute_attention_inputs for the encoder outputs, one for each input 
+                         in the batch. It is not replicated for the beams: row r of prev_state attends over 
+                         the encoder outputs of input r/num_beams
+            step: decoder step (int32 scalar), for local attention 
 
-        a7=tf.matmul(a6,self.attn_W)+self.attn_b
-        a8=tf.nn.tanh(a7,name='attn__a7__network_output')
-        a9=tf.reshape(a8,[-1,num_ctx_vec],name='attn__a9')
+
+            Returns: annotation/context vector of shape (number of rows of prev_state x enc_output_size)
+        """
+
+        if self.attention=='local': 
+            a4, a7_enc, attn_mask = self.select_attention_window(attn_inputs,step)
+        else: 
+            a4, a7_enc, attn_mask, _ = attn_inputs
+
+        ###### Only the decoder side of the attention network is computed at each step, once for each input in the batch. 
+        ## It is the same for all encoder vectors and is added to the precomputed encoder side
+        att_ref=tf.concat(1,[prev_state,prev_out_embed])
+        attn_W_dec=tf.slice(self.attn_W,[0,0],[self.dec_state_size+self.embedding_size,1])
+        a7_dec=tf.matmul(att_ref,attn_W_dec,name='attn__a7_dec__network_output_dec')
+        ## the beams of an input share its encoder side: (batch_size x 1 x num_ctx_vec) + (batch_size x num_beams x 1)
+        batch_size=tf.shape(a7_enc)[0]
+        num_ctx_vec=tf.shape(a7_enc)[1]
+        a7=tf.expand_dims(a7_enc,1)+tf.reshape(a7_dec,tf.pack([batch_size,-1,1]))
+        a9=tf.nn.tanh(a7,name='attn__a9__network_output')
+        ## PAD positions get zero weight in the softmax
+        if attn_mask is not None: 
+            a9=a9+tf.expand_dims(attn_mask,1)
+        a9=tf.reshape(a9,tf.pack([-1,num_ctx_vec]))
 
         ## apply softmax to compute the weights for the encoder outputs
         a10=tf.nn.softmax(a9,name='attn__a10__softmax')
 
         # computing context vector
 
-        #### (a)
-        #a11=tf.unpack(a10,name='attn__a11__ctxweighting_input1')
-        #a12=tf.unpack(a4,num=batch_size,name='attn__a12__ctxweighting_input2')  ## organized as list, one for each input in batch (used later)
-        #a13=[]
-        #for i  in range(batch_size):
-        #    a13.append(tf.matmul(tf.expand_dims(a11[i],0),a12[i],name='attn__a13__{}__ctx_weighting'.format(i)))
-        #a14=tf.squeeze(tf.pack(a13),name='attn__a14__output')
-
-        ###### (b)
-        #a13=[]
-        #def loop_func(batch_no):
-        #    a11=tf.slice(a10,[batch_no,0],[1,self.max_sequence_length])
-        #    a12=tf.slice(a5,[batch_no*self.max_sequence_length,0],[self.max_sequence_length,self.ctxvec_size])
-        #    a13.append(tf.matmul(a11,a12,name='attn__a13__{}__ctx_weighting'.format(batch_no)))
-        #    return tf.add(batch_no,1)
-
-        #cond=lambda bno:tf.less(bno,batch_size)
-        #bno=tf.constant(0)
-
-        #tf.while_loop(cond,loop_func,[bno])
-        #a14=tf.squeeze(tf.pack(a13),[1],name='attn__a14__output')
-
-        ###### (c)
-        #def loop_func(batch_no,_):
-        #    a11=tf.slice(a10,[batch_no,0],[1,self.max_sequence_length])
-        #    a12=tf.slice(a5,[batch_no*self.max_sequence_length,0],[self.max_sequence_length,self.ctxvec_size])
-        #    c=tf.matmul(a11,a12,name='attn__a13__{}__ctx_weighting'.format(batch_no))
-        #    return (tf.add(batch_no,1),c)
-
-        #cond=lambda bno, _:tf.less(bno,batch_size) ## FIXME: hardcoding
-        #bno=tf.constant(0)
-        #ctxv=tf.random_uniform((1,self.ctxvec_size))
-
-        #results=tf.while_loop(cond,loop_func,[bno,ctxv])
-        #[ x[1] for x in results ]
-        #a13=[ x[1] for x in results ]
-        #print 'hello'
-        #print a13
-        #a14=tf.squeeze(tf.pack(a13),[1],name='attn__a14__output')
-
-        #### (e)  This method finally worked and it is so simple and elegant!
-        def loop_func(batch_no):
-            a11=tf.slice(a10,[batch_no,0],[1,num_ctx_vec])
-            a12=tf.slice(a5,[batch_no*num_ctx_vec,0],[num_ctx_vec,self.ctxvec_size])
-            return tf.matmul(a11,a12)
-
-        a13=tf.map_fn(loop_func,tf.range(0,batch_size),dtype=tf.float32,parallel_iterations=100)
-        a14=tf.squeeze(a13,[1])
+        ## one batched matmul for the entire batch
+        ## (batch_size x num_beams x num_ctx_vec) x (batch_size x num_ctx_vec x ctxvec_size)
+        a13=tf.batch_matmul(tf.reshape(a10,tf.pack([batch_size,-1,num_ctx_vec])),a4,name='attn__a13__ctx_weighting')
+        a14=tf.reshape(a13,[-1,self.ctxvec_size],name='attn__a14__output')
 
         return a14
 
     # Find cross entropy loss in predicting target_sequences from computed hidden representation (intial state)
-    def seq_loss(self, target_sequence, target_masks, lang, initial_state, enc_output,dropout_keep_prob):
+    # sequence_lengths: lengths of the source sequences, for masking the attention (see precompute_attention_inputs)
+    def seq_loss(self, target_sequence, target_masks, lang, initial_state, enc_output,dropout_keep_prob,sequence_lengths=None):
 
         batch_size = tf.shape(target_sequence)[0]
 
         state = tf.matmul(initial_state,self.state_adapt_W) + self.state_adapt_b 
 
-        loss = 0.0
-        cell = tf.nn.rnn_cell.DropoutWrapper(self.decoder_cell[lang],output_keep_prob=dropout_keep_prob)
+        ## encoder side of the attention network, computed once for all decoder steps
+        attn_inputs=None
+        if self.use_attention:
+            attn_inputs=self.precompute_attention_inputs(enc_output,sequence_lengths)
+
+        cell = tf.nn.rnn_cell.DropoutWrapper(self.get_decoder_cell(lang),output_keep_prob=dropout_keep_prob)
+
+        ## output embedding and output layer of the target language
+        embed_outW = self.get_lang_param(self.embed_outW,self.embed_outW_table,lang)
+        embed_outb = self.get_lang_param(self.embed_outb,self.embed_outb_table,lang)
+        out_W = self.get_lang_param(self.out_W,self.out_W_table,lang,self.out_W_padded)
+        out_b = self.get_lang_param(self.out_b,self.out_b_table,lang,self.out_b_padded)
 
         # One step generate one character for each sequence
-        for i in range(self.max_sequence_length):
-            # for first iteration, decoder_input embedding is used, otherwise, output from previous iteration is used
-            # embedding lookup replace the character index with its embedding_size vector representation, which is given to the rnn_cell
-            if(i==0):
-                #current_emb = tf.reshape(tf.tile(self.decoder_input[lang],[batch_size,1]),[-1,self.embedding_size])
-                x = tf.expand_dims(
-                        tf.nn.embedding_lookup(self.embed_outW[lang],self.mapping[lang].get_index(Mapping.Mapping.GO))+self.embed_outb[lang],
-                        0) 
-                current_emb = tf.reshape(tf.tile(x,[batch_size,1]),[-1,self.embedding_size])
-            else:
-                current_emb = tf.nn.embedding_lookup(self.embed_outW[lang],target_sequence[:,i-1])+self.embed_outb[lang] 
-            if i > 0 : tf.get_variable_scope().reuse_variables()
+        # The decoder is run in a loop up to the longest target sequence in the batch, since the later steps 
+        # only add masked cross entropy. So shorter batches run shorter loops
+        num_steps = tf.minimum(tf.cast(tf.reduce_max(tf.reduce_sum(target_masks,1)),tf.int32),tf.shape(target_sequence)[1])
+
+        ## the target sequences and masks, indexed by time step 
+        targets_by_step = tf.transpose(target_sequence)
+        masks_by_step = tf.transpose(target_masks)
+
+        def decoder_step(i, current_emb, state): 
+            """
+            Runs the decoder for position i, returns the decoder output and the new state
+            """
 
             ### compute the context vector 
             current_input=None
-            if self.enc_type=='simple_lstm_noattn':
+            if not self.use_attention:
                 current_input=current_emb
             else: 
                 ## using the attention mechanism
-                context=self.compute_attention_context(state,current_emb,enc_output)
+                context=self.compute_attention_context(state,current_emb,attn_inputs,i)
                 current_input=tf.concat(1,[current_emb,context])
 
             # Run one step of the decoder cell. Updates 'state' and store output in 'output'
             output = None
             with tf.variable_scope('decoder'):
-                if i > 0 : tf.get_variable_scope().reuse_variables()
                 output, state = cell(current_input,state)
 
-            # Generating one-hot labels for target_sequences
-            labels = tf.expand_dims(target_sequence[:,i],1)
-            indices = tf.expand_dims(tf.range(0,batch_size),1)
-            concated = tf.concat(1,[indices,labels])
-            onehot_labels = tf.sparse_to_dense(concated,tf.pack([batch_size,self.vocab_size[lang]]),1.0,0.0)
+            return output, state
+
+        ## the decoder outputs of all steps are collected, for one output projection and cross entropy for the batch
+        outputs = tf.TensorArray(tf.float32,size=num_steps,infer_shape=False)
+
+        # for first step, embedding of GO is used, otherwise, the previous target symbol (teacher forcing)
+        # The first step is done outside the loop, since it creates the decoder variables
+        go_ids = tf.fill(tf.pack([batch_size]),self.get_symbol_index(lang,Mapping.Mapping.GO))
+        current_emb = self.lookup_embeddings(embed_outW,embed_outb,lang,go_ids)
+        output, state = decoder_step(0, current_emb, state)
+        outputs = outputs.write(0, output)
 
-            # Find probabilities of character
-            logit_words = tf.matmul(output,self.out_W[lang])+self.out_b[lang]
+        tf.get_variable_scope().reuse_variables()
+
+        def loop_body(i, state, outputs): 
+            # embedding lookup replace the character index with its embedding_size vector representation, which is given to the rnn_cell
+            current_emb = self.lookup_embeddings(embed_outW,embed_outb,lang,tf.gather(targets_by_step,i-1))
+            output, state = decoder_step(i, current_emb, state)
 
-            # Predicted char_ids
-            output_id = tf.argmax(logit_words,1)
+            return (i+1, state, outputs.write(i, output))
 
-            # Finding cross entropy
-            cross_entropy = tf.nn.softmax_cross_entropy_with_logits(logit_words, onehot_labels)
-            # Takaing cross entropy for only non-padding characters
-            cross_entropy = cross_entropy * target_masks[:,i]
+        _, _, outputs = tf.while_loop(lambda i, state, outputs: tf.less(i,num_steps), loop_body, 
+                                    [tf.constant(1), state, outputs])
 
-            # Add cross entropy to the loss
-            loss = loss + tf.reduce_sum(cross_entropy)
+        ## Output projection for all the steps: (num_steps*batch_size x dec_rnn_size) x (dec_rnn_size x vocab_size)
+        ## The rows are ordered by step, like the targets and masks
+        outputs = tf.reshape(outputs.pack(),[-1,self.dec_rnn_size])
+        labels = tf.reshape(tf.slice(targets_by_step,[0,0],tf.pack([num_steps,-1])),[-1])
+        masks = tf.reshape(tf.slice(masks_by_step,[0,0],tf.pack([num_steps,-1])),[-1])
+
+        logit_lang = lang
+        if self.is_lang_per_example(lang): 
+            logit_lang = tf.tile(lang,tf.pack([num_steps]))
+        logit_words = self.compute_logits(outputs,out_W,out_b,logit_lang)
+
+        # Finding cross entropy, with the labels as symbol ids 
+        cross_entropy = tf.nn.sparse_softmax_cross_entropy_with_logits(logit_words, labels)
+        # Takaing cross entropy for only non-padding characters
+        loss = tf.reduce_sum(cross_entropy * masks)
 
         loss = loss / tf.reduce_sum(target_masks[:,1:])
 
@@ -406,43 +724,198 @@ class AttentionModel():
                     lang2,target_sequences,target_sequence_masks,target_sequence_lengths,
                     dropout_keep_prob):
         hidden_representation, enc_output = self.compute_hidden_representation(sequences,sequence_lengths,lang1,dropout_keep_prob)
-        loss = self.seq_loss(target_sequences,target_sequence_masks,lang2,hidden_representation,enc_output,dropout_keep_prob)
+        loss = self.seq_loss(target_sequences,target_sequence_masks,lang2,hidden_representation,enc_output,dropout_keep_prob,
+                                sequence_lengths)
         return loss
 
     # Get a monolingual optimizer for 'lang' language
     # sequences, sequence masks: tensors of shape: [batch_size, max_sequence lengths]
     # sequence_lengths: tensor of shape: [batch_sizes]
+    # If an optimizer object is passed, it is used instead of creating a new Adam optimizer. 
+    # This allows sharing of optimizer slots between different graphs for the same language pair (e.g. for buckets)
+    # lang1 and lang2 can be language id Tensors (see get_lang_param), then one graph and optimizer serve all language pairs. 
+    # The variables of each language are then updated only for the batches with that language (see get_lang_optimizers)
+    # With the language ids of each example, one batch can have examples of different language pairs 
     def get_parallel_optimizer(self,learning_rate,
                     lang1,sequences,sequence_masks,sequence_lengths,
                     lang2,target_sequences,target_sequence_masks,target_sequence_lengths,
-                    dropout_keep_prob):
+                    dropout_keep_prob,optimizer=None):
         hidden_representation, enc_output = self.compute_hidden_representation(sequences,sequence_lengths,lang1,dropout_keep_prob)
-        loss = self.seq_loss(target_sequences,target_sequence_masks,lang2,hidden_representation,enc_output,dropout_keep_prob)
-        optimizer = tf.train.AdamOptimizer(learning_rate).minimize(loss)
-        return [ optimizer, loss ]
+        loss = self.seq_loss(target_sequences,target_sequence_masks,lang2,hidden_representation,enc_output,dropout_keep_prob,
+                                sequence_lengths)
+        if optimizer is None: 
+            optimizer = tf.train.AdamOptimizer(learning_rate)
+        var_optimizers = None
+        if isinstance(lang1,tf.Tensor): 
+            var_optimizers = self.get_lang_optimizers(learning_rate,lang1,lang2,optimizer)
+        return [ utilities.minimize(optimizer,loss,var_optimizers), loss ]
+
+    def get_lang_optimizers(self, learning_rate, lang1, lang2, optimizer): 
+        """
+        Optimizers for the variables of each language, for a graph where lang1 and lang2 are language id 
+        Tensors (see get_lang_param). 
 
-    def transliterate_beam(self, source_lang, sequences, sequence_lengths, target_lang, beam_size, topn):
+        The tables of get_lang_param contain the variables of every language, so every language gets a 
+        (zero) gradient at every step. Applying it with one Adam optimizer would keep updating the languages 
+        which are not in the batch with their old moments. Instead, the variables used by only one language 
+        are updated by an Adam optimizer of their own, and only when that language is in the batch on the 
+        side where the variables are used: the input embeddings for lang1, the output embeddings and output 
+        layer for lang2. The variables shared by languages are updated by 'optimizer'. 
+
+        The optimizers are created once for each 'optimizer', and are shared by the graphs using it (e.g. the 
+        graphs for the buckets). 
+
+        Returns a list of (variables, condition, var_optimizer) for utilities.minimize
+        """
+        var_sides = dict()
+        for side, params_list in [ ('src',[self.embed_W,self.embed_b]),
+                                   ('tgt',[self.embed_outW,self.embed_outb,self.out_W,self.out_b]) ]: 
+            for params in params_list: 
+                for lang, var in params.iteritems(): 
+                    if isinstance(var,tf.Variable): 
+                        var_sides.setdefault(var,set()).add((lang,side))
+
+        lang_vars = dict()
+        for var, lang_sides in var_sides.iteritems(): 
+            langs = set([ lang for lang, _ in lang_sides ])
+            if len(langs) == 1: 
+                lang = langs.pop()
+                sides = tuple(sorted([ side for _, side in lang_sides ]))
+                lang_vars.setdefault((lang,sides),[]).append(var)
+
+        var_optimizers = []
+        for (lang,sides), variables in sorted(lang_vars.iteritems()): 
+            key = (optimizer,lang,sides)
+            if key not in self.lang_optimizers: 
+                self.lang_optimizers[key] = tf.train.AdamOptimizer(learning_rate)
+
+            side_langs = {'src': lang1, 'tgt': lang2}
+            in_batch = [ tf.reduce_any(tf.equal(tf.reshape(side_langs[side],[-1]),self.lang_ids[lang])) for side in sides ]
+            condition = in_batch[0] if len(in_batch) == 1 else tf.logical_or(in_batch[0],in_batch[1])
+            var_optimizers.append((variables,condition,self.lang_optimizers[key]))
+
+        return var_optimizers
+
+    def init_finished_pool(self, batch_size, topn, target_lang):
+        """
+            Create the empty pool of finished candidates for beam search. 
+
+            Returns a tuple (pool_outputs, pool_scores) 
+              pool_outputs: symbol ids of the finished candidates, shape: (batch_size x topn x max_sequence_length) 
+              pool_scores: length normalized scores of the finished candidates, shape: (batch_size x topn). 
+                           Empty places in the pool have score -inf
+        """
+        pad_id = self.get_symbol_index(target_lang,Mapping.Mapping.PAD)
+        pool_outputs = tf.fill(tf.pack([batch_size,topn,self.max_sequence_length]),pad_id)
+        pool_scores = tf.fill(tf.pack([batch_size,topn]),-np.inf)
+        return pool_outputs, pool_scores
+
+    def update_beam_search(self, i, scores, prev_outputs, pool_outputs, pool_scores, 
+                            batch_size, cur_beam_size, beam_size, topn, target_lang): 
+        """
+            One step of beam search, after the scores of all extensions of the candidates in the beam are computed. 
+
+            The extensions ending with EOW (and all extensions at the last position) are finished, and 
+            replace the worse candidates in the pool of finished candidates. The best 'beam_size' 
+            extensions not ending with EOW form the beam for the next step. 
+
+            Parameters: 
+
+            i: position of the symbols generated in this step (scalar Tensor)
+            scores: log-likelihood of all extensions of the candidates in the beam. 
+                    Shape: (batch_size*cur_beam_size x vocab_size)
+            prev_outputs: symbol ids of the candidates in the beam. 
+                    Shape: (batch_size*cur_beam_size x max_sequence_length)
+            pool_outputs, pool_scores: pool of finished candidates (see init_finished_pool) 
+
+            Returns: a tuple (best_flat_indices, symbols, scores, outputs, pool_outputs, pool_scores) 
+              best_flat_indices: index of the extended candidate in 'prev_outputs' for each candidate of the new 
+                                 beam, to be used for gathering the decoder states. Shape: (batch_size*beam_size)
+              symbols: the last symbol of the candidates in the new beam, shape: (batch_size*beam_size x 1)
+              scores: log-likelihood of the candidates in the new beam, shape: (batch_size*beam_size x 1)
+              outputs: symbol ids of the candidates in the new beam, shape: (batch_size*beam_size x max_sequence_length)
+              pool_outputs, pool_scores: the updated pool of finished candidates
+        """
+        vocab_size = self.get_vocab_size(target_lang)
+        eow_id = self.get_symbol_index(target_lang,Mapping.Mapping.EOW)
+
+        ## the EOW extensions are finished, and are not extended further
+        eow_mask = np.zeros(vocab_size,dtype=np.float32)
+        eow_mask[eow_id] = 1.0
+        is_last = tf.cast(tf.equal(i,self.max_sequence_length-1),tf.float32)
+        finish_mask = tf.maximum(tf.constant(eow_mask),is_last)
+        live_mask = tf.constant(1.0-eow_mask)
+
+        ## masked extensions get score -inf
+        finish_scores_by_instance = tf.reshape(scores+tf.log(finish_mask),[-1,cur_beam_size*vocab_size])
+        live_scores_by_instance = tf.reshape(scores+tf.log(live_mask),[-1,cur_beam_size*vocab_size])
+
+        ## the output symbol at position i is set for the extensions
+        position = tf.expand_dims(tf.one_hot(i,self.max_sequence_length,dtype=tf.int32),0)
+        def extend(indices):
+            symbols = indices % vocab_size 
+            prev_beams = indices // vocab_size 
+            flat_indices = tf.reshape(tf.reshape(tf.range(0,batch_size),[-1,1])*cur_beam_size + prev_beams,[-1])
+            symbols = tf.reshape(symbols,[-1,1])
+            outputs = tf.gather(prev_outputs,flat_indices)*(1-position) + symbols*position
+            return flat_indices, symbols, outputs
+
+        #### update the pool of finished candidates, the scores are normalized by the length (including EOW)
+        finish_scores, finish_indices = tf.nn.top_k(finish_scores_by_instance, topn)
+        finish_scores = finish_scores/tf.cast(i+1,tf.float32)
+        _, _, finish_outputs = extend(finish_indices)
+
+        cand_scores = tf.concat(1,[pool_scores,finish_scores])
+        cand_outputs = tf.reshape(tf.concat(1,[pool_outputs,tf.reshape(finish_outputs,[-1,topn,self.max_sequence_length])]),
+                                    [-1,self.max_sequence_length])
+        pool_scores, pool_indices = tf.nn.top_k(cand_scores, topn)
+        pool_flat_indices = tf.reshape(tf.reshape(tf.range(0,batch_size),[-1,1])*(2*topn) + pool_indices,[-1])
+        pool_outputs = tf.reshape(tf.gather(cand_outputs,pool_flat_indices),[-1,topn,self.max_sequence_length])
+
+        #### compute best-k candidates now 
+        best_scores, best_indices = tf.nn.top_k(live_scores_by_instance, beam_size)
+        best_flat_indices, best_symbols, best_outputs = extend(best_indices)
+
+        return best_flat_indices, best_symbols, tf.reshape(best_scores,[-1,1]), best_outputs, pool_outputs, pool_scores
+
+    def is_beam_search_done(self, scores, pool_scores, beam_size):
+        """
+            Check if beam search can be stopped i.e. for every input in the batch, the pool of finished 
+            candidates is full and none of its candidates can be beaten by a candidate in the beam. 
+
+            The log-likelihood of a candidate can only decrease as it is extended, and it is normalized by 
+            at most max_sequence_length. So a candidate in the beam with log-likelihood s cannot finish 
+            with a score better than s/max_sequence_length. 
+        """
+        best_live_scores = tf.reduce_max(tf.reshape(scores,[-1,beam_size]),1)/float(self.max_sequence_length)
+        return tf.reduce_all(tf.greater_equal(tf.reduce_min(pool_scores,1),best_live_scores))
+
+    def transliterate_beam(self, source_lang, sequences, sequence_lengths, target_lang, beam_size, topn, early_stop=True):
         """
             Decode using the trained seq2seq model with beam search and return the topn results and scores
 
-            Note: The implementation generates a sequence of length max_sequence_length always. 
-            It might be better to stop the sequence generation after EOW is generated.
+            Candidates ending with EOW are moved to a pool of finished candidates. The search stops at 
+            max_sequence_length or, with early_stop, as soon as no candidate still in the beam can beat the 
+            topn finished candidates of any input (see is_beam_search_done). The results are the same as 
+            those of the search up to max_sequence_length.
 
             Parameters: 
 
-            source_lang: input language
+            source_lang: input language (a language code, or a language id Tensor, see get_lang_param)
             sequences: Tensor of integers of shape containing the input symbol ids 
                         Shape: (batch_size x max_sequence_length)
             sequence_lengths: Tensor of shape (batch_size) containing length of each  sequence input 
-            target_lang: target language
+            target_lang: target language (a language code, or a language id Tensor, see get_lang_param)
             beam_size: size of beam used for beam search while decoding
             topn: get the 'topn' best outputs 
+            early_stop: stop the search as soon as the topn finished candidates cannot be beaten (see is_beam_search_done)
 
             Outputs: 
 
-            final_outputs: Tensor containing symbol ids of shape (batch_size x topn x max_sequence_length)
+            final_outputs: Tensor containing symbol ids of shape (batch_size x topn x max_sequence_length). 
+                           The positions after EOW contain PAD 
             final_scores : Tensor containing log-likelihood scores for each candidate of shape (batch_size x topn).  
-                           The scores are length normalized
+                           The scores are normalized by the length of the candidate (including EOW)
             
         """
 
@@ -450,111 +923,117 @@ class AttentionModel():
         initial_state, enc_output = self.compute_hidden_representation(sequences,sequence_lengths, source_lang,tf.constant(1.0))
         initial_state = tf.matmul(initial_state,self.state_adapt_W) + self.state_adapt_b 
 
+        ## encoder side of the attention network, computed once for all decoder steps
+        attn_inputs=None
+        if self.use_attention:
+            attn_inputs=self.precompute_attention_inputs(enc_output,sequence_lengths)
+
         ### start decoding 
 
         batch_size = tf.shape(sequences)[0]
-        cur_beam_size=1
+        go_id = self.get_symbol_index(target_lang,Mapping.Mapping.GO)
+        pad_id = self.get_symbol_index(target_lang,Mapping.Mapping.PAD)
+
+        cell = tf.nn.rnn_cell.DropoutWrapper(self.get_decoder_cell(target_lang),output_keep_prob=tf.constant(1.0))
+
+        ## output embedding and output layer of the target language
+        embed_outW = self.get_lang_param(self.embed_outW,self.embed_outW_table,target_lang)
+        embed_outb = self.get_lang_param(self.embed_outb,self.embed_outb_table,target_lang)
+        out_W = self.get_lang_param(self.out_W,self.out_W_table,target_lang)
+        out_b = self.get_lang_param(self.out_b,self.out_b_table,target_lang)
+
+        ### the first step generates from the GO symbol, with a single beam for each input. 
+        ### It is done outside the loop, since it creates the decoder variables
+        prev_states = initial_state
+        prev_scores = tf.zeros(tf.pack([batch_size,1]))
+        prev_outputs = tf.fill(tf.pack([batch_size,self.max_sequence_length]),pad_id)
+        pool_outputs, pool_scores = self.init_finished_pool(batch_size, topn, target_lang)
+
+        x = tf.expand_dims(
+                tf.nn.embedding_lookup(embed_outW,go_id)+embed_outb,
+                0)
+        current_emb = tf.reshape(tf.tile(x,[batch_size,1]),[-1,self.embedding_size])
+
+        ### compute the context vector 
+        current_input=None
+        if not self.use_attention:
+            current_input=current_emb
+        else: 
+            ## using the attention mechanism
+            context=self.compute_attention_context(prev_states,current_emb,attn_inputs,0)
+            current_input=tf.concat(1,[current_emb,context])
 
-        prev_states = tf.reshape(tf.tile(initial_state, [1,cur_beam_size]), [-1,self.dec_state_size]) 
-        prev_scores = tf.tile(tf.constant(0.0,shape=[1,1]),[batch_size*cur_beam_size,1])
-        prev_symbols = None
+        with tf.variable_scope('decoder'):
+            output, state = cell(current_input,prev_states)
 
-        cell = tf.nn.rnn_cell.DropoutWrapper(self.decoder_cell[target_lang],output_keep_prob=tf.constant(1.0))
+        logit_words = tf.add(tf.matmul(output,out_W),out_b)
 
-        prev_best_outputs=None
+        prev_scores = prev_scores + tf.nn.log_softmax(logit_words)
 
-        final_outputs=None
-        final_scores=None
+        best_flat_indices, prev_symbols, prev_scores, prev_outputs, pool_outputs, pool_scores = \
+                self.update_beam_search(tf.constant(0), prev_scores, prev_outputs, pool_outputs, pool_scores,
+                                        batch_size, 1, beam_size, topn, target_lang)
+        prev_states = tf.gather(state, best_flat_indices)
 
-        for i in range(self.max_sequence_length):
-            if(i==0):
-                #current_emb = tf.reshape(tf.tile(self.decoder_input[target_lang],[batch_size,1]),[-1,self.embedding_size])
-                x = tf.expand_dims(
-                        tf.nn.embedding_lookup(self.embed_outW[target_lang],self.mapping[target_lang].get_index(Mapping.Mapping.GO))+self.embed_outb[target_lang],
-                        0)
-                current_emb = tf.reshape(tf.tile(x,[batch_size,1]),[-1,self.embedding_size])
-            else:
-                current_emb = tf.nn.embedding_lookup(self.embed_outW[target_lang],tf.reshape(prev_symbols,[-1]))+self.embed_outb[target_lang]
+        ##### the beam size is updated after the first iteration. The attention inputs are shared by 
+        ##### the beams of an input (see compute_attention_context)
 
-            if i > 0 : tf.get_variable_scope().reuse_variables()
+        tf.get_variable_scope().reuse_variables()
+
+        ### the remaining steps, until the last position or, with early_stop, until every input in the batch has 
+        ### topn finished candidates which the candidates still in the beam cannot beat (see is_beam_search_done)
+        def loop_cond(i, prev_symbols, prev_states, prev_scores, prev_outputs, pool_outputs, pool_scores):
+            if not early_stop:
+                return tf.less(i,self.max_sequence_length)
+            return tf.logical_and(tf.less(i,self.max_sequence_length), 
+                    tf.logical_not(self.is_beam_search_done(prev_scores, pool_scores, beam_size)))
+
+        def loop_body(i, prev_symbols, prev_states, prev_scores, prev_outputs, pool_outputs, pool_scores):
+            current_emb = tf.nn.embedding_lookup(embed_outW,tf.reshape(prev_symbols,[-1]))+embed_outb
 
             ### compute the context vector 
             current_input=None
-            if self.enc_type=='simple_lstm_noattn':
+            if not self.use_attention:
                 current_input=current_emb
             else: 
                 ## using the attention mechanism
-                context=self.compute_attention_context(prev_states,current_emb,enc_output)
+                context=self.compute_attention_context(prev_states,current_emb,attn_inputs,i)
                 current_input=tf.concat(1,[current_emb,context])
 
             # Run one step of the decoder cell. Updates 'state' and store output in 'output'
-            output = None
-            state = None
             with tf.variable_scope('decoder'):
-                if i > 0 : tf.get_variable_scope().reuse_variables()
+                tf.get_variable_scope().reuse_variables()
                 output, state = cell(current_input,prev_states)
 
-            logit_words = tf.add(tf.matmul(output,self.out_W[target_lang]),self.out_b[target_lang])
+            logit_words = tf.add(tf.matmul(output,out_W),out_b)
 
-            ### check dimentionality and orientation 
             prev_scores = prev_scores + tf.nn.log_softmax(logit_words)
 
-            prev_scores_by_instance = tf.reshape(prev_scores,[-1,cur_beam_size*self.vocab_size[target_lang]])
+            best_flat_indices, prev_symbols, prev_scores, prev_outputs, pool_outputs, pool_scores = \
+                    self.update_beam_search(i, prev_scores, prev_outputs, pool_outputs, pool_scores,
+                                            batch_size, beam_size, beam_size, topn, target_lang)
+            prev_states = tf.gather(state, best_flat_indices)
 
-            best_scores, best_indices = tf.nn.top_k(prev_scores_by_instance, beam_size)
+            return (i+1, prev_symbols, prev_states, prev_scores, prev_outputs, pool_outputs, pool_scores)
 
-            best_symbols = best_indices % self.vocab_size[target_lang] 
-            best_prev_beams = best_indices // self.vocab_size[target_lang] 
+        loop_vars = [tf.constant(1), prev_symbols, prev_states, prev_scores, prev_outputs, pool_outputs, pool_scores]
+        shape_invariants = [tf.TensorShape([]), tf.TensorShape([None,1]), tf.TensorShape([None,self.dec_state_size]), 
+                            tf.TensorShape([None,1]), tf.TensorShape([None,self.max_sequence_length]), 
+                            tf.TensorShape([None,None,self.max_sequence_length]), tf.TensorShape([None,None])]
 
-            best_flat_indices = tf.tile(tf.reshape(tf.range(0,batch_size),[-1,1]),[1,cur_beam_size])*cur_beam_size + best_prev_beams
+        results = tf.while_loop(loop_cond, loop_body, loop_vars, shape_invariants=shape_invariants, back_prop=False)
+        final_outputs, final_scores = results[-2], results[-1]
 
-            ### update variables for the next iteration 
-            prev_scores = tf.reshape(best_scores, [-1,1])
-            prev_symbols = tf.reshape(best_symbols, [-1,1])
-           
-            prev_states=  tf.gather( state, tf.reshape(best_flat_indices,[-1]) )
+        return (final_outputs, final_scores)
 
-            #### compute best-k candidates now 
-            prev_best_outputs_for_final=prev_best_outputs
-            if(i==0): 
-                prev_best_outputs=prev_symbols
-            else: 
-                top_beam_prev_outputs = tf.gather( prev_best_outputs, tf.reshape(best_flat_indices,[-1]) )
-                prev_best_outputs = tf.concat(1,[top_beam_prev_outputs,prev_symbols])
-
-            ##### update beam size after first iteration 
-            if i==0:
-                cur_beam_size=beam_size
-                enc_output=tf.unpack(
-                        tf.reshape(   tf.tile(tf.pack(  enc_output   ),[1,1,beam_size]),
-                                    [self.max_sequence_length,-1,self.input_encoder.get_output_size()]
-                                  )
-                        )
-
-            #### get top-n outputs for the last iteration                 
-            if i==self.max_sequence_length-1: 
-                final_scores, final_indices = tf.nn.top_k(prev_scores_by_instance, topn)
-
-                final_symbols    = final_indices %  self.vocab_size[target_lang] 
-                final_prev_beams = final_indices // self.vocab_size[target_lang] 
-
-                final_flat_indices = tf.tile(tf.reshape(tf.range(0,batch_size),[-1,1]),[1,topn])*beam_size + final_prev_beams
-
-                ### update variables for the next iteration 
-                final_flat_symbols = tf.reshape(final_symbols, [-1,1])
-           
-                #### compute best-n candidates now 
-                top_n_prev_outputs = tf.gather( prev_best_outputs_for_final, tf.reshape(final_flat_indices,[-1]) )
-                final_outputs = tf.concat(1,[top_n_prev_outputs,final_flat_symbols])
-
-        return (tf.reshape(final_outputs,[-1,topn,self.max_sequence_length]),final_scores/self.max_sequence_length)
-
-    def transliterate_beam_with_lm(self, source_lang, sequences, sequence_lengths, target_lang, beam_size, topn):
+    def transliterate_beam_with_lm(self, source_lang, sequences, sequence_lengths, target_lang, beam_size, topn, early_stop=True):
         """
             Decode using the trained seq2seq model with beam search and return the topn results and scores
 
-            Note: The implementation generates a sequence of length max_sequence_length always. 
-            It might be better to stop the sequence generation after EOW is generated.
+            Candidates ending with EOW are moved to a pool of finished candidates. The search stops at 
+            max_sequence_length or, with early_stop, as soon as no candidate still in the beam can beat the 
+            topn finished candidates of any input (see is_beam_search_done). The results are the same as 
+            those of the search up to max_sequence_length.
 
             Parameters: 
 
@@ -565,149 +1044,138 @@ class AttentionModel():
             target_lang: target language
             beam_size: size of beam used for beam search while decoding
             topn: get the 'topn' best outputs 
+            early_stop: stop the search as soon as the topn finished candidates cannot be beaten (see is_beam_search_done)
 
             Outputs: 
 
-            final_outputs: Tensor containing symbol ids of shape (batch_size x topn x max_sequence_length)
+            final_outputs: Tensor containing symbol ids of shape (batch_size x topn x max_sequence_length). 
+                           The positions after EOW contain PAD 
             final_scores : Tensor containing log-likelihood scores for each candidate of shape (batch_size x topn).  
-                           The scores are length normalized
+                           The scores are normalized by the length of the candidate (including EOW)
             
         """
 
         ## NEW: assert that the lm paramters have been set 
         assert(self.lm_model is not None)
-        start_char=self.mapping[target_lang].get_index(Mapping.Mapping.GO)
 
         #### compute hidden representation first     
         initial_state, enc_output = self.compute_hidden_representation(
                             sequences,sequence_lengths, source_lang,tf.constant(1.0))
         initial_state = tf.matmul(initial_state,self.state_adapt_W) + self.state_adapt_b 
 
+        ## encoder side of the attention network, computed once for all decoder steps
+        attn_inputs=None
+        if self.use_attention:
+            attn_inputs=self.precompute_attention_inputs(enc_output,sequence_lengths)
+
         ### start decoding 
 
         batch_size = tf.shape(sequences)[0]
-        cur_beam_size=1
+        go_id = self.mapping[target_lang].get_index(Mapping.Mapping.GO)
+        pad_id = self.mapping[target_lang].get_index(Mapping.Mapping.PAD)
 
-        prev_states = tf.reshape(tf.tile(initial_state, [1,cur_beam_size]), [-1,self.dec_state_size])
-        prev_scores = tf.tile(tf.constant(0.0,shape=[1,1]),[batch_size*cur_beam_size,1])
-        prev_symbols = None
+        cell = tf.nn.rnn_cell.DropoutWrapper(self.decoder_cell[target_lang],output_keep_prob=tf.constant(1.0))
 
+        ### the first step generates from the GO symbol, with a single beam for each input. 
+        ### It is done outside the loop, since it creates the decoder variables
+        prev_states = initial_state
+        prev_scores = tf.zeros(tf.pack([batch_size,1]))
+        prev_outputs = tf.fill(tf.pack([batch_size,self.max_sequence_length]),pad_id)
+        pool_outputs, pool_scores = self.init_finished_pool(batch_size, topn, target_lang)
         ## NEW
-        prev_lm_states = tf.reshape( tf.tile( self.lm_model.initial_state(batch_size), [1,cur_beam_size]), 
-                                     [-1,self.lm_model.state_size()]
-                                   ) 
+        prev_lm_states = self.lm_model.initial_state(batch_size)
 
-        cell = tf.nn.rnn_cell.DropoutWrapper(self.decoder_cell[target_lang],output_keep_prob=tf.constant(1.0))
+        x = tf.expand_dims(
+                tf.nn.embedding_lookup(self.embed_outW[target_lang],go_id)+self.embed_outb[target_lang],
+                0)
+        current_emb = tf.reshape(tf.tile(x,[batch_size,1]),[-1,self.embedding_size])
+
+        ### compute the context vector 
+        current_input=None
+        if not self.use_attention:
+            current_input=current_emb
+        else: 
+            ## using the attention mechanism
+            context=self.compute_attention_context(prev_states,current_emb,attn_inputs,0)
+            current_input=tf.concat(1,[current_emb,context])
+
+        with tf.variable_scope('decoder'):
+            output, state = cell(current_input,prev_states)
 
-        prev_best_outputs=None
+        logit_words = tf.add(tf.matmul(output,self.out_W[target_lang]),self.out_b[target_lang])
+
+        ## NEW: get lm scores
+        lm_input = tf.reshape(tf.tile(tf.constant(go_id,dtype=tf.int32,shape=(1,1)),[batch_size,1]),[-1,1])
+        with tf.variable_scope('lang_model'):
+            lm_logit_words, lm_state = self.lm_model.logit_next_char(lm_input, prev_lm_states)
+
+        prev_scores = prev_scores + tf.nn.log_softmax(  (1.0-self.wlm)*logit_words + self.wlm*lm_logit_words )
+
+        best_flat_indices, prev_symbols, prev_scores, prev_outputs, pool_outputs, pool_scores = \
+                self.update_beam_search(tf.constant(0), prev_scores, prev_outputs, pool_outputs, pool_scores,
+                                        batch_size, 1, beam_size, topn, target_lang)
+        prev_states = tf.gather(state, best_flat_indices)
+        ## NEW
+        prev_lm_states = tf.gather(lm_state, best_flat_indices)
 
-        final_outputs=None
-        final_scores=None
+        ##### the beam size is updated after the first iteration. The attention inputs are shared by 
+        ##### the beams of an input (see compute_attention_context)
 
-        for i in range(self.max_sequence_length):
+        tf.get_variable_scope().reuse_variables()
 
-            if(i==0):
-                x = tf.expand_dims(
-                            tf.nn.embedding_lookup(self.embed_outW[target_lang], start_char) + \
-                            self.embed_outb[target_lang], \
-                        0)
-                current_emb = tf.reshape(tf.tile(x,[batch_size,1]),[-1,self.embedding_size])
-            else:
-                current_emb = tf.nn.embedding_lookup(self.embed_outW[target_lang],tf.reshape(prev_symbols,[-1])) + \
-                            self.embed_outb[target_lang]
+        ### the remaining steps, until the last position or, with early_stop, until every input in the batch has 
+        ### topn finished candidates which the candidates still in the beam cannot beat (see is_beam_search_done)
+        def loop_cond(i, prev_symbols, prev_states, prev_lm_states, prev_scores, prev_outputs, pool_outputs, pool_scores):
+            if not early_stop:
+                return tf.less(i,self.max_sequence_length)
+            return tf.logical_and(tf.less(i,self.max_sequence_length), 
+                    tf.logical_not(self.is_beam_search_done(prev_scores, pool_scores, beam_size)))
 
-            if i > 0 : tf.get_variable_scope().reuse_variables()
+        def loop_body(i, prev_symbols, prev_states, prev_lm_states, prev_scores, prev_outputs, pool_outputs, pool_scores):
+            current_emb = tf.nn.embedding_lookup(self.embed_outW[target_lang],tf.reshape(prev_symbols,[-1]))+self.embed_outb[target_lang]
 
             ### compute the context vector 
             current_input=None
-            if self.enc_type=='simple_lstm_noattn':
+            if not self.use_attention:
                 current_input=current_emb
             else: 
                 ## using the attention mechanism
-                context=self.compute_attention_context(prev_states,current_emb,enc_output)
+                context=self.compute_attention_context(prev_states,current_emb,attn_inputs,i)
                 current_input=tf.concat(1,[current_emb,context])
 
             # Run one step of the decoder cell. Updates 'state' and store output in 'output'
-            output = None
-            state = None
             with tf.variable_scope('decoder'):
-                if i > 0 : tf.get_variable_scope().reuse_variables()
+                tf.get_variable_scope().reuse_variables()
                 output, state = cell(current_input,prev_states)
 
             logit_words = tf.add(tf.matmul(output,self.out_W[target_lang]),self.out_b[target_lang])
-            
-            ## NEW: get lm scores
-            lm_input = None
-            if i==0: 
-                #lm_input = tf.reshape(tf.tile(start_char,[batch_size,1]),[-1,1])
-                #lm_input = tf.constant(start_char,dtype=tf.int32,shape=(batch_size,1))
-                lm_input = tf.reshape(tf.tile(tf.constant(start_char,dtype=tf.int32,shape=(1,1)),[batch_size,1]),[-1,1])
-            else:  
-                lm_input = prev_symbols
-
-            lm_logit_words = None
-            lm_state = None 
 
+            ## NEW: get lm scores
             with tf.variable_scope('lang_model'):
-                if i > 0 : tf.get_variable_scope().reuse_variables()
-                lm_logit_words, lm_state = self.lm_model.logit_next_char(lm_input, prev_lm_states)
+                tf.get_variable_scope().reuse_variables()
+                lm_logit_words, lm_state = self.lm_model.logit_next_char(prev_symbols, prev_lm_states)
 
-            ### check dimentionality and orientation 
             prev_scores = prev_scores + tf.nn.log_softmax(  (1.0-self.wlm)*logit_words + self.wlm*lm_logit_words )
-            #av_scores=(1.0-self.wlm)*tf.nn.softmax(logit_words) + self.wlm*tf.nn.softmax(lm_logit_words) 
-            #prev_scores = prev_scores + tf.log(av_scores)
 
-            prev_scores_by_instance = tf.reshape(prev_scores,[-1,cur_beam_size*self.vocab_size[target_lang]])
-
-            best_scores, best_indices = tf.nn.top_k(prev_scores_by_instance, beam_size)
+            best_flat_indices, prev_symbols, prev_scores, prev_outputs, pool_outputs, pool_scores = \
+                    self.update_beam_search(i, prev_scores, prev_outputs, pool_outputs, pool_scores,
+                                            batch_size, beam_size, beam_size, topn, target_lang)
+            prev_states = tf.gather(state, best_flat_indices)
+            ## NEW
+            prev_lm_states = tf.gather(lm_state, best_flat_indices)
 
-            best_symbols = best_indices % self.vocab_size[target_lang] 
-            best_prev_beams = best_indices // self.vocab_size[target_lang] 
+            return (i+1, prev_symbols, prev_states, prev_lm_states, prev_scores, prev_outputs, pool_outputs, pool_scores)
 
-            best_flat_indices = tf.tile(tf.reshape(tf.range(0,batch_size),[-1,1]),[1,cur_beam_size])*cur_beam_size + best_prev_beams
+        loop_vars = [tf.constant(1), prev_symbols, prev_states, prev_lm_states, prev_scores, prev_outputs, pool_outputs, pool_scores]
+        shape_invariants = [tf.TensorShape([]), tf.TensorShape([None,1]), tf.TensorShape([None,self.dec_state_size]), tf.TensorShape([None,self.lm_model.state_size()]),
+                           
+                            tf.TensorShape([None,1]), tf.TensorShape([None,self.max_sequence_length]), 
+                            tf.TensorShape([None,None,self.max_sequence_length]), tf.TensorShape([None,None])]
 
-            ### update variables for the next iteration 
-            prev_scores = tf.reshape(best_scores, [-1,1])
-            prev_symbols = tf.reshape(best_symbols, [-1,1])
-           
-            prev_states=  tf.gather( state, tf.reshape(best_flat_indices,[-1]) )
-            ## NEW
-            prev_lm_states=  tf.gather( lm_state, tf.reshape(best_flat_indices,[-1]) )
+        results = tf.while_loop(loop_cond, loop_body, loop_vars, shape_invariants=shape_invariants, back_prop=False)
+        final_outputs, final_scores = results[-2], results[-1]
 
-            #### compute best-k candidates now 
-            prev_best_outputs_for_final=prev_best_outputs
-            if(i==0): 
-                prev_best_outputs=prev_symbols
-            else: 
-                top_beam_prev_outputs = tf.gather( prev_best_outputs, tf.reshape(best_flat_indices,[-1]) )
-                prev_best_outputs = tf.concat(1,[top_beam_prev_outputs,prev_symbols])
-
-            ##### update beam size after first iteration 
-            if i==0:
-                cur_beam_size=beam_size
-                enc_output=tf.unpack(
-                        tf.reshape(   tf.tile(tf.pack(  enc_output   ),[1,1,beam_size]),
-                                    [self.max_sequence_length,-1,self.input_encoder.get_output_size()]
-                                  )
-                        )
-
-            #### get top-n outputs for the last iteration                 
-            if i==self.max_sequence_length-1: 
-                final_scores, final_indices = tf.nn.top_k(prev_scores_by_instance, topn)
-
-                final_symbols    = final_indices %  self.vocab_size[target_lang] 
-                final_prev_beams = final_indices // self.vocab_size[target_lang] 
-
-                final_flat_indices = tf.tile(tf.reshape(tf.range(0,batch_size),[-1,1]),[1,topn])*beam_size + final_prev_beams
-
-                ### update variables for the next iteration 
-                final_flat_symbols = tf.reshape(final_symbols, [-1,1])
-           
-                #### compute best-n candidates now 
-                top_n_prev_outputs = tf.gather( prev_best_outputs_for_final, tf.reshape(final_flat_indices,[-1]) )
-                final_outputs = tf.concat(1,[top_n_prev_outputs,final_flat_symbols])
-
-        return (tf.reshape(final_outputs,[-1,topn,self.max_sequence_length]),final_scores/self.max_sequence_length)
+        return (final_outputs, final_scores)
 
     ## Given source sequences, and target language, predict character ids sequences in target_lang
     ## Explanation same as that of seq_loss
@@ -0,0 +1,68 @@
+import threading
+import Queue
+import sys
+
+class BatchPrefetcher(object):
+    """
+    Prepares batches ahead of time in a background thread.
+
+    The items produced by the iterator 'batch_iter' are put in a queue holding at most
+    'max_batches' items, which the training loop takes them from with 'get_next'. The
+    order of the items is the same as the order of the iterator.
+
+    The iterator is advanced while holding 'lock'. Any other access to the objects it
+    reads from (e.g. saving the state of the data readers) must hold the same lock.
+    """
+
+    def __init__(self, batch_iter, max_batches, lock=None):
+        self.batch_iter = batch_iter
+        self.lock = threading.Lock() if lock is None else lock
+        self._queue = Queue.Queue(maxsize=max_batches)
+        self._stop = threading.Event()
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        ## wait for space in the queue, unless stopped
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self.lock:
+                    item = (True, next(self.batch_iter))
+            except StopIteration:
+                self._put((False, None))
+                return
+            except Exception:
+                ## the error is raised again in the training loop
+                self._put((False, sys.exc_info()))
+                return
+            if not self._put(item):
+                return
+
+    def get_next(self):
+        """
+        Returns the next item of the iterator. Raises StopIteration when it is exhausted
+        """
+        ok, item = self._queue.get()
+
+        if not ok:
+            ## put the end marker back, so that later calls behave the same way
+            self._queue.put((ok, item))
+            if item is None:
+                raise StopIteration
+            raise item[0], item[1], item[2]
+        return item
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
@@ -21,7 +21,12 @@ class LanguageModel(object):
     """
 
     def __init__(self,lang, mapping, representation,
-                    max_sequence_length, embedding_size,rnn_size):
+                    max_sequence_length, embedding_size,rnn_size,inference_mode=False):
+        """
+        inference_mode: the embedding matrix, if it is a projection of the bit-vector embeddings, is stored 
+            in a table that is not trained or saved. Call fold_embeddings() after the parameters are restored 
+            to fill it (see AttentionModel)
+        """
 
         ## save parameters 
         self.lang = lang
@@ -37,9 +42,12 @@ class LanguageModel(object):
         max_val = 0.1
 
         ####### Input embeddings 
-        self.bitvector_embeddings = tf.constant(
-                                        self.mapping.get_bitvector_embeddings(self.lang,self.representation),
-                                        dtype=tf.float32)
+        ## The onehot representations are identity matrices, so the embedding matrix is used directly (see AttentionModel)
+        self.bitvector_embeddings = None
+        if self.representation not in ['onehot','onehot_shared']:
+            self.bitvector_embeddings = tf.constant(
+                                            self.mapping.get_bitvector_embeddings(self.lang,self.representation),
+                                            dtype=tf.float32)
         self.bitvector_embedding_size = self.mapping.get_bitvector_embedding_size(self.representation)
 
         ###### Embeddings 
@@ -47,7 +55,17 @@ class LanguageModel(object):
         self.Wmat = tf.Variable(tf.random_uniform([self.bitvector_embedding_size, self.embedding_size], 
                                                      -1*max_val, max_val), 
                                 name = 'lm_Wmat')
-        self.embed_W = tf.matmul(self.bitvector_embeddings, self.Wmat, name='lm_embed_W')
+        if self.bitvector_embeddings is None:
+            self.embed_W = self.Wmat
+        else:
+            self.embed_W = tf.matmul(self.bitvector_embeddings, self.Wmat, name='lm_embed_W')
+
+        self.fold_ops=[]
+        if inference_mode and self.bitvector_embeddings is not None: 
+            projection = self.embed_W
+            self.embed_W = tf.Variable(tf.zeros(projection.get_shape()), trainable=False, collections=[], 
+                                        name='lm_embed_W_folded')
+            self.fold_ops.append(tf.assign(self.embed_W,projection))
         self.embed_b = tf.Variable(tf.constant(0., shape=[self.embedding_size]), name = 'lm_embed_b')
 
         ##### Encoder Cell
@@ -60,6 +78,13 @@ class LanguageModel(object):
                                     name='lm_out_W')
         self.out_b = tf.Variable(tf.constant(0., shape = [self.vocab_size]), name='lm_out_b')
 
+    def fold_embeddings(self,sess): 
+        """
+        Computes the embedding table of the inference mode. Call after the parameters are restored
+        """
+        if len(self.fold_ops)>0: 
+            sess.run(self.fold_ops)
+
     def compute_logits(self, sequences, seq_lengths, dropout_keep_prob): 
         """
         Compute logits for the sequences 
@@ -163,7 +188,7 @@ class LanguageModel(object):
         dropout_keep_prob: scalar. Dropout applied to the output of RNN layer
         """
         loss=self.average_loss(sequences, sequence_lengths, dropout_keep_prob)
-        optimizer = tf.train.AdamOptimizer(learning_rate).minimize(loss)
+        optimizer = utilities.minimize(tf.train.AdamOptimizer(learning_rate),loss)
         return [ optimizer, loss ]
 
     def logit_next_char(self,current_input,prev_state): 
@@ -276,6 +301,7 @@ def run_train(args):
 
     with open(mappings_dir+'/mapping_{}.json'.format(args.lang),'w') as mapping_json_file:
         mapping.save_mapping(mapping_json_file)
+    mapping.save_bitvector_embeddings(mappings_dir,args.lang,args.representation)
 
     ## Print Representation and Mappings 
     print 'Mapping'
@@ -473,6 +499,7 @@ def run_test(args):
     mapping = Mapping.get_mapping_instance(args.mapping_class) 
     with open(args.mapping_fname,'r') as mapping_json_file:     
         mapping.load_mapping(mapping_json_file)
+    mapping.load_bitvector_embeddings(os.path.dirname(args.mapping_fname),args.lang,args.representation)
     print 'Mapping'
     print mapping
 
@@ -546,6 +573,7 @@ def run_print_vars(args):
     mapping = Mapping.get_mapping_instance(args.mapping_class) 
     with open(args.mapping_fname,'r') as mapping_json_file:     
         mapping.load_mapping(mapping_json_file)
+    mapping.load_bitvector_embeddings(os.path.dirname(args.mapping_fname),args.lang,args.representation)
     print 'Mapping'
     print mapping
 
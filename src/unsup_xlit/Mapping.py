@@ -1,6 +1,9 @@
+import os
 from collections import defaultdict
+import itertools as it
 import numpy as np 
 import json
+import hashlib
 
 from indicnlp.script import  indic_scripts as isc
 from indicnlp import langinfo as li
@@ -20,6 +23,40 @@ def prefix_sequence_with_token(sequences,sequence_masks,sequence_lengths,token,m
     
         return sd, sm, sl
 
+def _get_symbol_codes(symbols): 
+    """
+    Integer code for each symbol in the list: the codepoint for single character symbols, 
+    and a negative number for the other symbols (e.g. GO, EOW, language tokens)
+
+    Returns a tuple (codes, multi_symbols), where symbol multi_symbols[k] has code -(k+1)
+    """
+    lengths=np.fromiter(it.imap(len,symbols),dtype=np.int64,count=len(symbols))
+    single=lengths==1
+
+    codes=np.empty(len(symbols),dtype=np.int64)
+    codes[single]=np.frombuffer(u''.join(it.compress(symbols,single)).encode('utf-32-le'),dtype='<u4')
+
+    multi_codes={}
+    for k in np.nonzero(~single)[0]: 
+        codes[k]=-(multi_codes.setdefault(symbols[k],len(multi_codes))+1)
+    multi_symbols=sorted(multi_codes.keys(),key=multi_codes.get)
+
+    return codes, multi_symbols
+
+def _get_symbol(code,multi_symbols): 
+    return unichr(code) if code>=0 else multi_symbols[-code-1]
+
+def get_distinct_symbols(words): 
+    """
+    Distinct symbols in a list of words (each a list of symbols), in the order in which they first occur
+    """
+    codes, multi_symbols = _get_symbol_codes(list(it.chain.from_iterable(words)))
+    distinct_codes, first_pos = np.unique(codes,return_index=True)
+    return [ _get_symbol(code,multi_symbols) for code in distinct_codes[np.argsort(first_pos)] ]
+
+def get_bitvector_embeddings_fname(mapping_dir,lang,representation): 
+    return os.path.join(mapping_dir,'bitvector_{}_{}.npy'.format(lang,representation))
+
 def get_mapping_instance(mapping_class): 
 
     if mapping_class == 'CharacterMapping': 
@@ -27,6 +64,79 @@ def get_mapping_instance(mapping_class):
     elif mapping_class == 'IndicPhoneticMapping':
         return IndicPhoneticMapping()
 
+MAPPING_BUNDLE_FNAME='mappings.npz'
+
+def save_mapping_bundle(mapping,fname): 
+    """
+    Save the mappings for all languages to a single binary file. A mapping object shared by
+    several languages is saved only once, and is shared again when loaded (see load_mapping_bundle)
+
+    mapping: Dictionary of mapping objects for each language. The vocabularies must be final 
+    """
+    objects=[]
+    for lang in sorted(mapping.keys()): 
+        if not any([ m is mapping[lang] for m in objects ]): 
+            objects.append(mapping[lang])
+
+    header={}
+    header['langs']=dict([ (lang,[ m is mapping[lang] for m in objects ].index(True)) for lang in mapping.keys() ])
+    header['classes']=[ m.__class__.__name__ for m in objects ]
+
+    arrays={}
+    for k, m in enumerate(objects): 
+        for name, array in m.get_mapping_arrays().iteritems(): 
+            arrays['{}_{}'.format(name,k)]=array
+
+    np.savez(fname,header=np.array(json.dumps(header)),**arrays)
+
+def load_mapping_bundle(fname): 
+    """
+    Load the mappings saved by save_mapping_bundle
+
+    Returns a dictionary of mapping objects for each language 
+    """
+    bundle=np.load(fname)
+    header=json.loads(str(bundle['header']))
+
+    objects=[]
+    for k, mapping_class in enumerate(header['classes']): 
+        m=get_mapping_instance(mapping_class)
+        m.set_mapping_arrays(dict([ (name,bundle['{}_{}'.format(name,k)]) for name in m.get_mapping_array_names() ]))
+        objects.append(m)
+
+    return dict([ (lang,objects[k]) for lang, k in header['langs'].iteritems() ])
+
+def load_mappings(mapping_dir,representation,shared_mapping_class): 
+    """
+    Load the mappings of the languages in 'representation' from the mapping directory. The 
+    mapping bundle is used if it exists, else the per language JSON files are read 
+
+    representation: Dictionary of representation for each language
+    shared_mapping_class: class of the mapping shared by the languages with a shared representation 
+
+    Returns a dictionary of mapping objects for each language 
+    """
+    bundle_fname=os.path.join(mapping_dir,MAPPING_BUNDLE_FNAME)
+    if os.path.exists(bundle_fname): 
+        mapping=load_mapping_bundle(bundle_fname)
+        return dict([ (lang,mapping[lang]) for lang in representation.keys() ])
+
+    mapping={}
+    shared_mapping_obj=get_mapping_instance(shared_mapping_class) 
+
+    for lang in representation.keys(): 
+        if representation[lang] in ['phonetic','onehot_and_phonetic']: 
+            mapping[lang]=shared_mapping_obj
+        elif representation[lang]=='onehot_shared': 
+            mapping[lang]=shared_mapping_obj
+        elif representation[lang]=='onehot': 
+            mapping[lang]=CharacterMapping()
+
+        with open(os.path.join(mapping_dir,'mapping_'+lang+'.json'),'r') as mapping_file:     
+            mapping[lang].load_mapping(mapping_file)
+
+    return mapping
+
 class Mapping():
 
     GO=u'GO'
@@ -40,6 +150,31 @@ class Mapping():
     def load_mapping(self,mapping_file): 
         pass 
 
+    def get_mapping_array_names(self): 
+        return ['i2c','langs']
+
+    def get_mapping_arrays(self): 
+        """
+        Contents of the mapping as a dictionary of arrays (see save_mapping_bundle)
+        """
+        assert not self.update_mode, 'the vocabulary is not final'
+        arrays={}
+        arrays['i2c']=np.array([ self.vocab_i2c[i] for i in xrange(len(self.vocab_i2c)) ],dtype=np.unicode_)
+        arrays['langs']=np.array(sorted([ lang for lang in self.lang_list if lang is not None ]),dtype=np.unicode_)
+        return arrays
+
+    def set_mapping_arrays(self,arrays): 
+        """
+        Restore the mapping from arrays created by get_mapping_arrays
+        """
+        symbols=arrays['i2c'].tolist()
+        self.vocab_i2c=dict(enumerate(symbols))
+        self.vocab_c2i=dict(it.izip(symbols,xrange(len(symbols))))
+        self.lang_list=set(arrays['langs'].tolist())
+        self.update_mode=False
+        self._lookup_tables={}
+        self._bitvector_embeddings={}
+
     def finalize_vocab(self): 
         """
         Call after all vocabulary has been added via get_index
@@ -64,9 +199,194 @@ class Mapping():
     def get_bitvector_embedding_size(self,representation): 
         pass 
 
-    def get_bitvector_embeddings(self,lang,representation): 
+    def compute_bitvector_embeddings(self,lang,representation): 
         pass 
 
+    def get_bitvector_embeddings(self,lang,representation): 
+        """
+        Bit-vector embeddings for the vocabulary of lang. Once the vocabulary is final, the 
+        embeddings are computed only once and reused 
+        """
+        key=(lang,representation)
+        if self.update_mode: 
+            return self.compute_bitvector_embeddings(lang,representation)
+        if key not in self._bitvector_embeddings: 
+            self._bitvector_embeddings[key]=self.compute_bitvector_embeddings(lang,representation)
+        return self._bitvector_embeddings[key]
+
+    def save_bitvector_embeddings(self,mapping_dir,lang,representation): 
+        """
+        Save the bit-vector embeddings to the mapping directory, so that they need not be 
+        computed again when the mapping is loaded (see load_bitvector_embeddings) 
+        """
+        np.save(get_bitvector_embeddings_fname(mapping_dir,lang,representation),
+                np.asarray(self.get_bitvector_embeddings(lang,representation),dtype=np.float32))
+
+    def load_bitvector_embeddings(self,mapping_dir,lang,representation): 
+        """
+        Use the bit-vector embeddings saved in the mapping directory, if they exist. 
+        Call after the mapping has been loaded. Returns True if the embeddings were loaded 
+        """
+        fname=get_bitvector_embeddings_fname(mapping_dir,lang,representation)
+        if not os.path.exists(fname): 
+            return False
+        bitvector_embeddings=np.load(fname)
+        assert bitvector_embeddings.shape[0]==self.get_vocab_size(), fname+' does not match the mapping'
+        self._bitvector_embeddings[(lang,representation)]=bitvector_embeddings
+        return True
+
+    def get_fingerprint(self): 
+        """
+        Digest of the contents of the mapping. Two mappings with the same fingerprint
+        assign the same ids to all symbols
+        """
+        state={}
+        state['class']=self.__class__.__name__
+        state['c2i']=sorted(self.vocab_c2i.items())
+        state['i2pid']=sorted(getattr(self,'indic_i2pid',{}).items())
+        state['langs']=sorted(self.lang_list)
+        state['update_mode']=self.update_mode
+        return hashlib.sha1(json.dumps(state)).hexdigest()
+
+    def _peek_index(self,c,lang=None): 
+        """
+        Index of symbol c if it is in the vocabulary, else None. Unlike get_index, this never 
+        changes the vocabulary 
+        """
+        return self.vocab_c2i.get(c)
+
+    def _get_encode_candidates(self,lang): 
+        """
+        Single character symbols which are looked up in the precomputed codepoint table for lang
+        """
+        return [ c for c in self.vocab_c2i.keys() if len(c)==1 ]
+
+    def _get_c2i_table(self,lang): 
+        """
+        Array mapping codepoints to indices for lang. The entry is -1 for codepoints which must be 
+        looked up with get_index. The table is cached till the vocabulary changes 
+        """
+        key=('c2i',lang,len(self.vocab_c2i),self.update_mode)
+        if key not in self._lookup_tables: 
+            candidates=self._get_encode_candidates(lang)
+            table=np.empty(max([ord(c) for c in candidates]+[-1])+1,dtype=np.int32)
+            ## in update mode, symbols not in the vocabulary are added by get_index 
+            table.fill(-1 if self.update_mode else self.vocab_c2i[Mapping.UNK])
+            for c in candidates: 
+                index=self._peek_index(c,lang)
+                if index is not None: 
+                    table[ord(c)]=index
+            self._lookup_tables[key]=table
+        return self._lookup_tables[key]
+
+    def _get_i2c_table(self,lang): 
+        """
+        Array mapping indices to codepoints for lang. The entry is -1 for indices whose symbol 
+        is not a single character. The table is cached till the vocabulary changes 
+        """
+        key=('i2c',lang,len(self.vocab_c2i),self.update_mode)
+        if key not in self._lookup_tables: 
+            table=np.empty(self.get_vocab_size(),dtype=np.int64)
+            for index in xrange(self.get_vocab_size()): 
+                c=self.get_char(index,lang)
+                table[index]=ord(c) if len(c)==1 else -1
+            self._lookup_tables[key]=table
+        return self._lookup_tables[key]
+
+    def encode_batch(self,words,lang=None,max_sequence_length=None): 
+        """
+        Vectorized version of get_index for a list of words. Each word is a list of symbols.
+
+        In update mode, new symbols are added to the vocabulary in the order in which they first 
+        occur, so the vocabulary is the same as with calling get_index on every symbol in turn.
+
+        Returns a tuple (ids, lengths)
+            ids: int32 array of shape (num_words x max_sequence_length), padded with PAD. 
+                 If max_sequence_length is None, the length of the longest word is used 
+            lengths: int32 array of shape (num_words)
+        """
+        lengths=np.array([ len(word) for word in words ],dtype=np.int32)
+        if max_sequence_length is None: 
+            max_sequence_length=lengths.max() if len(words)>0 else 0 
+        assert (lengths<=max_sequence_length).all(), 'words longer than max_sequence_length'
+
+        codes, multi_symbols=_get_symbol_codes(list(it.chain.from_iterable(words)))
+
+        ## lookup the single character symbols in the precomputed table 
+        table=self._get_c2i_table(lang)
+        flat_ids=np.empty(len(codes),dtype=np.int32)
+        flat_ids.fill(-1)
+        in_table=(codes>=0)&(codes<len(table))
+        flat_ids[in_table]=table[codes[in_table]]
+        if not self.update_mode: 
+            flat_ids[codes>=len(table)]=self.vocab_c2i[Mapping.UNK]
+
+        ## the other symbols are looked up once each, in the order of first occurrence
+        unresolved=flat_ids<0
+        if unresolved.any(): 
+            distinct_codes, first_pos, inverse=np.unique(codes[unresolved],return_index=True,return_inverse=True)
+            distinct_ids=np.empty(len(distinct_codes),dtype=np.int32)
+            for k in np.argsort(first_pos): 
+                distinct_ids[k]=self.get_index(_get_symbol(distinct_codes[k],multi_symbols),lang)
+            flat_ids[unresolved]=distinct_ids[inverse]
+
+        if self.update_mode and len(codes)>0: 
+            self.lang_list.add(lang)
+
+        ids=np.empty([len(words),max_sequence_length],dtype=np.int32)
+        ids.fill(self.get_index(Mapping.PAD,lang))
+        ids[np.arange(max_sequence_length)[np.newaxis,:]<lengths[:,np.newaxis]]=flat_ids
+
+        return ids, lengths
+
+    def _decode_ids(self,ids,lang): 
+        sent=[self.get_char(x,lang) for x in ids]
+        return u' '.join(it.takewhile(lambda x:x != Mapping.EOW,it.dropwhile(lambda x:x==Mapping.GO,sent)))
+
+    def decode_batch(self,id_array,lang): 
+        """
+        Vectorized conversion of id sequences to words. For each row of id_array, leading GO 
+        symbols are dropped and the row is cut at the first EOW. 
+
+        Returns a list with one word per row, the characters separated by space
+        """
+        id_array=np.asarray(id_array)
+        num_rows, row_length=id_array.shape
+        positions=np.arange(row_length)[np.newaxis,:]
+
+        ## the span of each row between the leading GOs and the first EOW 
+        not_go=id_array!=self.vocab_c2i[Mapping.GO]
+        starts=np.where(not_go.any(axis=1),not_go.argmax(axis=1),row_length)
+        eow=(id_array==self.vocab_c2i[Mapping.EOW])&(positions>=starts[:,np.newaxis])
+        ends=np.where(eow.any(axis=1),eow.argmax(axis=1),row_length)
+        in_span=(positions>=starts[:,np.newaxis])&(positions<ends[:,np.newaxis])
+
+        table=self._get_i2c_table(lang)
+        valid_ids=(id_array>=0)&(id_array<len(table))
+        codes=np.where(valid_ids,table[np.where(valid_ids,id_array,0)],-1)
+
+        ## rows with symbols which are not single characters are decoded one symbol at a time
+        slow_rows=(in_span&(codes<0)).any(axis=1)
+        in_span[slow_rows]=False
+
+        ## all the other rows are decoded together, with a space after every character
+        span_codes=codes[in_span]
+        spaced_codes=np.empty(2*len(span_codes),dtype='<u4')
+        spaced_codes[0::2]=span_codes
+        spaced_codes[1::2]=ord(u' ')
+        text=spaced_codes.tostring().decode('utf-32-le')
+
+        num_chars=in_span.sum(axis=1)
+        offsets=2*(np.cumsum(num_chars)-num_chars)
+
+        words=[]
+        for row in xrange(num_rows): 
+            if slow_rows[row]: 
+                words.append(self._decode_ids(id_array[row],lang))
+            else: 
+                words.append(text[offsets[row]:offsets[row]+max(2*num_chars[row]-1,0)])
+        return words
+
     # Given sequence of character ids, return word.
     # A word is space separated character with GO, EOW (End of Word) and PAD character to make total length = max_sequence_length
     def get_word_from_ids(self,sequence,lang):
@@ -88,6 +408,8 @@ class IndicPhoneticMapping(Mapping):
         
         ## state members 
         self.update_mode=True
+        self._lookup_tables={}
+        self._bitvector_embeddings={}
 
         ## add standard vocabulary 
         self.vocab_c2i[Mapping.GO]
@@ -118,6 +440,22 @@ class IndicPhoneticMapping(Mapping):
 
         self.lang_list=set(dump_data['langs'])
         self.update_mode=False
+        self._lookup_tables={}
+        self._bitvector_embeddings={}
+
+    def get_mapping_array_names(self): 
+        return Mapping.get_mapping_array_names(self)+['i2pid_index','i2pid_pid']
+
+    def get_mapping_arrays(self): 
+        arrays=Mapping.get_mapping_arrays(self)
+        indices=sorted(self.indic_i2pid.keys())
+        arrays['i2pid_index']=np.array(indices,dtype=np.int32)
+        arrays['i2pid_pid']=np.array([ self.indic_i2pid[i] for i in indices ],dtype=np.int32)
+        return arrays
+
+    def set_mapping_arrays(self,arrays): 
+        Mapping.set_mapping_arrays(self,arrays)
+        self.indic_i2pid=dict(it.izip(arrays['i2pid_index'].tolist(),arrays['i2pid_pid'].tolist()))
 
     def finalize_vocab(self): 
         """
@@ -147,6 +485,19 @@ class IndicPhoneticMapping(Mapping):
 
         return index
 
+    def _peek_index(self,c,lang=None): 
+        if len(c)==1 and lang is not None and isc.in_coordinated_range(c,lang): 
+            c=isc.offset_to_char(isc.get_offset(c,lang),'hi')
+        return self.vocab_c2i.get(c)
+
+    def _get_encode_candidates(self,lang): 
+        candidates=Mapping._get_encode_candidates(self,lang)
+        if lang is not None and isc.is_supported_language(lang): 
+            ## characters of the script of lang which are mapped to the coordinated Devanagari characters
+            candidates.extend([ c for c in [ isc.offset_to_char(pid,lang) for pid in xrange(0x80) ] 
+                                    if isc.in_coordinated_range(c,lang) ])
+        return candidates
+
     def get_char(self,index,lang=None): 
 
         c=None 
@@ -211,7 +562,7 @@ class IndicPhoneticMapping(Mapping):
         ohv=np.identity(self.get_vocab_size())
         return np.concatenate([ohv,phv],1)
 
-    def get_bitvector_embeddings(self,lang,representation='phonetic'): 
+    def compute_bitvector_embeddings(self,lang,representation='phonetic'): 
     
         if representation=='phonetic':
             return self.get_phonetic_bitvector_embeddings(lang)
@@ -231,6 +582,8 @@ class CharacterMapping(Mapping):
         
         ## state members 
         self.update_mode=True
+        self._lookup_tables={}
+        self._bitvector_embeddings={}
 
         ## add standard vocabulary 
         self.vocab_c2i[Mapping.GO]
@@ -256,6 +609,8 @@ class CharacterMapping(Mapping):
 
         self.lang_list=set(dump_data['langs'])
         self.update_mode=False
+        self._lookup_tables={}
+        self._bitvector_embeddings={}
 
     def finalize_vocab(self): 
         """
@@ -294,7 +649,7 @@ class CharacterMapping(Mapping):
             ##TODO: throw exception
             pass 
 
-    def get_bitvector_embeddings(self,lang,representation='onehot'): 
+    def compute_bitvector_embeddings(self,lang,representation='onehot'): 
     
         if representation  in ['onehot','onehot_shared']: 
             return np.identity(self.get_vocab_size())
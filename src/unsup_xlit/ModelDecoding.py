@@ -35,9 +35,12 @@ if __name__ == '__main__' :
 
     parser.add_argument('--max_seq_length', type = int, default = 30, help = 'maximum sequence length')
     parser.add_argument('--batch_size', type = int, default = 100, help = 'size of each batch used in decoding')
+    parser.add_argument('--tokens_per_batch', type = int, default = None, help = 'fill each batch with as many sequences as fit in this number of characters (including the GO and EOW symbols), instead of a fixed number of sequences. --batch_size is not used if this is set')
 
-    parser.add_argument('--enc_type', type = str, default = 'cnn',  help = 'encoder to use. One of (1) simple_lstm_noattn (2) bilstm (3) cnn')
+    parser.add_argument('--enc_type', type = str, default = 'cnn',  help = 'encoder to use. One of (1) simple_lstm_noattn (2) bilstm (3) cnn (4) cnn_masked: cnn, with the PAD positions masked out of the convolutions and the final state (5) simple_lstm_noattn_dynamic (6) bilstm_dynamic: same as (1) and (2), but the RNN is run in a loop up to the longest sequence in the batch')
     parser.add_argument('--separate_output_embedding', action='store_true', default = False,  help = 'Should separate embeddings be used on the input and output side. Generally the same embeddings are to be used. This is used only for Indic-Indic transliteration, when input is phonetic and output is onehot_shared')
+    parser.add_argument('--attention', type = str, default = 'global',  help = 'attention mechanism. One of (1) global: the decoder attends over all the positions of the source sequence (2) local: the decoder attends over the positions within --attention_window of a center which advances with the decoder step. Decoding has to use the same setting as training. Not used if the setting is saved with the model (<model_fname>.attention.json)')
+    parser.add_argument('--attention_window', type = int, default = 3, help = 'half width of the window of local attention: 2*attention_window+1 positions are attended. Not used if the setting is saved with the model')
     parser.add_argument('--prefix_tgtlang', action='store_true', default = False,
             help = 'Prefix the input sequence with the language code for the target language')
     parser.add_argument('--prefix_srclang', action='store_true', default = False,
@@ -76,6 +79,9 @@ if __name__ == '__main__' :
     ## architecture
     enc_type = args.enc_type
     separate_output_embedding = args.separate_output_embedding
+    ## the attention mechanism saved with the model, if any, is used instead of the command line flags
+    attention, attention_window = AttentionModel.load_attention_config(model_fname,args.attention,args.attention_window)
+    print 'Attention: {}, window: {}'.format(attention,attention_window)
     prefix_tgtlang = args.prefix_tgtlang
     prefix_srclang = args.prefix_srclang
 
@@ -88,6 +94,7 @@ if __name__ == '__main__' :
     ## other hyperparameters  
     max_sequence_length = args.max_seq_length
     batch_size = args.batch_size 
+    tokens_per_batch = args.tokens_per_batch
 
     ## decoding
     beam_size_val= args.beam_size
@@ -115,19 +122,13 @@ if __name__ == '__main__' :
     print representation 
 
     ### load the mapping
-    mapping={}
-    shared_mapping_obj = Mapping.get_mapping_instance(shared_mapping_class) 
+    mapping = Mapping.load_mappings(mapping_dir,representation,shared_mapping_class)
 
+    ## use the bitvector embeddings saved with the mapping, if available 
     for lang in representation.keys(): 
-        if representation[lang] in ['phonetic','onehot_and_phonetic']: 
-            mapping[lang]=shared_mapping_obj
-        elif representation[lang]=='onehot_shared': 
-            mapping[lang]=shared_mapping_obj
-        elif representation[lang]=='onehot': 
-            mapping[lang]=Mapping.CharacterMapping()
-
-        with open(mapping_dir+'/'+'mapping_'+lang+'.json','r') as mapping_file:     
-            mapping[lang].load_mapping(mapping_file)
+        mapping[lang].load_bitvector_embeddings(mapping_dir,lang,representation[lang])
+        if separate_output_embedding: 
+            mapping[lang].load_bitvector_embeddings(mapping_dir,lang,'onehot_shared')
 
     ## Print Representation and Mappings 
     print 'Mapping'
@@ -155,7 +156,9 @@ if __name__ == '__main__' :
     # Creating Model object
     model = AttentionModel.AttentionModel(mapping,representation,max_sequence_length,
             embedding_size,enc_rnn_size,dec_rnn_size,
-            enc_type,separate_output_embedding)
+            enc_type,separate_output_embedding,inference_mode=True,
+            attention=attention,attention_window=attention_window,
+            source_prefix_length=int(prefix_tgtlang)+int(prefix_srclang))
 
     # Pass parameters
 
@@ -181,6 +184,7 @@ if __name__ == '__main__' :
     sess = tf.Session(config=config)
     sess.run(tf.initialize_all_variables())
     saver.restore(sess,model_fname)
+    model.fold_embeddings(sess)
 
     print "Session started"
 
@@ -191,8 +195,7 @@ if __name__ == '__main__' :
     predicted_scores_list=[]
 
     print 'starting execution'
-    for start in xrange(0,sequences.shape[0],batch_size):
-        end = min(start+batch_size,sequences.shape[0])
+    for start, end in utilities.batch_boundaries(sequence_lengths,batch_size,tokens_per_batch):
 
         batch_start_time=time.time()
 
@@ -234,11 +237,12 @@ if __name__ == '__main__' :
                         sequences.shape[0]/test_time,
                     )
 
+    num_sents, num_ranks, _ = predicted_sequences_ids.shape
+    predicted_sents=mapping[target_lang].decode_batch(predicted_sequences_ids.reshape([num_sents*num_ranks,-1]),target_lang)
     with codecs.open(out_fname,'w','utf-8') as outfile: 
-        for sent_no, all_sent_predictions in enumerate(predicted_sequences_ids): 
-            for rank, sequence_at_rank in enumerate(all_sent_predictions): 
-                sent=[mapping[target_lang].get_char(x,target_lang) for x in sequence_at_rank]
-                sent=u' '.join(it.takewhile(lambda x:x != u'EOW',it.dropwhile(lambda x:x==u'GO',sent))) 
+        for sent_no in xrange(num_sents): 
+            for rank in xrange(num_ranks): 
+                sent=predicted_sents[sent_no*num_ranks+rank]
                 outfile.write(u'{} ||| {} ||| Distortion0= -1 LM0= -1 WordPenalty0= -1 PhrasePenalty0= -1 TranslationModel0= -1 -1 -1 -1 ||| {}\n'.format(sent_no,sent,predicted_scores[sent_no,rank]))
 
     print 'Process terminated at: ' + time.asctime()
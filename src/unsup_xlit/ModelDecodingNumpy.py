@@ -0,0 +1,132 @@
+"""
+Decodes a word list like ModelDecoding.py, with the parameters exported by ModelExport.py and
+NumpyAttentionModel instead of TensorFlow. The architecture is read from the exported file, so
+only the decoding parameters are needed.
+"""
+
+import argparse
+import sys
+import numpy as np
+import time
+
+import Mapping
+import MonoDataReader
+import NumpyAttentionModel
+import utilities
+
+from indicnlp import loader
+
+if __name__ == '__main__' :
+
+    print 'Process started at: ' + time.asctime()
+
+    #### Load Indic NLP Library ###
+    ## Note: Environment variable: INDIC_RESOURCES_PATH must be set
+    loader.load()
+
+    #####################################
+    #    Command line argument parser   #
+    #####################################
+
+    # Creating parser
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--batch_size', type = int, default = 100, help = 'size of each batch used in decoding')
+    parser.add_argument('--tokens_per_batch', type = int, default = None, help = 'fill each batch with as many sequences as fit in this number of characters (including the GO and EOW symbols), instead of a fixed number of sequences. --batch_size is not used if this is set')
+
+    parser.add_argument('--prefix_tgtlang', action='store_true', default = False,
+            help = 'Prefix the input sequence with the language code for the target language')
+    parser.add_argument('--prefix_srclang', action='store_true', default = False,
+            help = 'Prefix the input sequence with the language code for the source language')
+
+    parser.add_argument('--representation', type = str, default = 'onehot',  help = 'input representation, which can be specified in two ways: (i) one of "phonetic", "onehot", "onehot_and_phonetic"')
+    parser.add_argument('--shared_mapping_class', type = str, default = 'IndicPhoneticMapping',  help = 'class to be used for shared mapping. Possible values: IndicPhoneticMapping, CharacterMapping')
+
+    parser.add_argument('--topn', type = int, default = 10, help = 'The top-n candidates to report')
+    parser.add_argument('--beam_size', type = int, default = 5, help = 'beam size for decoding')
+
+    parser.add_argument('--lang_pair', type = str, help = 'language pair for decoding: "lang1-lang2"')
+
+    parser.add_argument('--weights_fname', type = str, help = 'file with the parameters exported by ModelExport.py, or quantized by ModelQuantize.py')
+    parser.add_argument('--mapping_dir', type = str, help = 'directory containing mapping files')
+    parser.add_argument('--in_fname', type = str, help = 'input file')
+    parser.add_argument('--out_fname', type = str, help = 'results file')
+
+    args = parser.parse_args()
+
+    print '========== Parameters start ==========='
+    for k,v in vars(args).iteritems():
+        print '{}: {}'.format(k,v)
+    print '========== Parameters end ============='
+
+    lang_pair=tuple(args.lang_pair.split('-'))
+    source_lang = lang_pair[0]
+    target_lang = lang_pair[1]
+
+    ### parse representation argument
+    if args.representation in ['onehot','onehot_shared','phonetic','onehot_and_phonetic']:
+        representation = {}
+        for lang in lang_pair:
+            representation[lang]=args.representation
+    else:
+        representation = dict([ x.split(':') for x in args.representation.split(',') ])
+
+    ### load the mapping. The embeddings are in the exported parameters, so the bitvector embeddings are not needed
+    mapping = Mapping.load_mappings(args.mapping_dir,representation,args.shared_mapping_class)
+
+    ### load the model
+    start_time=time.time()
+    model = NumpyAttentionModel.NumpyAttentionModel(args.weights_fname)
+    max_sequence_length = model.max_sequence_length
+    print 'Model loaded in {:.3f} s'.format(time.time()-start_time)
+    sys.stdout.flush()
+
+    test_data = MonoDataReader.MonoDataReader(source_lang, args.in_fname,mapping[source_lang],max_sequence_length)
+    sequences, sequence_masks, sequence_lengths = test_data.get_data()
+
+    test_time=0.0
+    predicted_sequences_ids_list=[]
+    predicted_scores_list=[]
+
+    print 'starting execution'
+    for start, end in utilities.batch_boundaries(sequence_lengths,args.batch_size,args.tokens_per_batch):
+
+        batch_start_time=time.time()
+
+        data_sequences=sequences[start:end,:]
+        data_sequence_masks=sequence_masks[start:end,:]
+        data_sequence_lengths=sequence_lengths[start:end]
+
+        if args.prefix_tgtlang:
+            data_sequences,data_sequence_masks,data_sequence_lengths = Mapping.prefix_sequence_with_token(
+                    data_sequences,data_sequence_masks,data_sequence_lengths,
+                    target_lang,mapping[target_lang])
+
+        if args.prefix_srclang:
+            data_sequences,data_sequence_masks,data_sequence_lengths = Mapping.prefix_sequence_with_token(
+                    data_sequences,data_sequence_masks,data_sequence_lengths,
+                    source_lang,mapping[source_lang])
+
+        b_sequences_ids, b_scores = model.transliterate_beam(source_lang,data_sequences,data_sequence_lengths,
+                                                            target_lang,args.beam_size,args.topn)
+        predicted_sequences_ids_list.append(b_sequences_ids)
+        predicted_scores_list.append(b_scores)
+
+        batch_end_time=time.time()
+        test_time+=(batch_end_time-batch_start_time)
+
+        print 'Decoded {} of {} sequences'.format(end,sequences.shape[0])
+        sys.stdout.flush()
+
+    predicted_sequences_ids=np.concatenate(predicted_sequences_ids_list,axis=0)
+    predicted_scores=np.concatenate(predicted_scores_list,axis=0)
+
+    print 'Number of sequences: {}'.format(sequences.shape[0])
+    print 'Time taken (hh:mm:ss): {}'.format(utilities.formatted_timeinterval(test_time))
+    print 'Decoding speed: {} sequences/s'.format(sequences.shape[0]/test_time)
+
+    num_sents, num_ranks, _ = predicted_sequences_ids.shape
+    predicted_sents=mapping[target_lang].decode_batch(predicted_sequences_ids.reshape([num_sents*num_ranks,-1]),target_lang)
+    utilities.write_nbest_output(args.out_fname,predicted_sents,predicted_scores)
+
+    print 'Process terminated at: ' + time.asctime()
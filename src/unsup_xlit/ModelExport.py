@@ -0,0 +1,129 @@
+"""
+Exports the parameters of a trained model to a NumPy file (see AttentionModel.export_weights),
+for decoding without TensorFlow with ModelDecodingNumpy.py. Use the same architecture parameters
+used for training the network.
+"""
+
+import argparse
+import sys
+import time
+
+import AttentionModel
+import Mapping
+
+import tensorflow as tf
+
+from indicnlp import loader
+
+if __name__ == '__main__' :
+
+    print 'Process started at: ' + time.asctime()
+
+    #### Load Indic NLP Library ###
+    ## Note: Environment variable: INDIC_RESOURCES_PATH must be set
+    loader.load()
+
+    #####################################
+    #    Command line argument parser   #
+    #####################################
+
+    # Creating parser
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--max_seq_length', type = int, default = 30, help = 'maximum sequence length')
+
+    parser.add_argument('--enc_type', type = str, default = 'cnn',  help = 'encoder to use. One of (1) simple_lstm_noattn (2) bilstm (3) cnn (4) cnn_masked: cnn, with the PAD positions masked out of the convolutions and the final state (5) simple_lstm_noattn_dynamic (6) bilstm_dynamic: same as (1) and (2), but the RNN is run in a loop up to the longest sequence in the batch')
+    parser.add_argument('--separate_output_embedding', action='store_true', default = False,  help = 'Should separate embeddings be used on the input and output side. Generally the same embeddings are to be used. This is used only for Indic-Indic transliteration, when input is phonetic and output is onehot_shared')
+    parser.add_argument('--attention', type = str, default = 'global',  help = 'attention mechanism. One of (1) global: the decoder attends over all the positions of the source sequence (2) local: the decoder attends over the positions within --attention_window of a center which advances with the decoder step. Decoding has to use the same setting as training. Not used if the setting is saved with the model (<model_fname>.attention.json)')
+    parser.add_argument('--attention_window', type = int, default = 3, help = 'half width of the window of local attention: 2*attention_window+1 positions are attended. Not used if the setting is saved with the model')
+
+    parser.add_argument('--prefix_tgtlang', action='store_true', default = False,
+            help = 'The input sequences are prefixed with the language code for the target language')
+    parser.add_argument('--prefix_srclang', action='store_true', default = False,
+            help = 'The input sequences are prefixed with the language code for the source language')
+
+    parser.add_argument('--embedding_size', type = int, default = 256, help = 'size of character representation')
+    parser.add_argument('--enc_rnn_size', type = int, default = 512, help = 'size of output of encoder RNN')
+    parser.add_argument('--dec_rnn_size', type = int, default = 512, help = 'size of output of dec RNN')
+    parser.add_argument('--representation', type = str, default = 'onehot',  help = 'input representation, which can be specified in two ways: (i) one of "phonetic", "onehot", "onehot_and_phonetic"')
+    parser.add_argument('--shared_mapping_class', type = str, default = 'IndicPhoneticMapping',  help = 'class to be used for shared mapping. Possible values: IndicPhoneticMapping, CharacterMapping')
+
+    parser.add_argument('--lang_pair', type = str, help = 'language pair for decoding: "lang1-lang2"')
+
+    parser.add_argument('--model_fname', type = str, help = 'model file name')
+    parser.add_argument('--mapping_dir', type = str, help = 'directory containing mapping files')
+    parser.add_argument('--out_fname', type = str, help = 'file to write the exported parameters to (.npz)')
+
+    args = parser.parse_args()
+
+    print '========== Parameters start ==========='
+    for k,v in vars(args).iteritems():
+        print '{}: {}'.format(k,v)
+    print '========== Parameters end ============='
+
+    max_sequence_length = args.max_seq_length
+    lang_pair=tuple(args.lang_pair.split('-'))
+
+    ## the attention mechanism saved with the model, if any, is used instead of the command line flags
+    attention, attention_window = AttentionModel.load_attention_config(args.model_fname,args.attention,args.attention_window)
+    print 'Attention: {}, window: {}'.format(attention,attention_window)
+
+    #######################################
+    # Reading data and creating mappings  #
+    #######################################
+
+    ### parse representation argument
+    if args.representation in ['onehot','onehot_shared','phonetic','onehot_and_phonetic']:
+        representation = {}
+        for lang in lang_pair:
+            representation[lang]=args.representation
+    else:
+        representation = dict([ x.split(':') for x in args.representation.split(',') ])
+
+    ### load the mapping
+    mapping = Mapping.load_mappings(args.mapping_dir,representation,args.shared_mapping_class)
+
+    ## use the bitvector embeddings saved with the mapping, if available
+    for lang in representation.keys():
+        mapping[lang].load_bitvector_embeddings(args.mapping_dir,lang,representation[lang])
+        if args.separate_output_embedding:
+            mapping[lang].load_bitvector_embeddings(args.mapping_dir,lang,'onehot_shared')
+
+    ###################################################################
+    #    Interacting with model and creating computation graph        #
+    ###################################################################
+
+    print "Start graph creation"
+    # Creating Model object
+    model = AttentionModel.AttentionModel(mapping,representation,max_sequence_length,
+            args.embedding_size,args.enc_rnn_size,args.dec_rnn_size,
+            args.enc_type,args.separate_output_embedding,inference_mode=True,
+            attention=attention,attention_window=attention_window,
+            source_prefix_length=int(args.prefix_tgtlang)+int(args.prefix_srclang))
+
+    ## the decoding graph creates the encoder and decoder variables, as in ModelDecoding.py
+    batch_sequences = tf.placeholder(shape=[None,max_sequence_length],dtype=tf.int32)
+    batch_sequence_lengths = tf.placeholder(shape=[None],dtype=tf.float32)
+    beam_size = tf.placeholder(dtype=tf.int32)
+    topn = tf.placeholder(dtype=tf.int32)
+
+    outputs, outputs_scores = model.transliterate_beam(
+                lang_pair[0],batch_sequences,batch_sequence_lengths,lang_pair[1],beam_size, topn)
+
+    saver = tf.train.Saver(max_to_keep = 3)
+
+    print "Done with creating graph. Starting session"
+
+    #Start Session
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    sess = tf.Session(config=config)
+    sess.run(tf.initialize_all_variables())
+    saver.restore(sess,args.model_fname)
+    model.fold_embeddings(sess)
+
+    model.export_weights(sess,args.out_fname)
+    print 'Exported the parameters to: {}'.format(args.out_fname)
+    sys.stdout.flush()
+
+    print 'Process terminated at: ' + time.asctime()
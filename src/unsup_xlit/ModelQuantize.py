@@ -0,0 +1,35 @@
+"""
+Post-training quantization of a model exported by ModelExport.py: the embeddings, LSTM matrices and
+output layers are stored as int8 with a scale for each row (see NumpyAttentionModel.quantize_weights_bundle).
+The quantized file is decoded by ModelDecodingNumpy.py like the exported file. Compare the two with
+QuantizationReport.py.
+"""
+
+import argparse
+import os
+import time
+
+import NumpyAttentionModel
+
+if __name__ == '__main__' :
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--weights_fname', type = str, help = 'file with the parameters exported by ModelExport.py')
+    parser.add_argument('--out_fname', type = str, help = 'file to write the quantized parameters to (.npz)')
+
+    args = parser.parse_args()
+
+    print '========== Parameters start ==========='
+    for k,v in vars(args).iteritems():
+        print '{}: {}'.format(k,v)
+    print '========== Parameters end ============='
+
+    start_time=time.time()
+    NumpyAttentionModel.quantize_weights_bundle(args.weights_fname,args.out_fname)
+    print 'Quantized in {:.3f} s'.format(time.time()-start_time)
+
+    for fname in [args.weights_fname,args.out_fname]:
+        model=NumpyAttentionModel.NumpyAttentionModel(fname)
+        print '{}: file {:.2f} MB, parameters in memory {:.2f} MB'.format(fname,
+                os.path.getsize(fname)/float(1<<20),model.get_weights_nbytes()/float(1<<20))
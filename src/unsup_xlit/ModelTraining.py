@@ -2,6 +2,7 @@ import argparse
 import os
 import sys
 import codecs
+import threading
 
 import itertools as it
 import tensorflow as tf
@@ -12,13 +13,15 @@ import AttentionModel
 import Mapping
 import MonoDataReader
 import ParallelDataReader
+import StreamingDataReader
+import BatchPrefetcher
 import utilities
 
 import calendar,time
 from indicnlp import loader
 
 def decode(out_dir,epoch_no,lang_pairs,test_data,
-        decode_output_op,decode_scores_op,
+        decode_output_op,decode_scores_op,lang_feed,
         batch_sequences, batch_sequence_masks, batch_sequence_lengths,
         beam_size, topn,
         prefix_tgtlang,prefix_srclang,mapping,
@@ -34,6 +37,7 @@ def decode(out_dir,epoch_no,lang_pairs,test_data,
 
     decode_output_op: dictionary of decoder output operation for every language pair 
     decode_scores_op: dictionary of decoder output scores operation for every language pair 
+    lang_feed: dictionary of additional feed (the language ids for a shared graph) for every language pair 
 
     batch_sequences, batch_sequence_masks, batch_sequence_lengths,
         beam_size, topn: placeholder variables 
@@ -64,8 +68,7 @@ def decode(out_dir,epoch_no,lang_pairs,test_data,
     
         predicted_sequences_ids_list=[]
         predicted_scores_list=[]
-        for start in xrange(0,sequences.shape[0],batch_size):
-            end = min(start+batch_size,sequences.shape[0])
+        for start, end in utilities.batch_boundaries(sequence_lengths,batch_size,tokens_per_batch):
     
             batch_start_time=time.time()
     
@@ -73,10 +76,12 @@ def decode(out_dir,epoch_no,lang_pairs,test_data,
             data_sequence_masks=sequence_masks[start:end,:]
             data_sequence_lengths=sequence_lengths[start:end]
     
+            feed_dict={batch_sequences: data_sequences, batch_sequence_lengths: data_sequence_lengths, 
+                        beam_size: beam_size_val, topn: topn_val
+                       }
+            feed_dict.update(lang_feed[lang_pair])
             b_sequences_ids, b_scores = sess.run([decode_output_op[lang_pair],decode_scores_op[lang_pair]], 
-                feed_dict={batch_sequences: data_sequences, batch_sequence_lengths: data_sequence_lengths, 
-                            beam_size: beam_size_val, topn: topn_val
-                           }
+                feed_dict=feed_dict
                 )
     
             predicted_sequences_ids_list.append(b_sequences_ids)
@@ -88,11 +93,12 @@ def decode(out_dir,epoch_no,lang_pairs,test_data,
         ## write output to file 
 
         out_fname=out_dir+str(epoch_no).zfill(3)+'test.nbest.'+src_lang+'-'+tgt_lang+'.'+tgt_lang
+        num_sents, num_ranks, _ = predicted_sequences_ids.shape
+        predicted_sents=mapping[tgt_lang].decode_batch(predicted_sequences_ids.reshape([num_sents*num_ranks,-1]),tgt_lang)
         with codecs.open(out_fname,'w','utf-8') as outfile: 
-            for sent_no, all_sent_predictions in enumerate(predicted_sequences_ids): 
-                for rank, predicted_sequence_ids in enumerate(all_sent_predictions): 
-                    sent=[mapping[tgt_lang].get_char(x,tgt_lang) for x in predicted_sequence_ids]
-                    sent=u' '.join(it.takewhile(lambda x:x != u'EOW',it.dropwhile(lambda x:x==u'GO',sent))) 
+            for sent_no in xrange(num_sents): 
+                for rank in xrange(num_ranks): 
+                    sent=predicted_sents[sent_no*num_ranks+rank]
                     outfile.write(u'{} ||| {} ||| Distortion0= -1 LM0= -1 WordPenalty0= -1 PhrasePenalty0= -1 TranslationModel0= -1 -1 -1 -1 ||| {}\n'.format(sent_no,sent,predicted_scores[sent_no,rank]))
     
         ### compute loss: just the negative of the likelihood of best candidates
@@ -103,7 +109,7 @@ def decode(out_dir,epoch_no,lang_pairs,test_data,
     
 
 def get_seq2seq_loss(lang_pairs, parallel_data,
-                        seq_loss_op,
+                        seq_loss_op, lang_feed,
                         batch_sequences, batch_sequence_masks, batch_sequence_lengths,
                         batch_sequences_2, batch_sequence_masks_2, batch_sequence_lengths_2,
                         dropout_keep_prob,
@@ -116,6 +122,7 @@ def get_seq2seq_loss(lang_pairs, parallel_data,
     parallel_data: Dictionary of ParallelDataReader object for various language pairs                 
 
     seq_loss_op: dictionary of sequence loss operation for every language pair 
+    lang_feed: dictionary of additional feed (the language ids for a shared graph) for every language pair 
     batch_sequences, batch_sequence_masks, batch_sequence_lengths,
         batch_sequences_2, batch_sequence_masks_2, batch_sequence_lengths_2,
         dropout_keep_prob: placeholder variables 
@@ -143,14 +150,94 @@ def get_seq2seq_loss(lang_pairs, parallel_data,
                                         sequences,sequence_masks,sequence_lengths,
                                         src_lang,mapping[src_lang])
     
-        validation_loss += sess.run(seq_loss_op[lang_pair], feed_dict = {
+        feed_dict = {
             batch_sequences:sequences,batch_sequence_masks:sequence_masks,batch_sequence_lengths:sequence_lengths,
             batch_sequences_2:sequences_2,batch_sequence_masks_2:sequence_masks_2,batch_sequence_lengths_2:sequence_lengths_2,
             dropout_keep_prob:1.0
-            })
+            }
+        feed_dict.update(lang_feed[lang_pair])
+        validation_loss += sess.run(seq_loss_op[lang_pair], feed_dict = feed_dict)
 
     return validation_loss        
 
+def get_train_batches(lang_pairs, parallel_data, batch_size, tokens_per_batch, buckets,
+                        prefix_tgtlang, prefix_srclang, mapping, max_sequence_length):
+    """
+    generator over the training batches, ready to be fed. The language pairs are visited 
+    in turn, forever. 
+
+    lang_pairs: list of language pair tuples. 
+    parallel_data: Dictionary of ParallelDataReader object for various language pairs                 
+    batch_size, tokens_per_batch: see commandline flags 
+    buckets: list of bucket lengths, None if the batches are not bucketed 
+
+    prefix_srclang: see commandline flags 
+    prefix_tgtlang: see commandline flags 
+    mapping: Dictionary of mapping objects for each language
+
+    Yields tuples (lang_pair, bucket_length, batch), where batch is a tuple 
+    (sequences,sequence_masks,sequence_lengths,sequences_2,sequence_masks_2,sequence_lengths_2)
+    """
+
+    while True: 
+        for src_lang,tgt_lang in lang_pairs:
+            lang_pair=(src_lang,tgt_lang)
+
+            if buckets is None: 
+                bucket_length = max_sequence_length
+                sequences,sequence_masks,sequence_lengths,sequences_2,sequence_masks_2,sequence_lengths_2 = \
+                        parallel_data[lang_pair].get_next_batch(batch_size,tokens_per_batch)
+            else: 
+                bucket_length, (sequences,sequence_masks,sequence_lengths,sequences_2,sequence_masks_2,sequence_lengths_2) = \
+                        parallel_data[lang_pair].get_next_bucket_batch(batch_size,tokens_per_batch)
+
+            if prefix_tgtlang: 
+                sequences,sequence_masks,sequence_lengths = Mapping.prefix_sequence_with_token(sequences,sequence_masks,sequence_lengths, 
+                                                            tgt_lang,mapping[tgt_lang])
+            if prefix_srclang: 
+                sequences,sequence_masks,sequence_lengths = Mapping.prefix_sequence_with_token(sequences,sequence_masks,sequence_lengths, 
+                                                            src_lang,mapping[src_lang])
+
+            yield lang_pair, bucket_length, (sequences,sequence_masks,sequence_lengths,sequences_2,sequence_masks_2,sequence_lengths_2)
+
+def get_mixed_train_batches(train_batches, lang_pairs, lang_ids, mapping):
+    """
+    generator over training batches with the examples of all the language pairs. One batch of each 
+    language pair from train_batches is concatenated, padded to the largest bucket length among them. 
+
+    train_batches: generator over the training batches of each language pair (see get_train_batches)
+    lang_pairs: list of language pair tuples, in the order of the batches from train_batches 
+    lang_ids: Dictionary of the language id of each language (see AttentionModel.lang_ids)
+    mapping: Dictionary of mapping objects for each language
+
+    Yields tuples (pair_sizes, bucket_length, batch), where pair_sizes is a dictionary of the number 
+    of examples of each language pair in the batch, and batch is a tuple 
+    (sequences,sequence_masks,sequence_lengths,sequences_2,sequence_masks_2,sequence_lengths_2,src_lang_ids,tgt_lang_ids)
+    """
+
+    while True: 
+        pair_batches = [ train_batches.next() for _ in lang_pairs ]
+        bucket_length = max([ batch_length for _, batch_length, _ in pair_batches ])
+
+        pair_sizes = dict()
+        mixed_batch = [ [] for _ in xrange(8) ]
+        for (src_lang,tgt_lang), batch_length, batch in pair_batches: 
+            num_examples = len(batch[0])
+            pair_sizes[(src_lang,tgt_lang)] = num_examples
+
+            ## pad the sequences with PAD and the masks with 0
+            pad_values = [ mapping[src_lang].get_index(Mapping.Mapping.PAD), 0.0, None, 
+                           mapping[tgt_lang].get_index(Mapping.Mapping.PAD), 0.0, None ]
+            for k, x in enumerate(batch): 
+                if pad_values[k] is not None and batch_length < bucket_length: 
+                    x = np.pad(x,[(0,0),(0,bucket_length-batch_length)],'constant',constant_values=pad_values[k])
+                mixed_batch[k].append(x)
+
+            mixed_batch[6].append(np.repeat(lang_ids[src_lang],num_examples).astype(np.int32))
+            mixed_batch[7].append(np.repeat(lang_ids[tgt_lang],num_examples).astype(np.int32))
+
+        yield pair_sizes, bucket_length, tuple([ np.concatenate(x) for x in mixed_batch ])
+
 if __name__ == '__main__' :
 
     print 'Process started at: ' + time.asctime()
@@ -169,12 +256,17 @@ if __name__ == '__main__' :
     parser.add_argument('--data_dir', type = str, help = 'data directory')
     parser.add_argument('--output_dir', type = str, help = 'output folder name')
     parser.add_argument('--train_size', type = int, metavar = 'N', default = -1, help = 'use the first N sequence pairs for training. N=-1 means use the entire training set.')
+    parser.add_argument('--streaming_reader', action='store_true', default = False, help = 'stream the parallel training data from disk instead of loading it into memory. The corpus cache is not used for the streamed data')
+    parser.add_argument('--shuffle_buffer_size', type = int, default = 10000, help = 'number of training sequence pairs held in memory for shuffling by the streaming reader')
+    parser.add_argument('--corpus_cache_dir', type = str, default = None, help = 'directory to cache the id-encoded corpora in. Cached corpora are memory-mapped in subsequent runs. The cache is not used if this is not set')
 
     parser.add_argument('--lang_pairs', type = str, default = None, help = 'List of language pairs for supervised training given as: "lang1-lang2,lang3-lang4,..."')
     parser.add_argument('--unseen_langs', type = str, default = None, help = 'List of languages not seen during training given as: "lang1,lang2,lang3,lang4,..."')
 
-    parser.add_argument('--enc_type', type = str, default = 'cnn',  help = 'encoder to use. One of (1) simple_lstm_noattn (2) bilstm (3) cnn')
+    parser.add_argument('--enc_type', type = str, default = 'cnn',  help = 'encoder to use. One of (1) simple_lstm_noattn (2) bilstm (3) cnn (4) cnn_masked: cnn, with the PAD positions masked out of the convolutions and the final state (5) simple_lstm_noattn_dynamic (6) bilstm_dynamic: same as (1) and (2), but the RNN is run in a loop up to the longest sequence in the batch')
     parser.add_argument('--separate_output_embedding', action='store_true', default = False,  help = 'Should separate embeddings be used on the input and output side. Generally the same embeddings are to be used. This is used only for Indic-Indic transliteration, when input is phonetic and output is onehot_shared')
+    parser.add_argument('--attention', type = str, default = 'global',  help = 'attention mechanism. One of (1) global: the decoder attends over all the positions of the source sequence (2) local: the decoder attends over the positions within --attention_window of a center which advances with the decoder step. Decoding has to use the same setting as training')
+    parser.add_argument('--attention_window', type = int, default = 3, help = 'half width of the window of local attention: 2*attention_window+1 positions are attended')
     parser.add_argument('--prefix_tgtlang', action='store_true', default = False,
             help = 'Prefix the input sequence with the language code for the target language')
     parser.add_argument('--prefix_srclang', action='store_true', default = False,
@@ -183,9 +275,16 @@ if __name__ == '__main__' :
     parser.add_argument('--embedding_size', type = int, default = 256, help = 'size of character representation')
     parser.add_argument('--enc_rnn_size', type = int, default = 512, help = 'size of output of encoder RNN')
     parser.add_argument('--dec_rnn_size', type = int, default = 512, help = 'size of output of dec RNN')
+    parser.add_argument('--shared_graph', action='store_true', default = False, help = 'create one training, validation loss and decoding graph for all language pairs, with the source and target language as inputs. The shared parameters of all language pairs are trained with one optimizer, and the parameters of each language only with the batches of that language. Otherwise, a graph and an optimizer are created for each language pair')
+    parser.add_argument('--mixed_batches', action='store_true', default = False, help = 'train on batches with the examples of all the language pairs: a batch of each language pair (see --batch_size, --tokens_per_batch) is put together, and all the language pairs are updated in one training step. The source and target language of each example are inputs of the graph. Implies --shared_graph')
 
     parser.add_argument('--max_seq_length', type = int, default = 30, help = 'maximum sequence length')
     parser.add_argument('--batch_size', type = int, default = 32, help = 'size of each batch used in training')
+    parser.add_argument('--tokens_per_batch', type = int, default = None, help = 'fill each batch with as many sequence pairs as fit in this number of characters (of both languages, including the GO and EOW symbols), instead of a fixed number of sequence pairs. --batch_size is not used if this is set')
+    parser.add_argument('--buckets', type = str, default = None, help = 'group the training sequence pairs into buckets by length, given as: "len1,len2,..." e.g. "10,15,20,30". Each training step only unrolls to the length of its bucket. max_seq_length is always used as the largest bucket. If not set, all batches are padded to max_seq_length')
+    parser.add_argument('--seed', type = int, default = None, help = 'seed for shuffling the training data. The shuffling is not reproducible if this is not set')
+    parser.add_argument('--prefetch_batches', type = int, default = 0, help = 'number of training batches prepared ahead of time in a background thread, e.g. 4. 0 means the batches are prepared in the training loop')
+    parser.add_argument('--report_data_wait', action='store_true', default = False, help = 'report the time the training loop waited for training batches in every epoch')
     parser.add_argument('--max_epochs', type = int, default = 30, help = 'maximum number of epochs')
     parser.add_argument('--learning_rate', type = float, default = 0.001, help = 'learning rate of Adam Optimizer')
     parser.add_argument('--dropout_keep_prob', type = float, default = 0.5, help = 'keep probablity for the dropout layers')
@@ -219,28 +318,44 @@ if __name__ == '__main__' :
         print 'ERROR: --output_dir has to be set'
         sys.exit(1)
 
+    if args.buckets is not None and args.streaming_reader:
+        print 'ERROR: --buckets cannot be used with --streaming_reader'
+        sys.exit(1)
+
     #### Reading arguments
 
     ## directories 
     data_dir = args.data_dir
     output_dir = args.output_dir
     train_size = args.train_size 
+    corpus_cache_dir = args.corpus_cache_dir
+    streaming_reader = args.streaming_reader
+    shuffle_buffer_size = args.shuffle_buffer_size
 
     ## architecture
     enc_type = args.enc_type
     separate_output_embedding = args.separate_output_embedding
+    attention = args.attention
+    attention_window = args.attention_window
     prefix_tgtlang = args.prefix_tgtlang
     prefix_srclang = args.prefix_srclang
 
     embedding_size = args.embedding_size
     enc_rnn_size = args.enc_rnn_size
     dec_rnn_size = args.dec_rnn_size
+    mixed_batches = args.mixed_batches
+    shared_graph = args.shared_graph or mixed_batches
     representation = None
     shared_mapping_class = args.shared_mapping_class
 
     ## additional hyperparameters 
     max_sequence_length = args.max_seq_length
     batch_size = args.batch_size
+    tokens_per_batch = args.tokens_per_batch
+    buckets = None if args.buckets is None else [ int(x) for x in args.buckets.split(',') ]
+    seed = args.seed
+    prefetch_batches = args.prefetch_batches
+    report_data_wait = args.report_data_wait
     max_epochs = args.max_epochs
     learning_rate = args.learning_rate
     infer_every = args.infer_every
@@ -340,10 +455,18 @@ if __name__ == '__main__' :
 
     # Reading Parallel Training data
     parallel_train_data = dict()
-    for lang_pair in parallel_train_langs:
+    for i, lang_pair in enumerate(parallel_train_langs):
         file_prefix = data_dir+'/parallel_train/'+lang_pair[0]+'-'+lang_pair[1]+'.'
-        parallel_train_data[lang_pair] = ParallelDataReader.ParallelDataReader(lang_pair[0],lang_pair[1],
-            file_prefix+lang_pair[0],file_prefix+lang_pair[1],mapping,max_sequence_length,train_size)
+        ## each language pair is shuffled with its own seed
+        pair_seed = None if seed is None else seed+i
+        if streaming_reader: 
+            parallel_train_data[lang_pair] = StreamingDataReader.StreamingParallelDataReader(lang_pair[0],lang_pair[1],
+                file_prefix+lang_pair[0],file_prefix+lang_pair[1],mapping,max_sequence_length,train_size,shuffle_buffer_size,
+                seed=pair_seed)
+        else: 
+            parallel_train_data[lang_pair] = ParallelDataReader.ParallelDataReader(lang_pair[0],lang_pair[1],
+                file_prefix+lang_pair[0],file_prefix+lang_pair[1],mapping,max_sequence_length,train_size,corpus_cache_dir,
+                seed=pair_seed)
 
     ## complete vocabulary creation
     for lang in all_langs: 
@@ -357,6 +480,16 @@ if __name__ == '__main__' :
         with open(mappings_dir+'/mapping_{}.json'.format(lang),'w') as mapping_json_file:
             mapping[lang].save_mapping(mapping_json_file)
 
+    ## the mapping bundle stores all languages in a single file and preserves the sharing of mapping objects.
+    ## It is used instead of the JSON files for decoding (see Mapping.load_mappings)
+    Mapping.save_mapping_bundle(dict([ (lang,mapping[lang]) for lang in all_langs ]),mappings_dir+'/'+Mapping.MAPPING_BUNDLE_FNAME)
+
+    ## save the bitvector embeddings, so that decoding need not compute them again 
+    for lang in all_langs: 
+        mapping[lang].save_bitvector_embeddings(mappings_dir,lang,representation[lang])
+        if separate_output_embedding: 
+            mapping[lang].save_bitvector_embeddings(mappings_dir,lang,'onehot_shared')
+
     print 'Vocabulary Statitics'
     for lang in all_langs: 
         print '{}: {}'.format(lang,mapping[lang].get_vocab_size())
@@ -367,21 +500,28 @@ if __name__ == '__main__' :
     for lang_pair in parallel_valid_langs:
         file_prefix = data_dir+'/parallel_valid/'+lang_pair[0]+'-'+lang_pair[1]+'.'
         parallel_valid_data[lang_pair] = ParallelDataReader.ParallelDataReader(lang_pair[0],lang_pair[1],
-            file_prefix+lang_pair[0],file_prefix+lang_pair[1],mapping,max_sequence_length)
+            file_prefix+lang_pair[0],file_prefix+lang_pair[1],mapping,max_sequence_length,cache_dir=corpus_cache_dir)
 
     # Reading Test data
     test_data = dict()
     for lang_pair in test_langs:
         file_name = data_dir+'/test/'+lang_pair[0]+'-'+lang_pair[1]
         test_data[lang_pair] = MonoDataReader.MonoDataReader(lang_pair[0],
-            file_name,mapping[lang_pair[0]],max_sequence_length)
+            file_name,mapping[lang_pair[0]],max_sequence_length,cache_dir=corpus_cache_dir)
 
     # Reading validation data for decoding 
     valid_decode_data = dict()
     for lang_pair in parallel_valid_langs:
         file_name = data_dir+'/parallel_valid/'+lang_pair[0]+'-'+lang_pair[1]+'.'+lang_pair[0]
         valid_decode_data[lang_pair] = MonoDataReader.MonoDataReader(lang_pair[0],
-            file_name,mapping[lang_pair[0]],max_sequence_length)
+            file_name,mapping[lang_pair[0]],max_sequence_length,cache_dir=corpus_cache_dir)
+
+    ## group training data into buckets
+    if buckets is not None: 
+        for lang_pair in parallel_train_langs:
+            parallel_train_data[lang_pair].create_buckets(buckets,int(prefix_tgtlang)+int(prefix_srclang))
+        buckets = parallel_train_data[parallel_train_langs[0]].bucket_lengths
+        print 'Buckets: {}'.format(buckets)
 
     print 'Finished Reading Data' 
 
@@ -392,7 +532,9 @@ if __name__ == '__main__' :
     # Creating Model object
     model = AttentionModel.AttentionModel(mapping,representation,max_sequence_length,
             embedding_size,enc_rnn_size,dec_rnn_size, 
-            enc_type,separate_output_embedding) # Pass parameters
+            enc_type,separate_output_embedding,
+            attention=attention,attention_window=attention_window,
+            source_prefix_length=int(prefix_tgtlang)+int(prefix_srclang)) # Pass parameters
 
     ## Creating placeholder for sequences, masks and lengths and dropout keep probability 
     batch_sequences = tf.placeholder(shape=[None,max_sequence_length],dtype=tf.int32)
@@ -407,37 +549,113 @@ if __name__ == '__main__' :
 
     beam_size = tf.placeholder(dtype=tf.int32)
     topn = tf.placeholder(dtype=tf.int32)
+
+    ## With a shared graph, the source and target language ids are fed with every batch. 
+    ## lang_feed has the feed for each language pair (empty if there is a graph for each language pair)
+    lang_feed = dict()
+    if shared_graph: 
+        batch_src_lang = tf.placeholder(shape=[],dtype=tf.int32)
+        batch_tgt_lang = tf.placeholder(shape=[],dtype=tf.int32)
+        for lang_pair in set(parallel_train_langs+parallel_valid_langs+test_langs): 
+            lang_feed[lang_pair] = { batch_src_lang: model.lang_ids[lang_pair[0]], batch_tgt_lang: model.lang_ids[lang_pair[1]] }
+    else: 
+        for lang_pair in set(parallel_train_langs+parallel_valid_langs+test_langs): 
+            lang_feed[lang_pair] = dict()
+
+    ## With mixed batches, the source and target language ids of each example are fed
+    if mixed_batches: 
+        batch_src_langs = tf.placeholder(shape=[None],dtype=tf.int32)
+        batch_tgt_langs = tf.placeholder(shape=[None],dtype=tf.int32)
     
+    ## Placeholders for training batches, for each bucket length 
+    ## Without buckets, all batches use the placeholders created above
+    train_placeholders = dict()
+    train_placeholders[max_sequence_length] = ( batch_sequences, batch_sequence_masks, batch_sequence_lengths,
+                                                batch_sequences_2, batch_sequence_masks_2, batch_sequence_lengths_2 )
+    for bucket_length in ( [] if buckets is None else buckets ):
+        if bucket_length not in train_placeholders: 
+            train_placeholders[bucket_length] = ( 
+                    tf.placeholder(shape=[None,bucket_length],dtype=tf.int32),
+                    tf.placeholder(shape=[None,bucket_length],dtype=tf.float32),
+                    tf.placeholder(shape=[None],dtype=tf.float32),
+                    tf.placeholder(shape=[None,bucket_length],dtype=tf.int32),
+                    tf.placeholder(shape=[None,bucket_length],dtype=tf.float32),
+                    tf.placeholder(shape=[None],dtype=tf.float32),
+                )
+
     # Optimizers for training using parallel data
+    # One optimizer per language pair, shared by the graphs for all buckets
+    # With a shared graph, one optimizer is shared by all language pairs and buckets (with an optimizer for the variables of each language)
+    # With mixed batches, there is one graph for each bucket, for the batches with examples of all the language pairs
 
     sup_optimizer = dict()
-    for lang_pair in parallel_train_langs:
-        lang1,lang2=lang_pair
-        print 'Created optimizer for language pair: {}-{}'.format(lang1,lang2)
-        sup_optimizer[(lang1,lang2)] = model.get_parallel_optimizer(
-                learning_rate,
-                lang1,batch_sequences,batch_sequence_masks,batch_sequence_lengths,
-                lang2,batch_sequences_2,batch_sequence_masks_2,batch_sequence_lengths_2,dropout_keep_prob)
+    mixed_optimizer = dict()
+    if mixed_batches: 
+        optimizer = tf.train.AdamOptimizer(learning_rate)
+        for bucket_length, placeholders in train_placeholders.iteritems():
+            print 'Created optimizer for mixed batches of all language pairs with sequence length: {}'.format(bucket_length)
+            mixed_optimizer[bucket_length] = model.get_parallel_optimizer(
+                    learning_rate,
+                    batch_src_langs,placeholders[0],placeholders[1],placeholders[2],
+                    batch_tgt_langs,placeholders[3],placeholders[4],placeholders[5],dropout_keep_prob,
+                    optimizer)
+    elif shared_graph: 
+        optimizer = tf.train.AdamOptimizer(learning_rate)
+        for bucket_length, placeholders in train_placeholders.iteritems():
+            print 'Created optimizer for all language pairs with sequence length: {}'.format(bucket_length)
+            shared_optimizer = model.get_parallel_optimizer(
+                    learning_rate,
+                    batch_src_lang,placeholders[0],placeholders[1],placeholders[2],
+                    batch_tgt_lang,placeholders[3],placeholders[4],placeholders[5],dropout_keep_prob,
+                    optimizer)
+            for lang_pair in parallel_train_langs:
+                sup_optimizer[(lang_pair,bucket_length)] = shared_optimizer
+    else: 
+        for lang_pair in parallel_train_langs:
+            lang1,lang2=lang_pair
+            optimizer = tf.train.AdamOptimizer(learning_rate)
+            for bucket_length, placeholders in train_placeholders.iteritems():
+                print 'Created optimizer for language pair: {}-{} with sequence length: {}'.format(lang1,lang2,bucket_length)
+                sup_optimizer[(lang_pair,bucket_length)] = model.get_parallel_optimizer(
+                        learning_rate,
+                        lang1,placeholders[0],placeholders[1],placeholders[2],
+                        lang2,placeholders[3],placeholders[4],placeholders[5],dropout_keep_prob,
+                        optimizer)
 
     # Finding validation sequence loss
     # For each pair of language, return sum of loss of transliteration one script to another and vice versa
     validation_seq_loss = dict()
 
-    for lang_pair in parallel_valid_langs:
-        lang1,lang2=lang_pair
-        print 'Created validation loss calculator for language pair: {}-{}'.format(lang1,lang2)
-        validation_seq_loss[lang_pair] = model.seq_loss_2(
-                lang1,batch_sequences,batch_sequence_masks,batch_sequence_lengths,
-                lang2,batch_sequences_2,batch_sequence_masks_2,batch_sequence_lengths_2,dropout_keep_prob)
+    if shared_graph: 
+        print 'Created validation loss calculator for all language pairs'
+        shared_seq_loss = model.seq_loss_2(
+                batch_src_lang,batch_sequences,batch_sequence_masks,batch_sequence_lengths,
+                batch_tgt_lang,batch_sequences_2,batch_sequence_masks_2,batch_sequence_lengths_2,dropout_keep_prob)
+        for lang_pair in parallel_valid_langs:
+            validation_seq_loss[lang_pair] = shared_seq_loss
+    else: 
+        for lang_pair in parallel_valid_langs:
+            lang1,lang2=lang_pair
+            print 'Created validation loss calculator for language pair: {}-{}'.format(lang1,lang2)
+            validation_seq_loss[lang_pair] = model.seq_loss_2(
+                    lang1,batch_sequences,batch_sequence_masks,batch_sequence_lengths,
+                    lang2,batch_sequences_2,batch_sequence_masks_2,batch_sequence_lengths_2,dropout_keep_prob)
 
     # Predict output for test sequences
     infer_output = dict()
     infer_output_scores = dict()
-    for lang_pair in test_langs:
-        lang1,lang2=lang_pair
-        print 'Created decoder for language pair: {}-{}'.format(lang1,lang2)
-        infer_output[lang_pair], infer_output_scores[lang_pair] =  \
-            model.transliterate_beam(lang_pair[0],batch_sequences,batch_sequence_lengths,lang_pair[1],beam_size,topn)
+    if shared_graph: 
+        print 'Created decoder for all language pairs'
+        shared_infer_output, shared_infer_output_scores = \
+            model.transliterate_beam(batch_src_lang,batch_sequences,batch_sequence_lengths,batch_tgt_lang,beam_size,topn)
+        for lang_pair in test_langs:
+            infer_output[lang_pair], infer_output_scores[lang_pair] = shared_infer_output, shared_infer_output_scores
+    else: 
+        for lang_pair in test_langs:
+            lang1,lang2=lang_pair
+            print 'Created decoder for language pair: {}-{}'.format(lang1,lang2)
+            infer_output[lang_pair], infer_output_scores[lang_pair] =  \
+                model.transliterate_beam(lang_pair[0],batch_sequences,batch_sequence_lengths,lang_pair[1],beam_size,topn)
 
     # All training dataset
     training_langs = parallel_train_langs
@@ -461,6 +679,12 @@ if __name__ == '__main__' :
     if(start_from is not None):
         saver.restore(sess,'{}/temp_models/my_model-{}'.format(output_dir,start_from))
         completed_epochs=start_from
+
+        ## continue the training data shuffling from where it was saved
+        for lang_pair in parallel_train_langs:
+            shuffle_state_fname = '{}/temp_models/shuffle_state-{}.{}-{}.npz'.format(output_dir,start_from,lang_pair[0],lang_pair[1])
+            if os.path.exists(shuffle_state_fname): 
+                parallel_train_data[lang_pair].load_shuffle_state(shuffle_state_fname)
     
     tf.train.SummaryWriter(log_dir,sess.graph)
 
@@ -472,6 +696,27 @@ if __name__ == '__main__' :
     epoch_train_time=0.0
     epoch_train_loss=0.0
 
+    ## time spent waiting for training batches 
+    epoch_data_wait_time=0.0
+
+    ## number of training steps and training time for each bucket length
+    bucket_steps=dict([ (bucket_length,0) for bucket_length in train_placeholders.keys() ])
+    bucket_train_time=dict([ (bucket_length,0.0) for bucket_length in train_placeholders.keys() ])
+
+    ## Training batches are prepared ahead of time by a background thread if prefetching is enabled.
+    ## The state of the training data readers must only be accessed while holding train_data_lock
+    train_batches = get_train_batches(parallel_train_langs, parallel_train_data, batch_size, tokens_per_batch, buckets, 
+                                        prefix_tgtlang, prefix_srclang, mapping, max_sequence_length)
+    if mixed_batches: 
+        train_batches = get_mixed_train_batches(train_batches, parallel_train_langs, model.lang_ids, mapping)
+    train_data_lock = threading.Lock()
+    if prefetch_batches > 0: 
+        prefetcher = BatchPrefetcher.BatchPrefetcher(train_batches, prefetch_batches, train_data_lock)
+        get_next_train_batch = prefetcher.get_next
+    else: 
+        prefetcher = None
+        get_next_train_batch = train_batches.next
+
     start_time=time.time()
 
     # Whether to continue or now
@@ -480,38 +725,53 @@ if __name__ == '__main__' :
     print 'Starting training ...'
     while cont:
         # Selected the dataset whose least fraction is used for training in current epoch
-        for (opti_lang,idx) in zip(training_langs,range(len(training_langs))):
+        # With mixed batches, all the language pairs are trained on one batch
+        for (opti_lang,idx) in ( [(None,None)] if mixed_batches else zip(training_langs,range(len(training_langs))) ):
 
             ### TRAIN
             update_start_time=time.time()
 
             # If it is a bilingual dataset, call corresponding optimizers
-            lang1 = opti_lang[0]
-            lang2 = opti_lang[1]
+            # The batches come in the same order as training_langs
+            batch_lang, bucket_length, batch = get_next_train_batch()
+            sequences,sequence_masks,sequence_lengths,sequences_2,sequence_masks_2,sequence_lengths_2 = batch[:6]
+            if not mixed_batches: 
+                assert batch_lang == opti_lang
+
+            data_ready_time=time.time()
+            epoch_data_wait_time+=(data_ready_time-update_start_time)
+
+            placeholders = train_placeholders[bucket_length]
+            feed_dict = {
+                placeholders[0]:sequences,placeholders[1]:sequence_masks,placeholders[2]:sequence_lengths,
+                placeholders[3]:sequences_2,placeholders[4]:sequence_masks_2,placeholders[5]:sequence_lengths_2,
+                dropout_keep_prob:dropout_keep_prob_val
+                }
+            if mixed_batches: 
+                feed_dict.update({ batch_src_langs: batch[6], batch_tgt_langs: batch[7] })
+                _, step_loss = sess.run(mixed_optimizer[bucket_length], feed_dict = feed_dict)
 
-            sequences,sequence_masks,sequence_lengths,sequences_2,sequence_masks_2,sequence_lengths_2 = \
-                    parallel_train_data[opti_lang].get_next_batch(batch_size)
-            
-            if prefix_tgtlang: 
-                sequences,sequence_masks,sequence_lengths = Mapping.prefix_sequence_with_token(sequences,sequence_masks,sequence_lengths, 
-                                                            lang2,mapping[lang2])
-            if prefix_srclang: 
-                sequences,sequence_masks,sequence_lengths = Mapping.prefix_sequence_with_token(sequences,sequence_masks,sequence_lengths, 
-                                                            lang1,mapping[lang1])
+                ## batch_lang has the number of examples of each language pair in the batch
+                for i, lang_pair in enumerate(training_langs): 
+                    fractional_epochs[i] += float(batch_lang[lang_pair])/parallel_train_data[lang_pair].num_words
 
-            _, step_loss = sess.run(sup_optimizer[opti_lang], feed_dict = {
-                batch_sequences:sequences,batch_sequence_masks:sequence_masks,batch_sequence_lengths:sequence_lengths,
-                batch_sequences_2:sequences_2,batch_sequence_masks_2:sequence_masks_2,batch_sequence_lengths_2:sequence_lengths_2,
-                dropout_keep_prob:dropout_keep_prob_val
-                })
+                ## the loss of a mixed batch is the average over all the language pairs. It is scaled to 
+                ## the sum of the loss of each language pair, as with one batch for each language pair
+                step_loss = step_loss*len(training_langs)
+            else: 
+                feed_dict.update(lang_feed[opti_lang])
+                _, step_loss = sess.run(sup_optimizer[(opti_lang,bucket_length)], feed_dict = feed_dict)
 
-            fractional_epochs[idx] += float(len(sequences))/parallel_train_data[opti_lang].num_words
+                fractional_epochs[idx] += float(len(sequences))/parallel_train_data[opti_lang].num_words
 
             epoch_train_loss+=step_loss
 
             update_end_time=time.time()
             epoch_train_time+=(update_end_time-update_start_time)
 
+            bucket_steps[bucket_length]+=1
+            bucket_train_time[bucket_length]+=(update_end_time-update_start_time)
+
         # One more batch is processed
         steps+=1
         # If all datasets are used for training epoch is complete
@@ -527,7 +787,7 @@ if __name__ == '__main__' :
             valid_start_time=time.time()
 
             validation_loss=get_seq2seq_loss(parallel_valid_langs, parallel_valid_data,
-                                validation_seq_loss,
+                                validation_seq_loss, lang_feed,
                                 batch_sequences, batch_sequence_masks, batch_sequence_lengths,
                                 batch_sequences_2, batch_sequence_masks_2, batch_sequence_lengths_2,
                                 dropout_keep_prob,
@@ -566,7 +826,7 @@ if __name__ == '__main__' :
 
                     test_start_time=time.time()
                     test_loss=decode(outputs_dir, completed_epochs, test_langs, test_data,
-                            infer_output, infer_output_scores,
+                            infer_output, infer_output_scores, lang_feed,
                             batch_sequences, batch_sequence_masks, batch_sequence_lengths,
                             beam_size, topn,
                             prefix_tgtlang, prefix_srclang, mapping,
@@ -575,7 +835,7 @@ if __name__ == '__main__' :
 
                     validdecode_start_time=time.time()
                     valid_decode_loss=decode(valid_outputs_dir, completed_epochs, parallel_valid_langs, valid_decode_data,
-                            infer_output, infer_output_scores,
+                            infer_output, infer_output_scores, lang_feed,
                             batch_sequences, batch_sequence_masks, batch_sequence_lengths,
                             beam_size, topn,
                             prefix_tgtlang, prefix_srclang, mapping,
@@ -590,7 +850,14 @@ if __name__ == '__main__' :
             # Save current model
             #if(cont == True):
                 #if(completed_epochs==1 or (len(validation_losses)>=2 and validation_losses[-1]<validation_losses[-2])):
-            saver.save(sess, temp_model_output_dir+'my_model', global_step=completed_epochs)
+            model.save_attention_config(saver.save(sess, temp_model_output_dir+'my_model', global_step=completed_epochs))
+            ## NOTE: with prefetching, the saved state is past the batches which were prepared but not trained 
+            #        on yet. These (at most prefetch_batches) batches are skipped when training is restarted
+            if not streaming_reader: 
+                with train_data_lock: 
+                    for lang_pair in parallel_train_langs:
+                        parallel_train_data[lang_pair].save_shuffle_state(temp_model_output_dir+'shuffle_state-{}.{}-{}.npz'.format(
+                            completed_epochs,lang_pair[0],lang_pair[1]))
 
             print "Epochs Completed : "+str(completed_epochs).zfill(3)+ \
                     "\t Time (hh:mm:ss)::: train> {} valid> {} test> {} validdecode> {}".format(
@@ -600,10 +867,26 @@ if __name__ == '__main__' :
                             utilities.formatted_timeinterval(epoch_validdecode_time),
                             )
 
+            if report_data_wait: 
+                print "Epochs Completed : "+str(completed_epochs).zfill(3)+ \
+                        "\t Time waiting for training data (hh:mm:ss): {} ({:.1f}% of train time)".format(
+                                utilities.formatted_timeinterval(epoch_data_wait_time),
+                                100.0*epoch_data_wait_time/epoch_train_time if epoch_train_time > 0 else 0.0)
+
+            for bucket_length in sorted(bucket_steps.keys()): 
+                if bucket_steps[bucket_length] > 0: 
+                    print "Epochs Completed : "+str(completed_epochs).zfill(3)+ \
+                            "\t Sequence length: {} Steps: {} Steps/sec: {}".format(
+                                    bucket_length, bucket_steps[bucket_length],
+                                    bucket_steps[bucket_length]/bucket_train_time[bucket_length])
+
             ## update epoch variables 
             fractional_epochs = [0.0 for _ in parallel_train_langs]
             epoch_train_time=0.0
             epoch_train_loss=0.0
+            epoch_data_wait_time=0.0
+            bucket_steps=dict([ (bucket_length,0) for bucket_length in train_placeholders.keys() ])
+            bucket_train_time=dict([ (bucket_length,0.0) for bucket_length in train_placeholders.keys() ])
 
             print "Epochs Completed : "+str(completed_epochs).zfill(3)+ \
                     "\t Number of training steps: {}".format(steps)
@@ -613,8 +896,11 @@ if __name__ == '__main__' :
 
             sys.stdout.flush()
 
+    if prefetcher is not None: 
+        prefetcher.stop()
+
     # save final model
-    final_saver.save(sess,output_dir+'/final_model_epochs_'+str(completed_epochs))
+    model.save_attention_config(final_saver.save(sess,output_dir+'/final_model_epochs_'+str(completed_epochs)))
 
     print 'End training' 
 
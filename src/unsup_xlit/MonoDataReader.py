@@ -1,73 +1,86 @@
 import numpy as np
-import codecs
+
+import corpus_cache
+import utilities
 
 class MonoDataReader():
     # Initializer and data reader
-    def __init__(self, lang, filename, mapping, max_sequence_length, train_size=-1):
+    def __init__(self, lang, filename, mapping, max_sequence_length, train_size=-1, cache_dir=None, seed=None):
         # Taking args and storing as class vars
         self.lang = lang
         self.mapping = mapping
         self.max_sequence_length = max_sequence_length
         self.train_size = train_size
 
-        # Reading the file
-        # NOTE: -2 should be -1 
-        file_read = map(lambda x: [u'GO']+(x.strip().split(' '))[:max_sequence_length-2]+[u'EOW'],codecs.open(filename,'r','utf-8').readlines())
-        if self.train_size > 0 : 
-            file_read = file_read[:self.train_size]
-
-        #lengths is list of lengths of all words. i.e. a list of integers with size num_words in dataset 
-        self.lengths = np.array(map(lambda x: len(x), file_read))
+        # Reading the file and replacing each character with the corresponding character id.
+        # sequences are padded with PAD to max_sequence_length
+        # lengths is list of lengths of all words. i.e. a list of integers with size num_words in dataset 
+        self.sequences, self.lengths = corpus_cache.load_corpus(filename, lang, self.mapping, 
+                                            max_sequence_length, self.train_size, cache_dir)
         self.num_words = len(self.lengths)
 
-        #Adding PAD to the words to make each word length = max_sequence_length
-        file_read = map(lambda x: x+[u'PAD']*(max_sequence_length-len(x)),file_read)
-
-        # replacing character with corresponding character id
-        self.sequences = np.array([[self.mapping.get_index(char,lang) for char in word] for word in file_read], dtype = np.int32)
-
         # Creating masks. Mask has size = size of list of sequence. 
         # Corresponding to each PAD character there is a zero, for all other there is a 1
-        self.masks = np.zeros([self.num_words, self.max_sequence_length],dtype = np.float32)
-        for i in range(self.num_words):
-            self.masks[i][:self.lengths[i]]=1
+        self.masks = (np.arange(self.max_sequence_length)[np.newaxis,:] < self.lengths[:,np.newaxis]).astype(np.float32)
 
         # Vars to be used while returning batch_size batches
         self._epochs_completed = 0
         self._current_index = 0
         
         # Shuffling data
-        perm = list(np.arange(self.num_words))
-        self.sequences = self.sequences[perm]
-        self.masks = self.masks[perm]
-        self.lengths = self.lengths[perm]
+        # Only the order in which the words are visited is shuffled, batches are gathered through it.
+        # The data itself stays in file order (see get_data)
+        self.rng = np.random.RandomState(seed)
+        self._order = np.arange(self.num_words)
+        self.rng.shuffle(self._order)
 
     # Returns next batch of data with given batch size
-    def get_next_batch(self,batch_size):
+    # If tokens_per_batch is not None, the batch is filled with as many words as fit in tokens_per_batch
+    # characters (including GO and EOW) instead
+    def get_next_batch(self,batch_size,tokens_per_batch=None):
         # If epoch was completed in last call, reset current index
         if(self._current_index >= self.num_words):
             self._current_index = 0
 
         start = self._current_index
+        if tokens_per_batch is not None: 
+            # every word has at least one character, so at most tokens_per_batch words are needed
+            batch_size = utilities.token_batch_size(self.lengths[self._order[start:start+tokens_per_batch]], tokens_per_batch)
         end = min(start + batch_size, self.num_words)
 
         self._current_index = end
 
-        batch_sequences = self.sequences[start:end]
-        batch_masks = self.masks[start:end]
-        batch_lengths = self.lengths[start:end]
+        # indices are sorted to read memory-mapped data in file order
+        batch_indices = np.sort(self._order[start:end])
+
+        batch_sequences = self.sequences[batch_indices]
+        batch_masks = self.masks[batch_indices]
+        batch_lengths = self.lengths[batch_indices]
 
         if(self._current_index >= self.num_words):
             self._epochs_completed += 1
 
             # Shuffling as epoch is complete
-            perm = list(np.arange(self.num_words))
-            self.sequences = self.sequences[perm]
-            self.masks = self.masks[perm]
-            self.lengths = self.lengths[perm]
+            self.rng.shuffle(self._order)
 
         return batch_sequences, batch_masks, batch_lengths
 
+    # Save the shuffling state (visiting order, position and random state) to a .npz file
+    def save_shuffle_state(self,fname):
+        rng_state = self.rng.get_state()
+        np.savez(fname, order=self._order, current_index=self._current_index, epochs_completed=self._epochs_completed,
+                rng_keys=rng_state[1], rng_pos=rng_state[2], rng_has_gauss=rng_state[3], rng_cached_gaussian=rng_state[4])
+
+    # Restore the shuffling state saved by save_shuffle_state
+    def load_shuffle_state(self,fname):
+        state = np.load(fname)
+        assert len(state['order']) == self.num_words, fname+" does not match the data"
+        self._order = state['order']
+        self._current_index = int(state['current_index'])
+        self._epochs_completed = int(state['epochs_completed'])
+        self.rng.set_state(('MT19937', state['rng_keys'], int(state['rng_pos']), 
+                            int(state['rng_has_gauss']), float(state['rng_cached_gaussian'])))
+
     # Return entire dataset
     def get_data(self):
         return self.sequences, self.masks, self.lengths
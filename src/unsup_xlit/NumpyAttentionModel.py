@@ -0,0 +1,461 @@
+"""
+Decoding with a trained AttentionModel using NumPy only, on the parameters exported by
+AttentionModel.export_weights. TensorFlow is not needed, and there is no graph to build.
+
+The computation is the same as that of AttentionModel.transliterate_beam in float32, so the outputs
+are the same up to the rounding differences between NumPy and TensorFlow.
+
+The parameters can also be quantized to int8 (see quantize_weights_bundle), to reduce the memory
+used by the model.
+"""
+
+import json
+import numpy as np
+
+def sigmoid(x):
+    ## does not overflow for large negative x, unlike 1/(1+exp(-x))
+    return 0.5*(np.tanh(0.5*x)+1.0)
+
+def log_softmax(x):
+    x=x-np.max(x,axis=-1,keepdims=True)
+    return x-np.log(np.sum(np.exp(x),axis=-1,keepdims=True))
+
+def softmax(x):
+    x=np.exp(x-np.max(x,axis=-1,keepdims=True))
+    return x/np.sum(x,axis=-1,keepdims=True)
+
+def top_k(x, k):
+    """
+    Same as tf.nn.top_k on the rows of 'x': the k largest values of each row in descending order,
+    and their indices. Equal values are in the order of their indices
+
+    Returns a tuple (values, indices), shape: (num_rows x k)
+    """
+    indices=np.argsort(-x,axis=1,kind='mergesort')[:,:k]
+    return x[np.arange(x.shape[0])[:,np.newaxis],indices], indices
+
+class QuantizedMatrix():
+    """
+    An int8 matrix with a float32 scale for each row: row i is values[i]*scales[i]
+    """
+
+    ## size of the blocks of columns converted to float32 by rdot
+    block_bytes=1<<22
+
+    def __init__(self, values, scales):
+        self.values=values
+        self.scales=scales
+        self.shape=values.shape
+        self.block_columns=max(1,self.block_bytes/(4*self.shape[0]))
+
+    def __getitem__(self, ids):
+        """
+        The rows 'ids' (an array of row indices of any shape) as float32
+        """
+        return self.values[ids]*self.scales[ids][...,np.newaxis]
+
+    def rdot(self, x):
+        """
+        np.dot(x, matrix). The scales are applied to x, and the int8 values are converted to float32 one 
+        block of columns at a time (block_bytes), so that the matrix is never held in float32 as a whole
+        """
+        x=x*self.scales
+        if self.block_columns>=self.shape[1]:
+            return np.dot(x,self.values.astype(np.float32))
+        result=np.empty([x.shape[0],self.shape[1]],dtype=np.float32)
+        for start in xrange(0,self.shape[1],self.block_columns):
+            end=start+self.block_columns
+            result[:,start:end]=np.dot(x,self.values[:,start:end].astype(np.float32))
+        return result
+
+def matmul(x, W):
+    """
+    np.dot(x, W) for a float32 array or QuantizedMatrix W
+    """
+    if isinstance(W,QuantizedMatrix):
+        return W.rdot(x)
+    return np.dot(x,W)
+
+def quantize_rows(x):
+    """
+    Symmetric int8 quantization of each row of 'x' with its own scale, so that the largest absolute
+    value in the row is 127
+
+    Returns a tuple (values, scales): int8 array of the shape of x, and float32 array of shape (num_rows)
+    """
+    scales=np.max(np.abs(x),axis=1)/127.0
+    scales[scales==0.0]=1.0
+    values=np.clip(np.round(x/scales[:,np.newaxis]),-127,127).astype(np.int8)
+    return values, scales.astype(np.float32)
+
+def lstm_cell(W, b, x, state):
+    """
+    One step of tf.nn.rnn_cell.BasicLSTMCell (forget bias 1.0, state_is_tuple=False)
+
+    W, b: the Matrix and Bias variables of the cell (W can be a QuantizedMatrix)
+    x: input, shape: (batch_size x input_size)
+    state: concatenation of the cell state and output, shape: (batch_size x 2*num_units)
+
+    Returns a tuple (output, state)
+    """
+    num_units=W.shape[1]/4
+    c, h = state[:,:num_units], state[:,num_units:]
+    i, j, f, o = np.split(matmul(np.concatenate([x,h],axis=1),W)+b,4,axis=1)
+    new_c=c*sigmoid(f+1.0)+sigmoid(i)*np.tanh(j)
+    new_h=np.tanh(new_c)*sigmoid(o)
+    return new_h, np.concatenate([new_c,new_h],axis=1)
+
+def run_lstm(W, b, x, sequence_lengths):
+    """
+    Same as tf.nn.dynamic_rnn with the BasicLSTMCell 'W', 'b' and sequence_length: the outputs after
+    the end of each sequence are zero, and the final state is the state at the end of the sequence
+
+    x: inputs, shape: (batch_size x num_steps x input_size)
+
+    Returns a tuple (outputs, state), with outputs of shape (batch_size x num_steps x num_units)
+    """
+    batch_size, num_steps, _ = x.shape
+    num_units=W.shape[1]/4
+    state=np.zeros([batch_size,2*num_units],dtype=np.float32)
+    outputs=np.zeros([batch_size,num_steps,num_units],dtype=np.float32)
+    for t in xrange(num_steps):
+        valid=(t<sequence_lengths)[:,np.newaxis]
+        output, new_state = lstm_cell(W,b,x[:,t,:],state)
+        outputs[:,t,:]=np.where(valid,output,0.0)
+        state=np.where(valid,new_state,state)
+    return outputs, state
+
+def reverse_sequences(x, sequence_lengths):
+    """
+    Same as tf.reverse_sequence: reverse the first sequence_lengths[i] steps of each sequence i in x
+    (shape: batch_size x num_steps x size)
+    """
+    num_steps=x.shape[1]
+    steps=np.arange(num_steps)[np.newaxis,:]
+    lengths=sequence_lengths[:,np.newaxis]
+    indices=np.where(steps<lengths,lengths-1-steps,steps)
+    return x[np.arange(x.shape[0])[:,np.newaxis],indices]
+
+def load_weights_bundle(fname):
+    """
+    Load the parameters saved by AttentionModel.export_weights
+
+    Returns a tuple (header, arrays): the header dictionary and a dictionary of the arrays by name
+    """
+    bundle=np.load(fname)
+    header=json.loads(str(bundle['header']))
+    arrays=dict([ (name,bundle[name]) for name in bundle.files if name!='header' ])
+    return header, arrays
+
+def is_quantized_weight(name):
+    """
+    Is the exported parameter 'name' quantized by quantize_weights_bundle: the embeddings, the
+    LSTM matrices and the output layers
+    """
+    return name.startswith(('embed_W_','embed_outW_','out_W_')) or \
+            name in ['encoder_W','encoder_fw_W','encoder_bw_W','decoder_W']
+
+def quantize_weights_bundle(in_fname, out_fname):
+    """
+    Post-training quantization of the parameters exported by AttentionModel.export_weights. The
+    embeddings, LSTM matrices and output layers (see is_quantized_weight) are stored as int8 with a
+    float32 scale for each row (see quantize_rows), under '<name>' and '<name>_scales'. The names of
+    the quantized parameters are listed in the header. The other parameters are kept in float32.
+    NumpyAttentionModel loads either file
+    """
+    header, arrays = load_weights_bundle(in_fname)
+    header['quantized']=sorted([ name for name in arrays if is_quantized_weight(name) ])
+    for name in header['quantized']:
+        arrays[name], arrays[name+'_scales'] = quantize_rows(arrays[name])
+    np.savez(out_fname,header=np.array(json.dumps(header)),**arrays)
+
+class NumpyAttentionModel():
+
+    def __init__(self,fname):
+        """
+        fname: parameters of the trained model, exported by AttentionModel.export_weights, or
+               quantized by quantize_weights_bundle
+        """
+        header, self.weights = load_weights_bundle(fname)
+        for name in header.get('quantized',[]):
+            self.weights[name]=QuantizedMatrix(self.weights[name],self.weights.pop(name+'_scales'))
+
+        self.enc_type=header['enc_type']
+        self.use_attention=self.enc_type not in ['simple_lstm_noattn','simple_lstm_noattn_dynamic']
+        self.embedding_size=header['embedding_size']
+        self.enc_rnn_size=header['enc_rnn_size']
+        self.dec_rnn_size=header['dec_rnn_size']
+        self.max_sequence_length=header['max_sequence_length']
+        self.attention=header['attention']
+        self.attention_window=header['attention_window']
+        self.source_prefix_length=header.get('source_prefix_length',0)
+        self.lang_list=header['langs']
+        self.symbols=header['symbols']
+        self.maxpool_width=header.get('maxpool_width')
+        self.mask_padding=header.get('mask_padding')
+
+        self.dec_state_size=self.weights['state_adapt_W'].shape[1]
+        if self.enc_type in ['cnn','cnn_masked']:
+            self.filter_sizes=sorted([ int(name[len('encoder_W_'):]) for name in self.weights
+                                            if name.startswith('encoder_W_') ])
+        self.ctxvec_size=self.weights['attn_W'].shape[0]-self.dec_state_size-self.embedding_size
+
+    def get_weights_nbytes(self):
+        """
+        Memory used by the parameters, in bytes
+        """
+        return sum([ w.values.nbytes+w.scales.nbytes if isinstance(w,QuantizedMatrix) else w.nbytes
+                        for w in self.weights.itervalues() ])
+
+    def get_lang_param(self, name, lang):
+        return self.weights['{}_{}'.format(name,lang)]
+
+    def get_symbol_index(self, lang, symbol):
+        return self.symbols[lang][symbol]
+
+    def lookup_embeddings(self, name, lang, ids):
+        return self.get_lang_param(name+'W',lang)[ids]+self.get_lang_param(name+'b',lang)
+
+    def encode_cnn(self, sequence_embeddings, sequence_lengths):
+        """
+        Same as encoders.CNNEncoder.encode. The convolutions and max pooling use SAME padding
+        """
+        batch_size, num_steps, _ = sequence_embeddings.shape
+        masks=None
+        if self.mask_padding:
+            lengths=np.minimum(sequence_lengths,num_steps)
+            masks=(np.arange(num_steps)[np.newaxis,:]<lengths[:,np.newaxis]).astype(np.float32)[:,:,np.newaxis]
+            sequence_embeddings=sequence_embeddings*masks
+
+        pooled_outputs=[]
+        for filter_size in self.filter_sizes:
+            W=self.weights['encoder_W_{}'.format(filter_size)]
+            b=self.weights['encoder_b_{}'.format(filter_size)]
+
+            ## convolution: each filter position is a matmul over the whole batch
+            pad_left=(filter_size-1)/2
+            x=np.pad(sequence_embeddings,[(0,0),(pad_left,filter_size-1-pad_left),(0,0)],'constant')
+            conv=b+sum([ np.dot(x[:,k:k+num_steps,:],W[k]) for k in xrange(filter_size) ])
+            h=np.maximum(conv,0.0)
+            if masks is not None:
+                h=h*masks
+
+            ## max pooling over time; the padding never gives the maximum
+            pad_left=(self.maxpool_width-1)/2
+            x=np.pad(h,[(0,0),(pad_left,self.maxpool_width-1-pad_left),(0,0)],'constant',constant_values=-np.inf)
+            pooled_outputs.append(np.max([ x[:,k:k+num_steps,:] for k in xrange(self.maxpool_width) ],axis=0))
+
+        enc_outputs=np.concatenate(pooled_outputs,axis=2)
+
+        if self.mask_padding:
+            states=np.sum(enc_outputs*masks,axis=1)/np.maximum(lengths,1)[:,np.newaxis].astype(np.float32)
+        else:
+            states=np.mean(enc_outputs,axis=1)
+
+        return states, enc_outputs
+
+    def compute_hidden_representation(self, sequences, sequence_lengths, lang):
+        """
+        Encode 'sequences' (shape: batch_size x max_sequence_length) of language 'lang'
+
+        Returns a tuple (states, enc_outputs)
+          states: final state of the encoder, shape: (batch_size x encoder_state_size)
+          enc_outputs: encoder outputs, shape: (batch_size x num_steps x enc_output_size). The RNN
+                       encoders are run up to the longest sequence in the batch only
+        """
+        sequence_embeddings=self.lookup_embeddings('embed_',lang,sequences)
+
+        if self.enc_type in ['cnn','cnn_masked']:
+            return self.encode_cnn(sequence_embeddings,sequence_lengths)
+
+        x=sequence_embeddings[:,:np.max(sequence_lengths),:]
+        if self.enc_type in ['simple_lstm_noattn','simple_lstm_noattn_dynamic']:
+            enc_outputs, states = run_lstm(self.weights['encoder_W'],self.weights['encoder_b'],x,sequence_lengths)
+        elif self.enc_type in ['bilstm','bilstm_dynamic']:
+            fw_outputs, states = run_lstm(self.weights['encoder_fw_W'],self.weights['encoder_fw_b'],x,sequence_lengths)
+            bw_outputs, _ = run_lstm(self.weights['encoder_bw_W'],self.weights['encoder_bw_b'],
+                                    reverse_sequences(x,sequence_lengths),sequence_lengths)
+            enc_outputs=np.concatenate([fw_outputs,reverse_sequences(bw_outputs,sequence_lengths)],axis=2)
+        else:
+            raise ValueError('Unknown encoder: {}'.format(self.enc_type))
+
+        return states, enc_outputs
+
+    def precompute_attention_inputs(self, enc_outputs, sequence_lengths):
+        """
+        Same as AttentionModel.precompute_attention_inputs
+
+        Returns a tuple (ctx_vecs, enc_attn_term, attn_mask, ctx_lengths)
+        """
+        num_ctx_vec=np.max(sequence_lengths)
+        ctx_vecs=enc_outputs[:,:num_ctx_vec,:]
+        attn_W_enc=self.weights['attn_W'][self.dec_state_size+self.embedding_size:,:]
+        enc_attn_term=np.dot(ctx_vecs,attn_W_enc)[:,:,0]+self.weights['attn_b']
+        attn_mask=np.where(np.arange(num_ctx_vec)[np.newaxis,:]<sequence_lengths[:,np.newaxis],0.0,-1e9).astype(np.float32)
+        return ctx_vecs, enc_attn_term, attn_mask, sequence_lengths
+
+    def select_attention_window(self, attn_inputs, step):
+        """
+        Same as AttentionModel.select_attention_window
+        """
+        ctx_vecs, enc_attn_term, _, ctx_lengths = attn_inputs
+        batch_size, num_ctx_vec = enc_attn_term.shape
+
+        centers=np.maximum(np.minimum(step+self.source_prefix_length,ctx_lengths-1),0)
+        positions=centers[:,np.newaxis]+np.arange(-self.attention_window,self.attention_window+1)[np.newaxis,:]
+        in_sequence=np.logical_and(positions>=0,positions<ctx_lengths[:,np.newaxis])
+        attn_mask=np.where(in_sequence,0.0,-1e9).astype(np.float32)
+
+        positions=np.minimum(np.maximum(positions,0),num_ctx_vec-1)
+        rows=np.arange(batch_size)[:,np.newaxis]
+        return ctx_vecs[rows,positions], enc_attn_term[rows,positions], attn_mask
+
+    def compute_attention_context(self, prev_state, prev_out_embed, attn_inputs, step):
+        """
+        Same as AttentionModel.compute_attention_context: the rows of prev_state are the beams of
+        each input, and share its attention inputs
+
+        Returns the context vectors, shape: (number of rows of prev_state x enc_output_size)
+        """
+        if self.attention=='local':
+            ctx_vecs, enc_attn_term, attn_mask = self.select_attention_window(attn_inputs,step)
+        else:
+            ctx_vecs, enc_attn_term, attn_mask, _ = attn_inputs
+        batch_size, num_ctx_vec = enc_attn_term.shape
+
+        attn_W_dec=self.weights['attn_W'][:self.dec_state_size+self.embedding_size,:]
+        dec_attn_term=np.dot(np.concatenate([prev_state,prev_out_embed],axis=1),attn_W_dec)
+
+        ## (batch_size x 1 x num_ctx_vec) + (batch_size x num_beams x 1)
+        scores=np.tanh(enc_attn_term[:,np.newaxis,:]+dec_attn_term.reshape([batch_size,-1,1]))+attn_mask[:,np.newaxis,:]
+        weights=softmax(scores)
+
+        ## (batch_size x num_beams x num_ctx_vec) x (batch_size x num_ctx_vec x ctxvec_size)
+        return np.matmul(weights,ctx_vecs).reshape([-1,self.ctxvec_size])
+
+    def update_beam_search(self, i, scores, prev_outputs, pool_outputs, pool_scores,
+                            batch_size, cur_beam_size, beam_size, topn, target_lang):
+        """
+        Same as AttentionModel.update_beam_search
+
+        Returns a tuple (best_flat_indices, symbols, scores, outputs, pool_outputs, pool_scores)
+        """
+        vocab_size=scores.shape[1]
+        eow_id=self.get_symbol_index(target_lang,'EOW')
+
+        ## the EOW extensions are finished, and are not extended further. All extensions are finished
+        ## at the last position. Masked extensions get score -inf
+        finish_scores_by_instance=np.full_like(scores,-np.inf)
+        if i==self.max_sequence_length-1:
+            finish_scores_by_instance[:]=scores
+        else:
+            finish_scores_by_instance[:,eow_id]=scores[:,eow_id]
+        finish_scores_by_instance=finish_scores_by_instance.reshape([-1,cur_beam_size*vocab_size])
+        live_scores_by_instance=scores.copy()
+        live_scores_by_instance[:,eow_id]=-np.inf
+        live_scores_by_instance=live_scores_by_instance.reshape([-1,cur_beam_size*vocab_size])
+
+        def extend(indices):
+            symbols=indices%vocab_size
+            prev_beams=indices//vocab_size
+            flat_indices=(np.arange(batch_size)[:,np.newaxis]*cur_beam_size+prev_beams).reshape([-1])
+            symbols=symbols.reshape([-1,1])
+            outputs=prev_outputs[flat_indices]
+            outputs[:,i]=symbols[:,0]
+            return flat_indices, symbols, outputs
+
+        #### update the pool of finished candidates, the scores are normalized by the length (including EOW)
+        finish_scores, finish_indices = top_k(finish_scores_by_instance,topn)
+        finish_scores=finish_scores/np.float32(i+1)
+        _, _, finish_outputs = extend(finish_indices)
+
+        cand_scores=np.concatenate([pool_scores,finish_scores],axis=1)
+        cand_outputs=np.concatenate([pool_outputs,finish_outputs.reshape([-1,topn,self.max_sequence_length])],axis=1)
+        pool_scores, pool_indices = top_k(cand_scores,topn)
+        pool_outputs=cand_outputs[np.arange(batch_size)[:,np.newaxis],pool_indices]
+
+        #### compute best-k candidates now
+        best_scores, best_indices = top_k(live_scores_by_instance,beam_size)
+        best_flat_indices, best_symbols, best_outputs = extend(best_indices)
+
+        return best_flat_indices, best_symbols, best_scores.reshape([-1,1]), best_outputs, pool_outputs, pool_scores
+
+    def is_beam_search_done(self, scores, pool_scores, beam_size):
+        """
+        Same as AttentionModel.is_beam_search_done
+        """
+        best_live_scores=np.max(scores.reshape([-1,beam_size]),axis=1)/np.float32(self.max_sequence_length)
+        return np.all(np.min(pool_scores,axis=1)>=best_live_scores)
+
+    def decoder_step(self, prev_symbols_emb, prev_states, attn_inputs, step, target_lang):
+        """
+        Run the decoder for one step, from the embeddings of the previous symbols and the decoder states
+
+        Returns a tuple (log-likelihood of the next symbols, new decoder states)
+        """
+        current_input=prev_symbols_emb
+        if self.use_attention:
+            context=self.compute_attention_context(prev_states,prev_symbols_emb,attn_inputs,step)
+            current_input=np.concatenate([prev_symbols_emb,context],axis=1)
+
+        output, state = lstm_cell(self.weights['decoder_W'],self.weights['decoder_b'],current_input,prev_states)
+        logit_words=matmul(output,self.get_lang_param('out_W',target_lang))+self.get_lang_param('out_b',target_lang)
+        return log_softmax(logit_words), state
+
+    def transliterate_beam(self, source_lang, sequences, sequence_lengths, target_lang, beam_size, topn, early_stop=True):
+        """
+        Same as AttentionModel.transliterate_beam
+
+        sequences: input symbol ids, shape: (batch_size x max_sequence_length)
+        sequence_lengths: length of each input sequence, shape: (batch_size)
+
+        Returns a tuple (final_outputs, final_scores)
+          final_outputs: symbol ids of the topn candidates, shape: (batch_size x topn x max_sequence_length).
+                         The positions after EOW contain PAD
+          final_scores: log-likelihood of the candidates normalized by their length (including EOW),
+                        shape: (batch_size x topn)
+        """
+        sequences=np.asarray(sequences).astype(np.int32)
+        sequence_lengths=np.minimum(np.asarray(sequence_lengths).astype(np.int32),sequences.shape[1])
+
+        #### compute hidden representation first
+        initial_state, enc_outputs = self.compute_hidden_representation(sequences,sequence_lengths,source_lang)
+        initial_state=np.dot(initial_state,self.weights['state_adapt_W'])+self.weights['state_adapt_b']
+
+        ## encoder side of the attention network, computed once for all decoder steps
+        attn_inputs=None
+        if self.use_attention:
+            attn_inputs=self.precompute_attention_inputs(enc_outputs,sequence_lengths)
+
+        ### start decoding
+        batch_size=sequences.shape[0]
+        go_id=self.get_symbol_index(target_lang,'GO')
+        pad_id=self.get_symbol_index(target_lang,'PAD')
+
+        ### the first step generates from the GO symbol, with a single beam for each input
+        prev_states=initial_state
+        prev_outputs=np.full([batch_size,self.max_sequence_length],pad_id,dtype=np.int32)
+        pool_outputs=np.full([batch_size,topn,self.max_sequence_length],pad_id,dtype=np.int32)
+        pool_scores=np.full([batch_size,topn],-np.inf,dtype=np.float32)
+
+        current_emb=self.lookup_embeddings('embed_out',target_lang,np.full([batch_size],go_id,dtype=np.int32))
+        scores, state = self.decoder_step(current_emb,prev_states,attn_inputs,0,target_lang)
+
+        best_flat_indices, prev_symbols, prev_scores, prev_outputs, pool_outputs, pool_scores = \
+                self.update_beam_search(0, scores, prev_outputs, pool_outputs, pool_scores,
+                                        batch_size, 1, beam_size, topn, target_lang)
+        prev_states=state[best_flat_indices]
+
+        ### the remaining steps, until the last position or, with early_stop, until the search is done (see is_beam_search_done)
+        i=1
+        while i<self.max_sequence_length and not (early_stop and self.is_beam_search_done(prev_scores, pool_scores, beam_size)):
+            current_emb=self.lookup_embeddings('embed_out',target_lang,prev_symbols.reshape([-1]))
+            scores, state = self.decoder_step(current_emb,prev_states,attn_inputs,i,target_lang)
+
+            best_flat_indices, prev_symbols, prev_scores, prev_outputs, pool_outputs, pool_scores = \
+                    self.update_beam_search(i, prev_scores+scores, prev_outputs, pool_outputs, pool_scores,
+                                            batch_size, beam_size, beam_size, topn, target_lang)
+            prev_states=state[best_flat_indices]
+            i+=1
+
+        return pool_outputs, pool_scores
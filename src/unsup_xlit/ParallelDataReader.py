@@ -1,15 +1,18 @@
 import numpy as np
-import codecs 
+
+import corpus_cache
+import utilities
 
 class ParallelDataReader():
         # Initializer and data reader
-        def __init__(self, lang1, lang2, filename1, filename2, mapping, max_sequence_length, train_size=-1):
+        def __init__(self, lang1, lang2, filename1, filename2, mapping, max_sequence_length, train_size=-1, cache_dir=None, seed=None):
                 # Taking args and storing as class vars
                 self.lang1 = lang1
                 self.lang2 = lang2
                 self.mapping = mapping
                 self.max_sequence_length = max_sequence_length
                 self.train_size=train_size
+                self.cache_dir=cache_dir
 
                 self.sequences = dict()
                 self.masks = dict()
@@ -29,65 +32,148 @@ class ParallelDataReader():
                 self._current_index = 0
                 
                 #Shuffling data
-                perm = list(np.arange(self.num_words))
-                for lang in [self.lang1,self.lang2]:
-                        self.sequences[lang] = self.sequences[lang][perm]
-                        self.masks[lang] = self.masks[lang][perm]
-                        self.lengths[lang] = self.lengths[lang][perm]
+                # Only the order in which the pairs are visited is shuffled, batches are gathered through it.
+                # The data itself stays in file order (see get_data)
+                self.rng = np.random.RandomState(seed)
+                self._order = np.arange(self.num_words)
+                self.rng.shuffle(self._order)
+
+                # Buckets (see create_buckets)
+                self.bucket_lengths = None
 
         # Reads file with given name and lang
         def read_file(self, filename, lang):
-                # Reading the file
-                file_read = map(lambda x: [u'GO']+(x.strip().split(' '))[:self.max_sequence_length-2]+[u'EOW'],codecs.open(filename,'r','utf-8').readlines())
-                if self.train_size > 0 : 
-                    file_read = file_read[:self.train_size]
-
-                #lengths is list of lengths of all words. i.e. a list of integers with size num_words in dataset 
-                self.lengths[lang] = np.array(map(lambda x: len(x), file_read))
+                # Reading the file and replacing each character with the corresponding character id
+                # sequences are padded with PAD to max_sequence_length
+                # lengths is list of lengths of all words. i.e. a list of integers with size num_words in dataset 
+                self.sequences[lang], self.lengths[lang] = corpus_cache.load_corpus(filename, lang, self.mapping[lang],
+                                                            self.max_sequence_length, self.train_size, self.cache_dir)
                 self.num_words[lang] = len(self.lengths[lang])
 
-                #Adding PAD to the words to make each word length = max_sequence_length
-                file_read = map(lambda x: x+[u'PAD']*(self.max_sequence_length-len(x)),file_read)
-
-                # replacing character with corresponding character id
-                self.sequences[lang] = np.array([[self.mapping[lang].get_index(char,lang) for char in word] for word in file_read], dtype = np.int32)
-
                 # Creating masks. Mask has size = size of list of sequence. 
                 # Corresponding to each PAD character there is a zero, for all other there is a 1
-                self.masks[lang] = np.zeros([self.num_words[lang], self.max_sequence_length],dtype = np.float32)
-                for i in range(self.num_words[lang]):
-                        self.masks[lang][i][:self.lengths[lang][i]]=1
+                self.masks[lang] = (np.arange(self.max_sequence_length)[np.newaxis,:] < self.lengths[lang][:,np.newaxis]).astype(np.float32)
 
-        def get_next_batch(self,batch_size):
+        # Returns next batch of data with given batch size
+        # If tokens_per_batch is not None, the batch is filled with as many pairs as fit in tokens_per_batch 
+        # characters (of both languages, including GO and EOW) instead
+        def get_next_batch(self,batch_size,tokens_per_batch=None):
                 # If epoch was completed in last call, reset current index
                 if(self._current_index >= self.num_words):
                         self._current_index = 0
 
                 start = self._current_index
+                if tokens_per_batch is not None:
+                        batch_size = self._token_batch_size(self._order[start:start+tokens_per_batch], tokens_per_batch)
                 end = min(start + batch_size, self.num_words)
 
                 self._current_index = end
 
-                batch_sequences1 = self.sequences[self.lang1][start:end]
-                batch_masks1 = self.masks[self.lang1][start:end]
-                batch_lengths1 = self.lengths[self.lang1][start:end]
+                # indices are sorted to read memory-mapped data in file order
+                batch_indices = np.sort(self._order[start:end])
 
-                batch_sequences2 = self.sequences[self.lang2][start:end]
-                batch_masks2 = self.masks[self.lang2][start:end]
-                batch_lengths2 = self.lengths[self.lang2][start:end]
+                batch_sequences1 = self.sequences[self.lang1][batch_indices]
+                batch_masks1 = self.masks[self.lang1][batch_indices]
+                batch_lengths1 = self.lengths[self.lang1][batch_indices]
+
+                batch_sequences2 = self.sequences[self.lang2][batch_indices]
+                batch_masks2 = self.masks[self.lang2][batch_indices]
+                batch_lengths2 = self.lengths[self.lang2][batch_indices]
 
                 if(self._current_index >= self.num_words):
                         self._epochs_completed += 1
 
                         # Shuffling as epoch is complete
-                        perm = list(np.arange(self.num_words))
-                        for lang in [self.lang1,self.lang2]:
-                                self.sequences[lang] = self.sequences[lang][perm]
-                                self.masks[lang] = self.masks[lang][perm]
-                                self.lengths[lang] = self.lengths[lang][perm]
+                        self.rng.shuffle(self._order)
 
                 return batch_sequences1, batch_masks1, batch_lengths1, batch_sequences2, batch_masks2, batch_lengths2
 
+        # Number of pairs from the start of 'indices' which fit in tokens_per_batch characters
+        def _token_batch_size(self,indices,tokens_per_batch):
+                pair_lengths = self.lengths[self.lang1][indices] + self.lengths[self.lang2][indices]
+                return utilities.token_batch_size(pair_lengths, tokens_per_batch)
+
+        # Groups the sequence pairs into buckets by length, for use with get_next_bucket_batch
+        # bucket_lengths: list of bucket lengths. max_sequence_length is always used as the largest bucket
+        # src_extra_length: number of symbols which will be added to the source sequences later (e.g. language tokens)
+        def create_buckets(self, bucket_lengths, src_extra_length=0):
+                self.bucket_lengths = sorted(set([ b for b in bucket_lengths if b < self.max_sequence_length ]+[self.max_sequence_length]))
+
+                pair_lengths = np.maximum(self.lengths[self.lang1]+src_extra_length, self.lengths[self.lang2])
+                bucket_ids = np.searchsorted(self.bucket_lengths, pair_lengths)
+                ## pairs which cannot fit in the largest bucket are truncated by it, as without buckets
+                bucket_ids = np.minimum(bucket_ids, len(self.bucket_lengths)-1)
+
+                # indices of the sequence pairs in each bucket (in shuffled order), and the next position to read in each bucket
+                self._bucket_indices = [ self._order[bucket_ids[self._order] == b] for b in range(len(self.bucket_lengths)) ]
+                self._bucket_current_index = [ 0 for _ in self.bucket_lengths ]
+
+        # Returns next batch of data from a randomly chosen bucket. The chance of choosing a bucket
+        # is proportional to the number of pairs in it not yet seen in the current epoch.
+        # The batch is truncated to the bucket length. Returns the bucket length and the batch
+        # tokens_per_batch: see get_next_batch
+        def get_next_bucket_batch(self,batch_size,tokens_per_batch=None):
+                remaining = np.array([ len(indices)-current for indices, current in
+                                        zip(self._bucket_indices, self._bucket_current_index) ], dtype=np.float64)
+
+                # If epoch was completed in last call, reset current indices
+                if remaining.sum() <= 0:
+                        self._bucket_current_index = [ 0 for _ in self.bucket_lengths ]
+                        remaining = np.array([ len(indices) for indices in self._bucket_indices ], dtype=np.float64)
+
+                b = self.rng.choice(len(self.bucket_lengths), p=remaining/remaining.sum())
+                bucket_length = self.bucket_lengths[b]
+
+                start = self._bucket_current_index[b]
+                if tokens_per_batch is not None:
+                        batch_size = self._token_batch_size(self._bucket_indices[b][start:start+tokens_per_batch], tokens_per_batch)
+                end = min(start + batch_size, len(self._bucket_indices[b]))
+                self._bucket_current_index[b] = end
+                batch_indices = np.sort(self._bucket_indices[b][start:end])
+
+                batch_sequences1 = self.sequences[self.lang1][batch_indices,:bucket_length]
+                batch_masks1 = self.masks[self.lang1][batch_indices,:bucket_length]
+                batch_lengths1 = self.lengths[self.lang1][batch_indices]
+
+                batch_sequences2 = self.sequences[self.lang2][batch_indices,:bucket_length]
+                batch_masks2 = self.masks[self.lang2][batch_indices,:bucket_length]
+                batch_lengths2 = self.lengths[self.lang2][batch_indices]
+
+                if all([ current >= len(indices) for indices, current in zip(self._bucket_indices, self._bucket_current_index) ]):
+                        self._epochs_completed += 1
+
+                        # Shuffling as epoch is complete
+                        for indices in self._bucket_indices:
+                                self.rng.shuffle(indices)
+
+                return bucket_length, (batch_sequences1, batch_masks1, batch_lengths1, batch_sequences2, batch_masks2, batch_lengths2)
+
+        # Save the shuffling state (visiting order, position and random state) to a .npz file
+        def save_shuffle_state(self,fname):
+                rng_state = self.rng.get_state()
+                state = dict(order=self._order, current_index=self._current_index, epochs_completed=self._epochs_completed,
+                        rng_keys=rng_state[1], rng_pos=rng_state[2], rng_has_gauss=rng_state[3], rng_cached_gaussian=rng_state[4])
+                if self.bucket_lengths is not None:
+                        state['bucket_lengths'] = self.bucket_lengths
+                        state['bucket_sizes'] = [ len(indices) for indices in self._bucket_indices ]
+                        state['bucket_order'] = np.concatenate(self._bucket_indices)
+                        state['bucket_current_index'] = self._bucket_current_index
+                np.savez(fname, **state)
+
+        # Restore the shuffling state saved by save_shuffle_state
+        def load_shuffle_state(self,fname):
+                state = np.load(fname)
+                assert len(state['order']) == self.num_words, fname+" does not match the data"
+                self._order = state['order']
+                self._current_index = int(state['current_index'])
+                self._epochs_completed = int(state['epochs_completed'])
+                self.rng.set_state(('MT19937', state['rng_keys'], int(state['rng_pos']), 
+                                    int(state['rng_has_gauss']), float(state['rng_cached_gaussian'])))
+                if self.bucket_lengths is not None:
+                        assert list(state['bucket_lengths']) == list(self.bucket_lengths), fname+" does not match the buckets"
+                        self._bucket_indices = np.split(state['bucket_order'], np.cumsum(state['bucket_sizes'])[:-1])
+                        self._bucket_current_index = [ int(x) for x in state['bucket_current_index'] ]
+
         # Return entire data
         def get_data(self):
                 return self.sequences[self.lang1], self.masks[self.lang1], self.lengths[self.lang1], self.sequences[self.lang2], self.masks[self.lang2], self.lengths[self.lang2]
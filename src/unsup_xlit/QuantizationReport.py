@@ -0,0 +1,174 @@
+"""
+Accuracy and speed of the int8 quantized parameters (ModelQuantize.py) against the float parameters
+(ModelExport.py) of the same model, decoding a test set with NumpyAttentionModel.
+
+Both are scored on the n-best lists with the NEWS shared task measures for a single reference:
+ACC (top-1 accuracy) and MRR (mean reciprocal rank of the reference in the n-best list). The report
+also gives the fraction of the inputs for which the quantized model has the same 1-best candidate as
+the float model, and the difference of the 1-best scores. With --out_prefix, the n-best lists are
+written in the format of ModelDecoding.py, so they can be scored with the NEWS evaluation scripts too.
+"""
+
+import argparse
+import codecs
+import sys
+import time
+
+import numpy as np
+
+import Mapping
+import MonoDataReader
+import NumpyAttentionModel
+import utilities
+
+from indicnlp import loader
+
+def decode(model, mapping, sequences, sequence_lengths, source_lang, target_lang, args):
+    """
+    Decode all the sequences in batches, like ModelDecodingNumpy.py
+
+    Returns a tuple (predicted_sents, predicted_scores, decode_time)
+      predicted_sents: list of the candidate words, args.topn consecutive candidates for each input
+      predicted_scores: scores of the candidates, shape: (num_inputs x topn)
+    """
+    decode_time=0.0
+    sequence_masks=(np.arange(sequences.shape[1])[np.newaxis,:]<sequence_lengths[:,np.newaxis]).astype(np.float32)
+    predicted_sequences_ids_list=[]
+    predicted_scores_list=[]
+
+    for start, end in utilities.batch_boundaries(sequence_lengths,args.batch_size,args.tokens_per_batch):
+
+        batch_start_time=time.time()
+
+        data_sequences=sequences[start:end,:]
+        data_sequence_masks=sequence_masks[start:end,:]
+        data_sequence_lengths=sequence_lengths[start:end]
+
+        if args.prefix_tgtlang:
+            data_sequences,data_sequence_masks,data_sequence_lengths = Mapping.prefix_sequence_with_token(
+                    data_sequences,data_sequence_masks,data_sequence_lengths,
+                    target_lang,mapping[target_lang])
+
+        if args.prefix_srclang:
+            data_sequences,data_sequence_masks,data_sequence_lengths = Mapping.prefix_sequence_with_token(
+                    data_sequences,data_sequence_masks,data_sequence_lengths,
+                    source_lang,mapping[source_lang])
+
+        b_sequences_ids, b_scores = model.transliterate_beam(source_lang,data_sequences,data_sequence_lengths,
+                                                            target_lang,args.beam_size,args.topn)
+        predicted_sequences_ids_list.append(b_sequences_ids)
+        predicted_scores_list.append(b_scores)
+
+        decode_time+=time.time()-batch_start_time
+
+    predicted_sequences_ids=np.concatenate(predicted_sequences_ids_list,axis=0)
+    predicted_scores=np.concatenate(predicted_scores_list,axis=0)
+
+    num_sents, num_ranks, _ = predicted_sequences_ids.shape
+    predicted_sents=mapping[target_lang].decode_batch(predicted_sequences_ids.reshape([num_sents*num_ranks,-1]),target_lang)
+    return predicted_sents, predicted_scores, decode_time
+
+def score_nbest(predicted_sents, num_ranks, references):
+    """
+    ACC and MRR of the n-best lists against one reference for each input
+
+    Returns a tuple (acc, mrr)
+    """
+    reciprocal_ranks=[]
+    for sent_no, reference in enumerate(references):
+        nbest=predicted_sents[sent_no*num_ranks:(sent_no+1)*num_ranks]
+        reciprocal_ranks.append(1.0/(nbest.index(reference)+1) if reference in nbest else 0.0)
+    reciprocal_ranks=np.array(reciprocal_ranks)
+    return np.mean(reciprocal_ranks==1.0), np.mean(reciprocal_ranks)
+
+if __name__ == '__main__' :
+
+    #### Load Indic NLP Library ###
+    ## Note: Environment variable: INDIC_RESOURCES_PATH must be set
+    loader.load()
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--batch_size', type = int, default = 100, help = 'size of each batch used in decoding')
+    parser.add_argument('--tokens_per_batch', type = int, default = None, help = 'fill each batch with as many sequences as fit in this number of characters (including the GO and EOW symbols), instead of a fixed number of sequences. --batch_size is not used if this is set')
+
+    parser.add_argument('--prefix_tgtlang', action='store_true', default = False,
+            help = 'Prefix the input sequence with the language code for the target language')
+    parser.add_argument('--prefix_srclang', action='store_true', default = False,
+            help = 'Prefix the input sequence with the language code for the source language')
+
+    parser.add_argument('--representation', type = str, default = 'onehot',  help = 'input representation, which can be specified in two ways: (i) one of "phonetic", "onehot", "onehot_and_phonetic"')
+    parser.add_argument('--shared_mapping_class', type = str, default = 'IndicPhoneticMapping',  help = 'class to be used for shared mapping. Possible values: IndicPhoneticMapping, CharacterMapping')
+
+    parser.add_argument('--topn', type = int, default = 10, help = 'The top-n candidates to report')
+    parser.add_argument('--beam_size', type = int, default = 5, help = 'beam size for decoding')
+
+    parser.add_argument('--lang_pair', type = str, help = 'language pair for decoding: "lang1-lang2"')
+
+    parser.add_argument('--weights_fname', type = str, help = 'file with the parameters exported by ModelExport.py')
+    parser.add_argument('--quantized_weights_fname', type = str, help = 'file with the parameters quantized by ModelQuantize.py')
+    parser.add_argument('--mapping_dir', type = str, help = 'directory containing mapping files')
+    parser.add_argument('--in_fname', type = str, help = 'input file of the test set')
+    parser.add_argument('--ref_fname', type = str, default = None, help = 'reference file of the test set: one reference for each input, with the characters separated by space. ACC and MRR are not reported if not given')
+    parser.add_argument('--out_prefix', type = str, default = None, help = 'if given, the n-best lists are written to <out_prefix>.float and <out_prefix>.int8')
+
+    args = parser.parse_args()
+
+    print '========== Parameters start ==========='
+    for k,v in vars(args).iteritems():
+        print '{}: {}'.format(k,v)
+    print '========== Parameters end ============='
+
+    lang_pair=tuple(args.lang_pair.split('-'))
+    source_lang = lang_pair[0]
+    target_lang = lang_pair[1]
+
+    ### parse representation argument
+    if args.representation in ['onehot','onehot_shared','phonetic','onehot_and_phonetic']:
+        representation = {}
+        for lang in lang_pair:
+            representation[lang]=args.representation
+    else:
+        representation = dict([ x.split(':') for x in args.representation.split(',') ])
+
+    mapping = Mapping.load_mappings(args.mapping_dir,representation,args.shared_mapping_class)
+
+    references=None
+    if args.ref_fname is not None:
+        with codecs.open(args.ref_fname,'r','utf-8') as infile:
+            references=[ line.strip() for line in infile ]
+
+    results={}
+    for name, fname in [('float',args.weights_fname),('int8',args.quantized_weights_fname)]:
+        start_time=time.time()
+        model=NumpyAttentionModel.NumpyAttentionModel(fname)
+        load_time=time.time()-start_time
+
+        ## the test data is read again for each model, since it is encoded for the model's max_sequence_length
+        test_data=MonoDataReader.MonoDataReader(source_lang,args.in_fname,mapping[source_lang],model.max_sequence_length)
+        sequences, _, sequence_lengths = test_data.get_data()
+
+        predicted_sents, predicted_scores, decode_time = decode(model,mapping,sequences,sequence_lengths,
+                                                                source_lang,target_lang,args)
+        results[name]=(model.get_weights_nbytes(),load_time,decode_time,predicted_sents,predicted_scores)
+
+        if args.out_prefix is not None:
+            utilities.write_nbest_output('{}.{}'.format(args.out_prefix,name),predicted_sents,predicted_scores)
+
+        print 'Decoded {} sequences with the {} parameters'.format(sequences.shape[0],name)
+        sys.stdout.flush()
+
+    num_sents, num_ranks = results['float'][4].shape
+    float_1best=results['float'][3][::num_ranks]
+
+    print '========== Report start ==========='
+    print 'Test set: {} ({} sequences)'.format(args.in_fname,num_sents)
+    print 'model|parameters (MB)|load time (s)|decoding time (s)|sequences/s|ACC|MRR|same 1-best as float|max 1-best score difference'
+    for name in ['float','int8']:
+        nbytes, load_time, decode_time, predicted_sents, predicted_scores = results[name]
+        acc, mrr = score_nbest(predicted_sents,num_ranks,references) if references is not None else (np.nan,np.nan)
+        same_1best=np.mean([ a==b for a, b in zip(predicted_sents[::num_ranks],float_1best) ])
+        score_diff=np.max(np.abs(predicted_scores[:,0]-results['float'][4][:,0]))
+        print '{}|{:.2f}|{:.3f}|{:.3f}|{:.2f}|{:.4f}|{:.4f}|{:.4f}|{:.4f}'.format(name,nbytes/float(1<<20),load_time,decode_time,
+                num_sents/decode_time,acc,mrr,same_1best,score_diff)
+    print '========== Report end ============='
@@ -0,0 +1,168 @@
+import itertools as it
+import codecs
+
+import numpy as np
+
+import Mapping
+
+class StreamingDataReader(object):
+    """
+    Out-of-core reader for one or more line-aligned streams of sequences (e.g. the two sides of a parallel corpus).
+
+    Each stream is a list of shard files which are read lazily, one line at a time. Sequences
+    are drawn at random from an in-memory buffer holding at most 'buffer_size' examples, so the
+    full corpus is never materialized. Only the first 'train_size' lines are used if train_size > 0.
+    """
+
+    def __init__(self, langs, shards, mappings, max_sequence_length, train_size=-1, buffer_size=10000, seed=None):
+        """
+        langs: list of languages, one for each stream
+        shards: list of shard file lists, one for each stream. The shards of all streams must be line aligned.
+                A single file name can also be given instead of a list
+        mappings: list of mapping objects, one for each stream
+        """
+        self.langs = langs
+        self.shards = [ [s] if isinstance(s,basestring) else list(s) for s in shards ]
+        self.mappings = mappings
+        self.max_sequence_length = max_sequence_length
+        self.train_size = train_size
+        self.buffer_size = buffer_size
+        self.rng = np.random.RandomState(seed)
+
+        # One pass over the data to count the sequences, and to collect the
+        # vocabulary if the mappings are still in update mode
+        num_lines = []
+        for lang, stream_shards, mapping in zip(self.langs, self.shards, self.mappings):
+            n = 0
+            stream = self._read_stream(stream_shards)
+            while True:
+                words = list(it.islice(stream, self.buffer_size))
+                if len(words) == 0:
+                    break
+                if mapping.update_mode:
+                    mapping.encode_batch(words, lang, self.max_sequence_length)
+                n += len(words)
+            num_lines.append(n)
+
+        # For parallel data, number of words must be same for all streams
+        assert len(set(num_lines)) == 1, ' and '.join([','.join(s) for s in self.shards])+' are of unequal lengths'
+        self.num_words = num_lines[0]
+
+        # Vars for batch handling
+        self._epochs_completed = 0
+        self._buffer = []
+        self._stream = None
+        self._stream_exhausted = True
+
+    def _read_stream(self, stream_shards):
+        """
+        Generator over the words in the shards, stops after train_size words
+        """
+        lines = it.chain.from_iterable( codecs.open(fname,'r','utf-8') for fname in stream_shards )
+        if self.train_size > 0 :
+            lines = it.islice(lines, self.train_size)
+        for line in lines:
+            # NOTE: -2 should be -1
+            yield [Mapping.Mapping.GO]+(line.strip().split(' '))[:self.max_sequence_length-2]+[Mapping.Mapping.EOW]
+
+    def _start_epoch(self):
+        # shards are visited in a different order in every epoch
+        shard_order = self.rng.permutation(len(self.shards[0]))
+        streams = [ self._read_stream([stream_shards[i] for i in shard_order]) for stream_shards in self.shards ]
+        self._stream = it.izip(*streams)
+        self._stream_exhausted = False
+
+    def _fill_buffer(self):
+        # the buffer is refilled in chunks, once it is less than half full
+        if self._stream_exhausted or len(self._buffer) > self.buffer_size // 2:
+            return
+
+        examples = list(it.islice(self._stream, self.buffer_size - len(self._buffer)))
+        if len(examples) < self.buffer_size - len(self._buffer):
+            self._stream_exhausted = True
+        if len(examples) == 0:
+            return
+
+        # encode each stream of the new examples at once
+        encoded = [ zip(*mapping.encode_batch(words, lang, self.max_sequence_length))
+                        for words, lang, mapping in zip(zip(*examples), self.langs, self.mappings) ]
+        self._buffer.extend( [ list(example) for example in zip(*encoded) ] )
+
+    def get_next_examples(self, batch_size, tokens_per_batch=None):
+        """
+        Returns a list of at most batch_size examples. Each example is a list with one
+        (sequence, length) tuple per stream. A batch never crosses an epoch boundary
+
+        If tokens_per_batch is not None, the batch is filled with as many examples as fit in
+        tokens_per_batch characters (of all streams) instead. At least one example is returned
+        """
+        if self._stream_exhausted and len(self._buffer) == 0:
+            self._start_epoch()
+
+        examples = []
+        num_tokens = 0
+        while tokens_per_batch is not None or len(examples) < batch_size:
+            self._fill_buffer()
+            if len(self._buffer) == 0:
+                break
+            # draw a random example from the buffer
+            i = self.rng.randint(len(self._buffer))
+            self._buffer[i], self._buffer[-1] = self._buffer[-1], self._buffer[i]
+            if tokens_per_batch is not None:
+                example_tokens = sum([ length for _, length in self._buffer[-1] ])
+                if len(examples) > 0 and num_tokens + example_tokens > tokens_per_batch:
+                    # the drawn example stays in the buffer for the next batch
+                    break
+                num_tokens += example_tokens
+            examples.append(self._buffer.pop())
+
+        if self._stream_exhausted and len(self._buffer) == 0:
+            self._epochs_completed += 1
+
+        return examples
+
+    def get_next_stream_batches(self, batch_size, tokens_per_batch=None):
+        """
+        Returns a list with a tuple (sequences, masks, lengths) for each stream
+        """
+        examples = self.get_next_examples(batch_size, tokens_per_batch)
+        batches = []
+        for s in range(len(self.langs)):
+            sequences = np.array([ x[s][0] for x in examples ],dtype=np.int32).reshape([-1,self.max_sequence_length])
+            lengths = np.array([ x[s][1] for x in examples ],dtype=np.int32)
+            masks = (np.arange(self.max_sequence_length)[np.newaxis,:] < lengths[:,np.newaxis]).astype(np.float32)
+            batches.append((sequences, masks, lengths))
+        return batches
+
+class StreamingMonoDataReader(StreamingDataReader):
+    """
+    Streaming counterpart of MonoDataReader
+    """
+
+    def __init__(self, lang, filename, mapping, max_sequence_length, train_size=-1, buffer_size=10000, seed=None):
+        self.lang = lang
+        self.mapping = mapping
+        super(StreamingMonoDataReader, self).__init__([lang], [filename], [mapping],
+                max_sequence_length, train_size, buffer_size, seed)
+
+    # Returns next batch of data with given batch size
+    def get_next_batch(self,batch_size,tokens_per_batch=None):
+        return self.get_next_stream_batches(batch_size,tokens_per_batch)[0]
+
+class StreamingParallelDataReader(StreamingDataReader):
+    """
+    Streaming counterpart of ParallelDataReader
+    """
+
+    def __init__(self, lang1, lang2, filename1, filename2, mapping, max_sequence_length, train_size=-1, buffer_size=10000, seed=None):
+        self.lang1 = lang1
+        self.lang2 = lang2
+        self.mapping = mapping
+        super(StreamingParallelDataReader, self).__init__([lang1,lang2], [filename1,filename2], [mapping[lang1],mapping[lang2]],
+                max_sequence_length, train_size, buffer_size, seed)
+
+    # Returns next batch of data with given batch size
+    def get_next_batch(self,batch_size,tokens_per_batch=None):
+        (batch_sequences1, batch_masks1, batch_lengths1), (batch_sequences2, batch_masks2, batch_lengths2) = \
+                self.get_next_stream_batches(batch_size,tokens_per_batch)
+        return batch_sequences1, batch_masks1, batch_lengths1, batch_sequences2, batch_masks2, batch_lengths2
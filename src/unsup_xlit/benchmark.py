@@ -0,0 +1,152 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import AttentionModel
+import Mapping
+import utilities
+
+"""
+Measures the training and decoding speed of the attention model on synthetic data.
+
+No data, mapping or trained model is needed: a vocabulary of synthetic characters is created for
+two languages and random words are generated. Run on two versions of the code to compare them, e.g.
+
+    python benchmark.py --enc_type cnn --batch_size 32 > before.txt
+"""
+
+def create_mapping(lang,vocab_size):
+    """
+    CharacterMapping with vocab_size synthetic characters, in addition to the special symbols
+    """
+    mapping=Mapping.CharacterMapping()
+    for k in xrange(vocab_size):
+        mapping.get_index(unichr(0x100+k),lang)
+    mapping.finalize_vocab()
+    return mapping
+
+def create_batch(mapping,lang,vocab_size,batch_size,max_sequence_length,rng,max_word_length=None):
+    """
+    Random words with lengths uniformly distributed between 1 and max_word_length characters 
+    (max_sequence_length-2 if not given)
+
+    Returns a tuple (sequences, masks, lengths)
+    """
+    if max_word_length is None: 
+        max_word_length=max_sequence_length-2
+    word_lengths=rng.randint(1,max_word_length+1,size=batch_size)
+    words=[ [Mapping.Mapping.GO]+[ unichr(0x100+k) for k in rng.randint(0,vocab_size,size=l) ]+[Mapping.Mapping.EOW]
+                for l in word_lengths ]
+    sequences, lengths = mapping.encode_batch(words,lang,max_sequence_length)
+    masks = (np.arange(max_sequence_length)[np.newaxis,:] < lengths[:,np.newaxis]).astype(np.float32)
+    return sequences, masks, lengths
+
+if __name__ == '__main__' :
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--enc_type', type = str, default = 'cnn',  help = 'encoder to use. One of (1) simple_lstm_noattn (2) bilstm (3) cnn (4) cnn_masked: cnn, with the PAD positions masked out of the convolutions and the final state (5) simple_lstm_noattn_dynamic (6) bilstm_dynamic: same as (1) and (2), but the RNN is run in a loop up to the longest sequence in the batch')
+    parser.add_argument('--attention', type = str, default = 'global',  help = 'attention mechanism. One of (1) global: the decoder attends over all the positions of the source sequence (2) local: the decoder attends over the positions within --attention_window of a center which advances with the decoder step. Decoding has to use the same setting as training')
+    parser.add_argument('--attention_window', type = int, default = 3, help = 'half width of the window of local attention: 2*attention_window+1 positions are attended')
+    parser.add_argument('--embedding_size', type = int, default = 256, help = 'size of character representation')
+    parser.add_argument('--enc_rnn_size', type = int, default = 512, help = 'size of output of encoder RNN')
+    parser.add_argument('--dec_rnn_size', type = int, default = 512, help = 'size of output of dec RNN')
+    parser.add_argument('--vocab_size', type = int, default = 60, help = 'number of characters in the vocabulary of each language')
+
+    parser.add_argument('--max_seq_length', type = int, default = 30, help = 'maximum sequence length')
+    parser.add_argument('--max_word_length', type = int, default = None, help = 'maximum length of the synthetic words (without GO and EOW). Default: max_seq_length-2')
+    parser.add_argument('--batch_size', type = int, default = 32, help = 'size of each training batch')
+    parser.add_argument('--decode_batch_size', type = int, default = 100, help = 'size of each decoding batch')
+    parser.add_argument('--beam_size', type = int, default = 5, help = 'beam size for decoding')
+    parser.add_argument('--topn', type = int, default = 10, help = 'the number of best candidates to output by the decoder')
+
+    parser.add_argument('--train_steps', type = int, default = 50, help = 'number of timed training steps')
+    parser.add_argument('--decode_steps', type = int, default = 20, help = 'number of timed decoding batches')
+    parser.add_argument('--warmup_steps', type = int, default = 3, help = 'number of untimed steps run before timing')
+    parser.add_argument('--seed', type = int, default = 1, help = 'seed for generating the synthetic data')
+
+    args = parser.parse_args()
+
+    print '========== Parameters start ==========='
+    for k,v in vars(args).iteritems():
+        print '{}: {}'.format(k,v)
+    print '========== Parameters end ============='
+
+    src_lang, tgt_lang = 'en', 'hi'
+    max_sequence_length = args.max_seq_length
+    rng = np.random.RandomState(args.seed)
+
+    mapping = dict([ (lang,create_mapping(lang,args.vocab_size)) for lang in [src_lang,tgt_lang] ])
+    representation = dict([ (lang,'onehot') for lang in [src_lang,tgt_lang] ])
+
+    ###################################################################
+    #    Interacting with model and creating computation graph        #
+    ###################################################################
+
+    model = AttentionModel.AttentionModel(mapping,representation,max_sequence_length,
+            args.embedding_size,args.enc_rnn_size,args.dec_rnn_size,
+            args.enc_type,attention=args.attention,attention_window=args.attention_window)
+
+    batch_sequences = tf.placeholder(shape=[None,max_sequence_length],dtype=tf.int32)
+    batch_sequence_masks = tf.placeholder(shape=[None,max_sequence_length],dtype=tf.float32)
+    batch_sequence_lengths = tf.placeholder(shape=[None],dtype=tf.float32)
+
+    batch_sequences_2 = tf.placeholder(shape=[None,max_sequence_length],dtype=tf.int32)
+    batch_sequence_masks_2 = tf.placeholder(shape=[None,max_sequence_length],dtype=tf.float32)
+    batch_sequence_lengths_2 = tf.placeholder(shape=[None],dtype=tf.float32)
+
+    dropout_keep_prob = tf.placeholder(dtype=tf.float32)
+    beam_size = tf.placeholder(dtype=tf.int32)
+    topn = tf.placeholder(dtype=tf.int32)
+
+    optimizer = model.get_parallel_optimizer(0.001,
+            src_lang,batch_sequences,batch_sequence_masks,batch_sequence_lengths,
+            tgt_lang,batch_sequences_2,batch_sequence_masks_2,batch_sequence_lengths_2,
+            dropout_keep_prob)
+
+    outputs, outputs_scores = model.transliterate_beam(src_lang,batch_sequences,batch_sequence_lengths,tgt_lang,beam_size,topn)
+
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    sess = tf.Session(config=config)
+    sess.run(tf.initialize_all_variables())
+
+    ### Training
+    train_batches = [ create_batch(mapping[src_lang],src_lang,args.vocab_size,args.batch_size,max_sequence_length,rng,args.max_word_length) +
+                      create_batch(mapping[tgt_lang],tgt_lang,args.vocab_size,args.batch_size,max_sequence_length,rng,args.max_word_length)
+                        for _ in xrange(args.warmup_steps+args.train_steps) ]
+
+    train_time = 0.0
+    for step, (sequences,masks,lengths,sequences_2,masks_2,lengths_2) in enumerate(train_batches):
+        start_time = time.time()
+        sess.run(optimizer, feed_dict = {
+            batch_sequences:sequences,batch_sequence_masks:masks,batch_sequence_lengths:lengths,
+            batch_sequences_2:sequences_2,batch_sequence_masks_2:masks_2,batch_sequence_lengths_2:lengths_2,
+            dropout_keep_prob:0.5
+            })
+        if step >= args.warmup_steps:
+            train_time += time.time()-start_time
+
+    ### Decoding
+    decode_batches = [ create_batch(mapping[src_lang],src_lang,args.vocab_size,args.decode_batch_size,max_sequence_length,rng,args.max_word_length)
+                        for _ in xrange(args.warmup_steps+args.decode_steps) ]
+
+    decode_time = 0.0
+    for step, (sequences,masks,lengths) in enumerate(decode_batches):
+        start_time = time.time()
+        sess.run([outputs, outputs_scores], feed_dict = {
+            batch_sequences:sequences,batch_sequence_lengths:lengths,
+            beam_size:args.beam_size,topn:args.topn
+            })
+        if step >= args.warmup_steps:
+            decode_time += time.time()-start_time
+
+    print 'Training: {} steps in {} (hh:mm:ss), {:.2f} steps/sec'.format(
+            args.train_steps, utilities.formatted_timeinterval(train_time), args.train_steps/train_time)
+    print 'Decoding: {} words in {} (hh:mm:ss), {:.2f} words/sec'.format(
+            args.decode_steps*args.decode_batch_size, utilities.formatted_timeinterval(decode_time),
+            args.decode_steps*args.decode_batch_size/decode_time)
+    sys.stdout.flush()
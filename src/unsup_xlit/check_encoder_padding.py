@@ -0,0 +1,98 @@
+"""
+Checks that the encoders which mask the padding give the same final states, and the same outputs within
+each sequence, however much padding the batch has. These are cnn_masked and the dynamic RNN encoders.
+
+The same random words are encoded twice, padded to the longest word and with --extra_padding more PAD
+positions. The graph is created with sequences of shape (batch_size x None), so this also checks that
+the encoders accept a number of time steps which is not known when the graph is created.
+
+    python check_encoder_padding.py --enc_types cnn_masked,bilstm_dynamic
+
+Exits with status 1 if the differences are larger than --tolerance.
+"""
+
+import argparse
+import sys
+
+import numpy as np
+import tensorflow as tf
+
+import AttentionModel
+import Mapping
+from check_numpy_decoding import create_mapping
+
+def pad_sequences(words, num_steps, pad_id):
+    """
+    Symbol ids of 'words' (lists of symbol ids) padded with pad_id, shape: (len(words) x num_steps)
+    """
+    sequences=np.full([len(words),num_steps],pad_id,dtype=np.int32)
+    for k, word in enumerate(words):
+        sequences[k,:len(word)]=word
+    return sequences
+
+if __name__ == '__main__' :
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--enc_types', type = str, default = 'cnn_masked,simple_lstm_noattn_dynamic,bilstm_dynamic', help = 'comma separated list of the encoders to check')
+    parser.add_argument('--embedding_size', type = int, default = 32, help = 'size of character representation')
+    parser.add_argument('--enc_rnn_size', type = int, default = 64, help = 'size of output of encoder RNN')
+    parser.add_argument('--vocab_size', type = int, default = 30, help = 'number of characters in the vocabulary')
+    parser.add_argument('--max_word_length', type = int, default = 12, help = 'maximum length of the random words')
+    parser.add_argument('--extra_padding', type = int, default = 8, help = 'number of PAD positions added to the batch in the second encoding')
+    parser.add_argument('--num_words', type = int, default = 100, help = 'number of words to encode')
+
+    parser.add_argument('--tolerance', type = float, default = 1e-5, help = 'largest allowed difference of the states and outputs')
+    parser.add_argument('--seed', type = int, default = 1, help = 'seed of the random parameters and words')
+
+    args = parser.parse_args()
+
+    print '========== Parameters start ==========='
+    for k,v in vars(args).iteritems():
+        print '{}: {}'.format(k,v)
+    print '========== Parameters end ============='
+
+    ## the model needs a language other than en, ar and zh for the shared output layer it creates
+    lang='hi'
+    mapping={lang: create_mapping(lang,[lang],args.vocab_size)}
+    representation={lang: 'onehot'}
+    pad_id=mapping[lang].get_index(Mapping.Mapping.PAD)
+    max_sequence_length=args.max_word_length+args.extra_padding
+
+    rng=np.random.RandomState(args.seed)
+    words=[ [ mapping[lang].get_index(unichr(0x100+k),lang) for k in rng.randint(0,args.vocab_size,size=rng.randint(1,args.max_word_length+1)) ]
+                for _ in xrange(args.num_words) ]
+    lengths=np.array([ len(word) for word in words ],dtype=np.float32)
+    num_steps=int(np.max(lengths))
+
+    report=[]
+    for enc_type in args.enc_types.split(','):
+        tf.reset_default_graph()
+        tf.set_random_seed(args.seed)
+
+        model = AttentionModel.AttentionModel(mapping,representation,max_sequence_length,
+                args.embedding_size,args.enc_rnn_size,args.enc_rnn_size,enc_type)
+        sequences = tf.placeholder(shape=[None,None],dtype=tf.int32)
+        sequence_lengths = tf.placeholder(shape=[None],dtype=tf.float32)
+        states, enc_outputs = model.compute_hidden_representation(sequences,sequence_lengths,lang,tf.constant(1.0))
+
+        sess = tf.Session()
+        sess.run(tf.initialize_all_variables())
+        results=[ sess.run([states,enc_outputs],{sequences: pad_sequences(words,steps,pad_id), sequence_lengths: lengths})
+                    for steps in [num_steps,num_steps+args.extra_padding] ]
+        sess.close()
+
+        ## the outputs are compared within each sequence only
+        masks=(np.arange(num_steps)[np.newaxis,:]<lengths[:,np.newaxis])[:,:,np.newaxis]
+        state_diff=np.max(np.abs(results[0][0]-results[1][0]))
+        output_diff=np.max(np.abs(results[0][1][:,:num_steps,:]-results[1][1][:,:num_steps,:])*masks)
+
+        report.append((enc_type,state_diff,output_diff,state_diff<=args.tolerance and output_diff<=args.tolerance))
+
+    print '========== Report start ==========='
+    for enc_type, state_diff, output_diff, passed in report:
+        print '{}: max state difference {}, max output difference {}: {}'.format(enc_type,state_diff,output_diff,
+                'PASSED' if passed else 'FAILED')
+    print '========== Report end ============='
+
+    sys.exit(0 if all([ passed for _, _, _, passed in report ]) else 1)
@@ -0,0 +1,221 @@
+"""
+Checks that ModelDecodingNumpy.py decodes like ModelDecoding.py, on a model with random parameters.
+
+The model and its mappings are saved like ModelTraining.py saves them, the parameters are exported
+with ModelExport.py, and the same random words are decoded with ModelDecoding.py and with
+ModelDecodingNumpy.py. For every input, the n-best candidates have to be the same and their scores
+equal within --tolerance. Two candidates can only be ranked differently if their scores are within
+the tolerance, since the rounding differences of NumPy and TensorFlow can reorder near ties.
+
+    python check_numpy_decoding.py --enc_type bilstm --attention local --prefix_tgtlang
+
+Exits with status 1 if the outputs differ.
+"""
+
+import argparse
+import codecs
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+import AttentionModel
+import Mapping
+
+def create_mapping(lang,langs,vocab_size):
+    """
+    CharacterMapping with vocab_size synthetic characters, and the language tokens of 'langs'
+    """
+    mapping=Mapping.CharacterMapping()
+    for k in xrange(vocab_size):
+        mapping.get_index(unichr(0x100+k),lang)
+    for token_lang in langs:
+        mapping.get_index(Mapping.create_special_token(token_lang),lang)
+    mapping.finalize_vocab()
+    return mapping
+
+def write_words(fname,vocab_size,num_words,max_word_length,rng):
+    """
+    Random words of the synthetic characters, with lengths between 1 and max_word_length
+    """
+    with codecs.open(fname,'w','utf-8') as outfile:
+        for _ in xrange(num_words):
+            word=[ unichr(0x100+k) for k in rng.randint(0,vocab_size,size=rng.randint(1,max_word_length+1)) ]
+            outfile.write(u' '.join(word)+u'\n')
+
+def read_nbest(fname):
+    """
+    Read the n-best output of the decoding scripts (see utilities.write_nbest_output)
+
+    Returns a list with the (candidate, score) pairs of each input, in rank order
+    """
+    nbest=[]
+    with codecs.open(fname,'r','utf-8') as infile:
+        for line in infile:
+            fields=line.split(u' ||| ')
+            sent_no=int(fields[0])
+            if sent_no==len(nbest):
+                nbest.append([])
+            nbest[sent_no].append((fields[1].strip(),float(fields[3])))
+    return nbest
+
+def compare_nbest(tf_nbest,np_nbest,tolerance):
+    """
+    Compare the n-best lists of ModelDecoding.py and ModelDecodingNumpy.py
+
+    Returns a tuple (num_same, num_reordered, errors, max_score_diff)
+      num_same: number of inputs with the same candidates in the same order
+      num_reordered: number of the other inputs, whose candidates differ only by near ties
+      errors: descriptions of the differences beyond the tolerance
+      max_score_diff: largest difference of the scores of a candidate in both lists
+    """
+    num_same=0
+    num_reordered=0
+    errors=[]
+    max_score_diff=0.0
+    if len(tf_nbest)!=len(np_nbest):
+        errors.append('{} inputs decoded with TensorFlow and {} with NumPy'.format(len(tf_nbest),len(np_nbest)))
+
+    for sent_no, (tf_cands, np_cands) in enumerate(zip(tf_nbest,np_nbest)):
+        if [ c for c, _ in tf_cands ]==[ c for c, _ in np_cands ]:
+            num_same+=1
+        num_errors=len(errors)
+
+        ## the score at each rank has to agree, whichever candidate has it
+        for rank, ((tf_cand, tf_score), (np_cand, np_score)) in enumerate(zip(tf_cands,np_cands)):
+            if abs(tf_score-np_score)>tolerance:
+                errors.append('input {}, rank {}: {} with score {} (TensorFlow), {} with score {} (NumPy)'.format(
+                                sent_no,rank,tf_cand.encode('utf-8'),tf_score,np_cand.encode('utf-8'),np_score))
+
+        ## a candidate in only one list has to be a near tie of the last candidate, which the other list ranked lower
+        tf_scores=dict(tf_cands)
+        np_scores=dict(np_cands)
+        last_score=min(tf_cands[-1][1],np_cands[-1][1])
+        for cand, score in tf_cands+np_cands:
+            if cand in tf_scores and cand in np_scores:
+                max_score_diff=max(max_score_diff,abs(tf_scores[cand]-np_scores[cand]))
+            elif score>last_score+tolerance:
+                errors.append('input {}: {} with score {} is not in both n-best lists'.format(
+                                sent_no,cand.encode('utf-8'),score))
+
+        if len(errors)==num_errors and [ c for c, _ in tf_cands ]!=[ c for c, _ in np_cands ]:
+            num_reordered+=1
+
+    return num_same, num_reordered, errors, max_score_diff
+
+if __name__ == '__main__' :
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--enc_type', type = str, default = 'cnn',  help = 'encoder to use. One of (1) simple_lstm_noattn (2) bilstm (3) cnn (4) cnn_masked: cnn, with the PAD positions masked out of the convolutions and the final state (5) simple_lstm_noattn_dynamic (6) bilstm_dynamic: same as (1) and (2), but the RNN is run in a loop up to the longest sequence in the batch')
+    parser.add_argument('--attention', type = str, default = 'global',  help = 'attention mechanism: global or local')
+    parser.add_argument('--attention_window', type = int, default = 3, help = 'half width of the window of local attention')
+    parser.add_argument('--prefix_tgtlang', action='store_true', default = False,
+            help = 'Prefix the input sequence with the language code for the target language')
+    parser.add_argument('--prefix_srclang', action='store_true', default = False,
+            help = 'Prefix the input sequence with the language code for the source language')
+    parser.add_argument('--embedding_size', type = int, default = 32, help = 'size of character representation')
+    parser.add_argument('--enc_rnn_size', type = int, default = 64, help = 'size of output of encoder RNN')
+    parser.add_argument('--dec_rnn_size', type = int, default = 64, help = 'size of output of dec RNN')
+    parser.add_argument('--vocab_size', type = int, default = 30, help = 'number of characters in the vocabulary of each language')
+    parser.add_argument('--max_seq_length', type = int, default = 20, help = 'maximum sequence length')
+    parser.add_argument('--weight_scale', type = float, default = 3.0, help = 'the random parameters are multiplied by this factor, so that the output distributions are not nearly uniform. Much larger factors saturate the LSTMs, and the rounding differences then grow over the decoder steps')
+
+    parser.add_argument('--num_words', type = int, default = 200, help = 'number of words to decode')
+    parser.add_argument('--batch_size', type = int, default = 50, help = 'size of each batch used in decoding')
+    parser.add_argument('--topn', type = int, default = 5, help = 'The top-n candidates to report')
+    parser.add_argument('--beam_size', type = int, default = 5, help = 'beam size for decoding')
+
+    parser.add_argument('--tolerance', type = float, default = 1e-4, help = 'largest allowed difference of the scores')
+    parser.add_argument('--seed', type = int, default = 1, help = 'seed of the random parameters and words')
+    parser.add_argument('--work_dir', type = str, default = None, help = 'directory for the model, the exported parameters and the outputs. A temporary directory, removed at the end, is used if not given')
+
+    args = parser.parse_args()
+
+    print '========== Parameters start ==========='
+    for k,v in vars(args).iteritems():
+        print '{}: {}'.format(k,v)
+    print '========== Parameters end ============='
+
+    src_lang, tgt_lang = 'en', 'hi'
+    lang_pair='{}-{}'.format(src_lang,tgt_lang)
+    work_dir=args.work_dir if args.work_dir is not None else tempfile.mkdtemp()
+    mapping_dir=os.path.join(work_dir,'mappings')
+    if not os.path.exists(mapping_dir):
+        os.makedirs(mapping_dir)
+
+    rng=np.random.RandomState(args.seed)
+    tf.set_random_seed(args.seed)
+
+    ### mappings, saved like ModelTraining.py saves them
+    mapping={}
+    for lang in [src_lang,tgt_lang]:
+        mapping[lang]=create_mapping(lang,[src_lang,tgt_lang],args.vocab_size)
+        with open(os.path.join(mapping_dir,'mapping_{}.json'.format(lang)),'w') as mapping_json_file:
+            mapping[lang].save_mapping(mapping_json_file)
+    representation=dict([ (lang,'onehot') for lang in [src_lang,tgt_lang] ])
+
+    ### model with random parameters
+    model = AttentionModel.AttentionModel(mapping,representation,args.max_seq_length,
+            args.embedding_size,args.enc_rnn_size,args.dec_rnn_size,args.enc_type,
+            attention=args.attention,attention_window=args.attention_window,
+            source_prefix_length=int(args.prefix_tgtlang)+int(args.prefix_srclang))
+
+    ## the decoding graph creates the decoder variables
+    batch_sequences = tf.placeholder(shape=[None,args.max_seq_length],dtype=tf.int32)
+    batch_sequence_lengths = tf.placeholder(shape=[None],dtype=tf.float32)
+    model.transliterate_beam(src_lang,batch_sequences,batch_sequence_lengths,tgt_lang,
+                                tf.placeholder(dtype=tf.int32),tf.placeholder(dtype=tf.int32))
+
+    sess = tf.Session()
+    sess.run(tf.initialize_all_variables())
+    for var in tf.trainable_variables():
+        sess.run(var.assign(var*args.weight_scale))
+    model_fname=tf.train.Saver().save(sess,os.path.join(work_dir,'model'))
+    model.save_attention_config(model_fname)
+    sess.close()
+
+    in_fname=os.path.join(work_dir,'words.'+src_lang)
+    write_words(in_fname,args.vocab_size,args.num_words,args.max_seq_length-2-int(args.prefix_tgtlang)-int(args.prefix_srclang),rng)
+
+    ### export and decode with the scripts
+    script_dir=os.path.dirname(os.path.abspath(__file__))
+    def run_script(script,script_args):
+        subprocess.check_call([sys.executable,os.path.join(script_dir,script)]+script_args)
+
+    arch_args=['--lang_pair',lang_pair,'--max_seq_length',str(args.max_seq_length),'--enc_type',args.enc_type,
+               '--embedding_size',str(args.embedding_size),'--enc_rnn_size',str(args.enc_rnn_size),
+               '--dec_rnn_size',str(args.dec_rnn_size),'--representation','onehot',
+               '--shared_mapping_class','CharacterMapping','--mapping_dir',mapping_dir]
+    prefix_args=[ flag for flag, is_set in [('--prefix_tgtlang',args.prefix_tgtlang),('--prefix_srclang',args.prefix_srclang)] if is_set ]
+    decode_args=['--batch_size',str(args.batch_size),'--topn',str(args.topn),'--beam_size',str(args.beam_size),
+                 '--in_fname',in_fname]+prefix_args
+
+    weights_fname=os.path.join(work_dir,'model.npz')
+    run_script('ModelExport.py',arch_args+prefix_args+['--model_fname',model_fname,'--out_fname',weights_fname])
+
+    tf_out_fname=os.path.join(work_dir,'nbest.tf')
+    np_out_fname=os.path.join(work_dir,'nbest.numpy')
+    run_script('ModelDecoding.py',arch_args+decode_args+['--model_fname',model_fname,'--out_fname',tf_out_fname])
+    run_script('ModelDecodingNumpy.py',['--lang_pair',lang_pair,'--representation','onehot','--shared_mapping_class',
+                'CharacterMapping','--mapping_dir',mapping_dir,'--weights_fname',weights_fname,'--out_fname',np_out_fname]+decode_args)
+
+    ### compare
+    num_same, num_reordered, errors, max_score_diff = compare_nbest(read_nbest(tf_out_fname),read_nbest(np_out_fname),args.tolerance)
+
+    print '========== Report start ==========='
+    print 'Inputs with the same n-best list: {}'.format(num_same)
+    print 'Inputs with near ties ranked differently: {}'.format(num_reordered)
+    print 'Max score difference: {}'.format(max_score_diff)
+    for error in errors:
+        print 'ERROR: '+error
+    print 'PASSED' if len(errors)==0 else 'FAILED'
+    print '========== Report end ============='
+
+    if args.work_dir is None:
+        shutil.rmtree(work_dir)
+    sys.exit(0 if len(errors)==0 else 1)
@@ -0,0 +1,147 @@
+import os
+import codecs
+import itertools as it
+import hashlib
+import json
+
+import numpy as np
+
+import Mapping
+
+### bump this whenever the on-disk layout of the cache changes
+CACHE_VERSION=1
+
+def file_digest(filename,block_size=1<<20):
+    """
+    SHA1 digest of the contents of a file
+    """
+    h=hashlib.sha1()
+    with open(filename,'rb') as infile:
+        for block in iter(lambda: infile.read(block_size),b''):
+            h.update(block)
+    return h.hexdigest()
+
+def cache_key(filename,lang,mapping,max_sequence_length,train_size):
+    """
+    Key identifying an encoded corpus. The key changes if the corpus file,
+    the contents of the mapping or the encoding parameters change.
+    """
+    key_data=[CACHE_VERSION,file_digest(filename),mapping.get_fingerprint(),
+                lang,max_sequence_length,train_size]
+    return hashlib.sha1(json.dumps(key_data)).hexdigest()
+
+def encode_corpus_file(filename,lang,mapping,max_sequence_length,train_size=-1):
+    """
+    Read a corpus file (one sequence per line, space separated symbols) and convert it to ids.
+    Only the first train_size lines are read if train_size > 0
+
+    Every sequence is wrapped with GO and EOW and padded with PAD to max_sequence_length.
+
+    Returns a tuple (sequences, lengths, tokens)
+        sequences: int32 array of shape (num_words x max_sequence_length)
+        lengths: int32 array of shape (num_words)
+        tokens: list of distinct input symbols in the order in which they were first seen.
+                Calling mapping.get_index on these (in order) reproduces the vocabulary
+                updates made while encoding the file
+    """
+    with codecs.open(filename,'r','utf-8') as infile:
+        lines = it.islice(infile,train_size) if train_size > 0 else infile
+        # NOTE: -2 should be -1
+        file_read = map(lambda x: [Mapping.Mapping.GO]+(x.strip().split(' '))[:max_sequence_length-2]+[Mapping.Mapping.EOW],
+                        lines)
+
+    sequences, lengths = mapping.encode_batch(file_read,lang,max_sequence_length)
+    tokens = [Mapping.Mapping.PAD]+Mapping.get_distinct_symbols(file_read)
+
+    return sequences, lengths, tokens
+
+def write_cache(cache_dir,key,sequences,lengths,tokens):
+    """
+    Write the encoded corpus to the cache directory.
+
+    Two files are written: <key>.bin containing the sequences followed by the lengths
+    (int32, C order) and <key>.json containing the header. Files are written to
+    temporary names and then renamed, so concurrent readers never see partial files.
+    """
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            ## created by a concurrent process
+            pass
+
+    bin_fname=os.path.join(cache_dir,key+'.bin')
+    hdr_fname=os.path.join(cache_dir,key+'.json')
+    tmp_suffix='.tmp{}'.format(os.getpid())
+
+    with open(bin_fname+tmp_suffix,'wb') as binfile:
+        np.ascontiguousarray(sequences,dtype=np.int32).tofile(binfile)
+        np.ascontiguousarray(lengths,dtype=np.int32).tofile(binfile)
+    os.rename(bin_fname+tmp_suffix,bin_fname)
+
+    header={
+        'version': CACHE_VERSION,
+        'num_words': sequences.shape[0],
+        'max_sequence_length': sequences.shape[1],
+        'dtype': 'int32',
+        'tokens': tokens,
+    }
+    with open(hdr_fname+tmp_suffix,'w') as hdrfile:
+        json.dump(header,hdrfile)
+    os.rename(hdr_fname+tmp_suffix,hdr_fname)
+
+def read_cache(cache_dir,key):
+    """
+    Open an encoded corpus from the cache directory as read-only memory-mapped arrays
+
+    Returns a tuple (sequences, lengths, tokens), or None if the key is not in the cache
+    """
+    bin_fname=os.path.join(cache_dir,key+'.bin')
+    hdr_fname=os.path.join(cache_dir,key+'.json')
+
+    if not (os.path.exists(hdr_fname) and os.path.exists(bin_fname)):
+        return None
+
+    with open(hdr_fname,'r') as hdrfile:
+        header=json.load(hdrfile)
+
+    num_words=header['num_words']
+    max_sequence_length=header['max_sequence_length']
+    dtype=np.dtype(header['dtype'])
+
+    if num_words==0:
+        ## empty files cannot be memory-mapped
+        return np.zeros([0,max_sequence_length],dtype=dtype), np.zeros([0],dtype=dtype), header['tokens']
+
+    sequences=np.memmap(bin_fname,dtype=dtype,mode='r',shape=(num_words,max_sequence_length))
+    lengths=np.memmap(bin_fname,dtype=dtype,mode='r',shape=(num_words,),
+                        offset=num_words*max_sequence_length*dtype.itemsize)
+
+    return sequences, lengths, header['tokens']
+
+def load_corpus(filename,lang,mapping,max_sequence_length,train_size=-1,cache_dir=None):
+    """
+    Load the id-encoded corpus, using the cache in 'cache_dir' if it is not None.
+
+    If the mapping is still collecting vocabulary (update mode), a cache hit replays the
+    vocabulary updates recorded when the corpus was first encoded, so the mapping ends
+    up in the same state as if the file had been read.
+
+    Returns a tuple (sequences, lengths). See encode_corpus_file for details
+    """
+    if cache_dir is None:
+        sequences, lengths, _ = encode_corpus_file(filename,lang,mapping,max_sequence_length,train_size)
+        return sequences, lengths
+
+    key=cache_key(filename,lang,mapping,max_sequence_length,train_size)
+    cached=read_cache(cache_dir,key)
+    if cached is not None:
+        sequences, lengths, tokens = cached
+        if mapping.update_mode:
+            for c in tokens:
+                mapping.get_index(c,lang)
+        return sequences, lengths
+
+    sequences, lengths, tokens = encode_corpus_file(filename,lang,mapping,max_sequence_length,train_size)
+    write_cache(cache_dir,key,sequences,lengths,tokens)
+    return sequences, lengths
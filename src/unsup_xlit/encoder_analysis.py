@@ -51,7 +51,7 @@ tf.app.flags.DEFINE_string('lang', '',
         'language under study')
 
 tf.app.flags.DEFINE_string('enc_type',  'cnn', 
-        'encoder to use. One of (1)simple_lstm_noattn (2) bilstm (3) cnn')
+        'encoder to use. One of (1)simple_lstm_noattn (2) bilstm (3) cnn (4) cnn_masked (5) simple_lstm_noattn_dynamic (6) bilstm_dynamic')
 tf.app.flags.DEFINE_string('representation',  'onehot', 
         'input representation, which can be specified in two ways: (i) one of "phonetic", "onehot", "onehot_and_phonetic"')
 tf.app.flags.DEFINE_string('shared_mapping_class',  'IndicPhoneticMapping', 
@@ -148,15 +148,16 @@ def compute_hidden_representation(model, sequences, sequence_lengths, lang):
     Return: 
      a tuple (states, enc_outputs)
       states: final state of the encoder, shape: (batch_size x encoder_state_size)
-      enc_outputs: list of Tensors with shape (batch_size x enc_output_size). 
-        Length of list=max_seq_length. One element in the list for each timestamp
+      enc_outputs: Tensor with shape (batch_size x num_steps x enc_output_size)
 
     """
     dropout_keep_prob=tf.constant(1.0)
     sequence_embeddings = tf.add(tf.nn.embedding_lookup(model.embed_W[lang],sequences),model.embed_b[lang])
     _ , enc_outputs = model.input_encoder.encode(sequence_embeddings,sequence_lengths,dropout_keep_prob)
 
-    return tf.transpose(tf.pack(enc_outputs),perm=[1,0,2])
+    if isinstance(enc_outputs,list):
+        return tf.transpose(tf.pack(enc_outputs),perm=[1,0,2])
+    return enc_outputs
 
 
 def get_label(x,lang): 
@@ -245,7 +246,7 @@ def main(argv=None):
         # Creating Model object
         model = AttentionModel.AttentionModel(mapping,representation,FLAGS.max_seq_length,
                 FLAGS.embedding_size,FLAGS.enc_rnn_size,FLAGS.dec_rnn_size,
-                FLAGS.enc_type,FLAGS.separate_output_embedding)
+                FLAGS.enc_type,FLAGS.separate_output_embedding,inference_mode=True)
 
         ## Creating placeholder for sequences, masks and lengths and dropout keep probability 
         batch_sequences = tf.placeholder(shape=[None,FLAGS.max_seq_length],dtype=tf.int32)
@@ -254,7 +255,7 @@ def main(argv=None):
         # Predict output for test sequences
         o_enc_outputs = compute_hidden_representation(model,batch_sequences,batch_sequence_lengths,FLAGS.lang)
 
-        return batch_sequences, batch_sequence_lengths, o_enc_outputs
+        return model, batch_sequences, batch_sequence_lengths, o_enc_outputs
         print "Done with creating graph. Starting session"
 
     def run_graph(): 
@@ -269,6 +270,7 @@ def main(argv=None):
         sess = tf.Session(config=config)
         sess.run(tf.initialize_all_variables())
         saver.restore(sess,FLAGS.model_fname)
+        model.fold_embeddings(sess)
         
         print "Session started"
 
@@ -313,7 +315,7 @@ def main(argv=None):
 
     sequences, sequence_pos, sequence_lengths, sequence_masks, = prepare_data()
 
-    batch_sequences, batch_sequence_lengths, o_enc_outputs = create_graph()
+    model, batch_sequences, batch_sequence_lengths, o_enc_outputs = create_graph()
 
     enc_outputs=run_graph()
 
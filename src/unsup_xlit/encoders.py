@@ -1,11 +1,31 @@
+import re
+
 import tensorflow as tf
 
+def get_lstm_variables(scope): 
+    """
+    Variables (matrix, bias) of the BasicLSTMCell run under the variable scope 'scope' (e.g. 'RNN', 'BiRNN/FW', 
+    'decoder'). The cell must have been run, since the variables are created when the graph for it is built
+    """
+    def find(name): 
+        pattern=r'^(.*/)?{}/(.*/)?BasicLSTMCell/Linear/{}:0$'.format(re.escape(scope),name)
+        matches=[ v for v in tf.all_variables() if re.match(pattern,v.name) ]
+        if len(matches)!=1: 
+            raise ValueError('Expected one LSTM {} variable for scope {}, found {}'.format(name,scope,len(matches)))
+        return matches[0]
+    return find('Matrix'), find('Bias')
+
 class Encoder(object):
 
     def encode(self, sequences, sequence_lengths):
         '''
             sequences: batch_size * max_length
             sequence_lengths: batch_size
+
+            returns a tuple (states, enc_outputs)
+              states: batch_size * state_size
+              enc_outputs: list of max_length Tensors of shape batch_size * output_size, or 
+                  a single Tensor of shape batch_size * num_steps * output_size (the dynamic and CNN encoders)
         '''
         pass 
 
@@ -15,6 +35,13 @@ class Encoder(object):
     def get_state_size(self): 
         pass 
 
+    def get_weights(self): 
+        '''
+            returns a dictionary of the encoder parameters (Tensors) by name, for exporting 
+            the model (see AttentionModel.export_weights)
+        '''
+        pass 
+
 class SimpleRnnEncoder(Encoder):
 
     def __init__(self,embedding_size,max_sequence_length,rnn_size):
@@ -24,9 +51,11 @@ class SimpleRnnEncoder(Encoder):
         self.encoder_cell = tf.nn.rnn_cell.BasicLSTMCell(rnn_size,state_is_tuple=False)
 
     def encode(self, sequence_embeddings, sequence_lengths,dropout_keep_prob):
+        ## the number of timesteps is taken from the input, so that shorter (bucketed) batches can be encoded
+        max_sequence_length = sequence_embeddings.get_shape()[1].value
         x = tf.transpose(sequence_embeddings,[1,0,2])
         x = tf.reshape(x,[-1,self.embedding_size])
-        x = tf.split(0,self.max_sequence_length,x,name='encoder_input')
+        x = tf.split(0,max_sequence_length,x,name='encoder_input')
         cell=tf.nn.rnn_cell.DropoutWrapper(self.encoder_cell,output_keep_prob=dropout_keep_prob)
         enc_outputs, states = tf.nn.rnn(cell, x, dtype = tf.float32, sequence_length = sequence_lengths)
         return states, enc_outputs
@@ -37,6 +66,10 @@ class SimpleRnnEncoder(Encoder):
     def get_state_size(self): 
         return self.encoder_cell.state_size 
 
+    def get_weights(self): 
+        W, b = get_lstm_variables('RNN')
+        return {'W':W, 'b':b}
+
 class BidirectionalRnnEncoder(Encoder):
 
     def __init__(self,embedding_size,max_sequence_length,rnn_size):
@@ -47,9 +80,11 @@ class BidirectionalRnnEncoder(Encoder):
         self.bw_encoder_cell = tf.nn.rnn_cell.BasicLSTMCell(rnn_size,state_is_tuple=False)
 
     def encode(self, sequence_embeddings, sequence_lengths,dropout_keep_prob):
+        ## the number of timesteps is taken from the input, so that shorter (bucketed) batches can be encoded
+        max_sequence_length = sequence_embeddings.get_shape()[1].value
         x = tf.transpose(sequence_embeddings,[1,0,2])
         x = tf.reshape(x,[-1,self.embedding_size])
-        x = tf.split(0,self.max_sequence_length,x,name='encoder_input')
+        x = tf.split(0,max_sequence_length,x,name='encoder_input')
         fw_cell=tf.nn.rnn_cell.DropoutWrapper(self.fw_encoder_cell,output_keep_prob=dropout_keep_prob)
         bw_cell=tf.nn.rnn_cell.DropoutWrapper(self.bw_encoder_cell,output_keep_prob=dropout_keep_prob)
         enc_outputs, states, _ = tf.nn.bidirectional_rnn(fw_cell, bw_cell, x, dtype = tf.float32, sequence_length = sequence_lengths)
@@ -62,14 +97,66 @@ class BidirectionalRnnEncoder(Encoder):
     def get_state_size(self): 
         return self.fw_encoder_cell.state_size 
 
+    def get_weights(self): 
+        fw_W, fw_b = get_lstm_variables('BiRNN/FW')
+        bw_W, bw_b = get_lstm_variables('BiRNN/BW')
+        return {'fw_W':fw_W, 'fw_b':fw_b, 'bw_W':bw_W, 'bw_b':bw_b}
+
+def truncate_to_longest(sequence_embeddings, sequence_lengths):
+    """
+    Truncate the batch to the longest sequence in it. 
+
+    Returns the truncated embeddings and the sequence lengths as int32 
+    """
+    sequence_lengths=tf.minimum(tf.cast(sequence_lengths,tf.int32),tf.shape(sequence_embeddings)[1])
+    num_steps=tf.reduce_max(sequence_lengths)
+    x=tf.slice(sequence_embeddings,[0,0,0],tf.pack([-1,num_steps,-1]))
+    x.set_shape([None,None,sequence_embeddings.get_shape()[2]])
+    return x, sequence_lengths
+
+class DynamicRnnEncoder(SimpleRnnEncoder):
+    """
+    Same as SimpleRnnEncoder, but runs the RNN in a loop (dynamic_rnn) instead of unrolling it in the graph. 
+    The number of timesteps need not be known when the graph is created, and only the timesteps up to 
+    the longest sequence in the batch are run. 
+
+    The encoder outputs are a Tensor of shape (batch_size x num_steps x output_size). The variables are 
+    the same as those of SimpleRnnEncoder.
+    """
+
+    def encode(self, sequence_embeddings, sequence_lengths,dropout_keep_prob):
+        x, sequence_lengths = truncate_to_longest(sequence_embeddings, sequence_lengths)
+        cell=tf.nn.rnn_cell.DropoutWrapper(self.encoder_cell,output_keep_prob=dropout_keep_prob)
+        enc_outputs, states = tf.nn.dynamic_rnn(cell, x, dtype = tf.float32, sequence_length = sequence_lengths)
+        return states, enc_outputs
+
+class DynamicBidirectionalRnnEncoder(BidirectionalRnnEncoder):
+    """
+    Same as BidirectionalRnnEncoder, but runs the RNNs in a loop (bidirectional_dynamic_rnn). 
+    See DynamicRnnEncoder. 
+    """
+
+    def encode(self, sequence_embeddings, sequence_lengths,dropout_keep_prob):
+        x, sequence_lengths = truncate_to_longest(sequence_embeddings, sequence_lengths)
+        fw_cell=tf.nn.rnn_cell.DropoutWrapper(self.fw_encoder_cell,output_keep_prob=dropout_keep_prob)
+        bw_cell=tf.nn.rnn_cell.DropoutWrapper(self.bw_encoder_cell,output_keep_prob=dropout_keep_prob)
+        (fw_outputs, bw_outputs), (states, _) = tf.nn.bidirectional_dynamic_rnn(fw_cell, bw_cell, x, 
+                                                    dtype = tf.float32, sequence_length = sequence_lengths)
+        enc_outputs = tf.concat(2,[fw_outputs,bw_outputs])
+        return states, enc_outputs
+
 class CNNEncoder(Encoder):
 
-    def __init__(self,embedding_size,max_sequence_length,filter_sizes,num_filters):
+    def __init__(self,embedding_size,max_sequence_length,filter_sizes,num_filters,mask_padding=False):
         self.filter_sizes=filter_sizes
         self.embedding_size=embedding_size
         self.num_filters=num_filters
         self.max_sequence_length=max_sequence_length 
         self.maxpool_width=4
+        ## if True, the positions after the sequence length are masked out of the convolutions, max pooling 
+        ## and the final state (the average over the positions within the sequence length), otherwise 
+        ## the PAD positions are used like the others 
+        self.mask_padding=mask_padding
 
         self.W=[]
         self.b=[]
@@ -81,45 +168,55 @@ class CNNEncoder(Encoder):
                 self.b.append(tf.Variable(tf.constant(0.0, shape=[self.num_filters]), name="b"))
 
     def encode(self, sequence_embeddings, sequence_lengths,dropout_keep_prob):
-        input_data = tf.expand_dims(sequence_embeddings, -1)
+        ## the number of timesteps need not be known when the graph is created 
+        num_steps=tf.shape(sequence_embeddings)[1]
+
+        ## with mask_padding, the positions after the end of each sequence are zero for the convolutions and 
+        ## max pooling, like the SAME padding. The outputs within the sequence then do not depend on the PAD 
+        ## positions of the batch
+        masks=None
+        if self.mask_padding: 
+            lengths=tf.minimum(tf.cast(sequence_lengths,tf.int32),num_steps)
+            masks=tf.expand_dims(tf.cast(tf.sequence_mask(lengths,num_steps),tf.float32),2)
+            sequence_embeddings=sequence_embeddings*masks
 
         # Create a convolution + maxpool layer for each filter size
         pooled_outputs = []
         for i, filter_size in enumerate(self.filter_sizes):
             with tf.name_scope("conv-maxpool-%s" % filter_size):
-                # Convolution Layer
-                conv = tf.nn.conv2d(
-                    input_data,
-                    self.W[i],
-                    strides=[1, 1, self.embedding_size, 1],
+                ## 1D convolution over time. The filter variable keeps its original (conv2d) shape, so that 
+                ## existing models can be loaded
+                conv = tf.nn.conv1d(
+                    sequence_embeddings,
+                    tf.reshape(self.W[i],[filter_size,self.embedding_size,self.num_filters]),
+                    stride=1,
                     padding="SAME",
                     name="conv")
                 # Apply nonlinearity
                 h = tf.nn.relu(tf.nn.bias_add(conv, self.b[i]), name="relu")
+                ## h is not negative, so the masked positions never give the maximum
+                if masks is not None: 
+                    h = h*masks
                 # Maxpooling over the outputs
                 pooled = tf.nn.max_pool(
-                    h,
+                    tf.expand_dims(h,2),
                     ksize=[1, self.maxpool_width, 1, 1],
                     strides=[1, 1, 1, 1],
                     padding='SAME',
                     name="pool")
-                pooled_outputs.append(pooled)
-
-        ## encoder output matrix of dimension: [batch,max_sequence_length,len(filter_sizes)*num_filters]
-        total_num_filters=self.num_filters*len(self.filter_sizes)
-        enc_output_matrix=tf.reshape(tf.squeeze(tf.concat(3,pooled_outputs)),
-                [-1,self.max_sequence_length,total_num_filters])
+                pooled_outputs.append(tf.squeeze(pooled,[2]))
 
-        ## output encoding  and dropout 
-        enc_outputs=tf.unpack(tf.transpose(tf.nn.dropout(enc_output_matrix,dropout_keep_prob),[1,0,2]))
+        ## encoder output matrix of dimension: [batch,num_steps,len(filter_sizes)*num_filters]
+        enc_output_matrix=tf.concat(2,pooled_outputs)
 
-        ## final state generation: taking as average of all time step vectors
-        def state_gen_func(batch_no): 
-            s=tf.slice(enc_output_matrix,[batch_no,0,0],[1,self.max_sequence_length,self.get_output_size()])
-            return tf.add_n(tf.unpack(tf.squeeze(s)))/self.max_sequence_length
+        ## output encoding and dropout 
+        enc_outputs=tf.nn.dropout(enc_output_matrix,dropout_keep_prob)
 
-        batch_size=tf.shape(enc_output_matrix)[0]
-        states=tf.map_fn(state_gen_func,tf.range(0,batch_size),dtype=tf.float32)
+        ## a single reduction over the time steps for the entire batch
+        if self.mask_padding: 
+            states=tf.reduce_sum(enc_output_matrix*masks,1)/tf.expand_dims(tf.cast(tf.maximum(lengths,1),tf.float32),1)
+        else: 
+            states=tf.reduce_mean(enc_output_matrix,1)
 
         return states, enc_outputs 
 
@@ -128,3 +225,11 @@ class CNNEncoder(Encoder):
 
     def get_state_size(self): 
         return self.num_filters*len(self.filter_sizes)
+
+    def get_weights(self): 
+        ## the filters in the conv1d shape (filter_size x embedding_size x num_filters)
+        weights={}
+        for i, filter_size in enumerate(self.filter_sizes):
+            weights['W_{}'.format(filter_size)]=tf.reshape(self.W[i],[filter_size,self.embedding_size,self.num_filters])
+            weights['b_{}'.format(filter_size)]=self.b[i]
+        return weights
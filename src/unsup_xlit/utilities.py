@@ -1,9 +1,86 @@
 import time 
+import codecs
+
+import numpy as np
 
 def formatted_timeinterval(seconds):
     m, s = divmod(seconds, 60)
     h, m = divmod(m, 60)
     return "%d:%02d:%02d" % (h, m, s)
 
+def token_batch_size(lengths, tokens_per_batch): 
+    """
+    Number of sequences from the start of 'lengths' whose total length is at most 
+    tokens_per_batch. At least one sequence is always taken
+    """
+    return max(1, int(np.searchsorted(np.cumsum(lengths), tokens_per_batch, side='right')))
+
+def batch_boundaries(lengths, batch_size, tokens_per_batch=None): 
+    """
+    Split sequences (in order) into consecutive batches. Each batch has batch_size sequences, 
+    or if tokens_per_batch is not None, as many sequences as fit in tokens_per_batch (see token_batch_size)
+
+    Returns list of (start,end) tuples
+    """
+    num_words = len(lengths)
+    if tokens_per_batch is None: 
+        return [ (start, min(start+batch_size,num_words)) for start in xrange(0,num_words,batch_size) ]
+
+    cum_lengths = np.cumsum(lengths)
+    boundaries = []
+    start = 0
+    while start < num_words: 
+        offset = cum_lengths[start-1] if start > 0 else 0
+        end = max(start+1, int(np.searchsorted(cum_lengths, offset+tokens_per_batch, side='right')))
+        boundaries.append((start,end))
+        start = end
+    return boundaries
+
+def write_nbest_output(out_fname, predicted_sents, predicted_scores): 
+    """
+    Write the n-best candidates in the format of the decoders (Moses n-best format). 
+
+    predicted_sents: list of the candidate words, num_ranks consecutive candidates for each input 
+    predicted_scores: array of scores, shape: (num_inputs x num_ranks)
+    """
+    num_sents, num_ranks = predicted_scores.shape
+    with codecs.open(out_fname,'w','utf-8') as outfile: 
+        for sent_no in xrange(num_sents): 
+            for rank in xrange(num_ranks): 
+                sent=predicted_sents[sent_no*num_ranks+rank]
+                outfile.write(u'{} ||| {} ||| Distortion0= -1 LM0= -1 WordPenalty0= -1 PhrasePenalty0= -1 TranslationModel0= -1 -1 -1 -1 ||| {}\n'.format(sent_no,sent,predicted_scores[sent_no,rank]))
+
+def minimize(optimizer, loss, var_optimizers=None): 
+    """
+    Same as optimizer.minimize(loss), except that the sparse gradients (e.g. of embedding lookups) are 
+    summed over duplicate indices first. The sparse update of Adam squares each entry of the gradient, 
+    so it differs from the dense update if an index occurs more than once
+
+    var_optimizers: list of (variables, condition, var_optimizer). The gradients of 'variables' are applied 
+    with 'var_optimizer', and only if the boolean scalar Tensor 'condition' is true. The other variables 
+    are updated with 'optimizer'
+    """
+    ## imported here, so that the other utilities can be used without TensorFlow (see ModelDecodingNumpy.py)
+    import tensorflow as tf
+
+    grads_and_vars = []
+    for grad, var in optimizer.compute_gradients(loss): 
+        if isinstance(grad, tf.IndexedSlices): 
+            indices, positions = tf.unique(grad.indices)
+            values = tf.unsorted_segment_sum(grad.values, positions, tf.shape(indices)[0])
+            grad = tf.IndexedSlices(values, indices, grad.dense_shape)
+        grads_and_vars.append((grad, var))
 
+    if var_optimizers is None: 
+        return optimizer.apply_gradients(grads_and_vars)
 
+    updates = []
+    cond_vars = set()
+    for variables, condition, var_optimizer in var_optimizers: 
+        variables = set(variables)
+        cond_vars.update(variables)
+        cond_grads_and_vars = [ (grad, var) for grad, var in grads_and_vars if var in variables and grad is not None ]
+        if len(cond_grads_and_vars) > 0: 
+            updates.append(tf.cond(condition, lambda: var_optimizer.apply_gradients(cond_grads_and_vars), tf.no_op))
+    updates.append(optimizer.apply_gradients([ (grad, var) for grad, var in grads_and_vars if var not in cond_vars ]))
+    return tf.group(*updates)